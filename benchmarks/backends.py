@@ -0,0 +1,92 @@
+"""Compares the throughput of the storage backends for storing, revoking and
+draining (claiming and deleting) scheduled tasks.
+
+Usage: python benchmarks/backends.py [--count N] [--redis-url URL]
+
+Without --redis-url, a temporary redis server is started (this requires the
+redis binary, like the tests).
+"""
+from celery_longterm_scheduler.backend import by_url
+import argparse
+import celery
+import os
+import pendulum
+import tempfile
+import testing.redis
+import time
+
+
+DUE = pendulum.datetime(2017, 1, 20)
+
+
+def task(i):
+    return ('benchmark.remind',), {
+        'args': (i, 'article-%s' % i), 'kwargs': {},
+        'task_id': 'task-%s' % i, 'queue': 'reminders'}
+
+
+def throughput(count, func):
+    start = time.perf_counter()
+    func()
+    return count / (time.perf_counter() - start)
+
+
+def measure(backend, count):
+    result = {}
+    ids = ['task-%s' % i for i in range(count)]
+
+    def store():
+        for i, id in enumerate(ids):
+            backend.set(DUE.add(seconds=i), id, *task(i))
+    result['store/s'] = throughput(count, store)
+
+    def revoke():
+        for id in ids[::2]:
+            backend.delete(id)
+    result['revoke/s'] = throughput(len(ids[::2]), revoke)
+    backend.set_many(
+        (DUE.add(seconds=i), id, *task(i)) for i, id in enumerate(ids)
+        if i % 2 == 0)
+
+    def drain():
+        while True:
+            claimed = backend.claim(DUE.add(seconds=count), 1000, 60)
+            if not claimed:
+                break
+            backend.ack(claimed)
+    result['drain/s'] = throughput(count, drain)
+    return result
+
+
+def backends(redis_url):
+    app = celery.Celery()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yield 'memory', by_url('memory://', app)
+        yield 'sqlite', by_url(
+            'sqlite://' + os.path.join(tmpdir, 'schedule.db'), app)
+    if redis_url:
+        yield 'redis', by_url(redis_url, app)
+    else:
+        server = testing.redis.RedisServer()
+        try:
+            yield 'redis', by_url(
+                'redis://{host}:{port}/{db}'.format(**server.dsn()), app)
+        finally:
+            server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--redis-url')
+    options = parser.parse_args()
+    print('%-8s %12s %12s %12s' % (
+        'backend', 'store/s', 'revoke/s', 'drain/s'))
+    for name, backend in backends(options.redis_url):
+        result = measure(backend, options.count)
+        print('%-8s %12.0f %12.0f %12.0f' % (
+            name, result['store/s'], result['revoke/s'], result['drain/s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""Measures the scheduler end-to-end through its public API, per backend:
+scheduling with ``Task.apply_async(eta=...)``, revoke latency, draining with
+``Scheduler.execute_pending()`` and the storage memory per scheduled entry.
+
+Usage: python benchmarks/scheduler.py [--backend NAME ...] [--sizes N,N,...]
+           [--redis-url URL] [--output FILE] [--compare FILE]
+
+The results are written as JSON (to stdout or --output), so runs of different
+versions can be compared with --compare, which prints the relative change of
+each metric and exits with status 1 if any got worse by more than
+--threshold percent.
+
+Without --redis-url, a temporary redis server is started (this requires the
+redis binary, like the tests). The backend ``redis-buckets`` is redis with
+``longterm_scheduler_payload_buckets``; the temporary server allows compact
+hashes with values up to 1 KB, for other servers see the README. On a given
+server, the benchmark only uses (and deletes) keys starting with
+``KEY_PREFIX``, but the memory measurement is skewed by other clients.
+
+Draining does not publish to a real broker, ``send_task()`` is replaced by a
+no-op, so we measure the scheduler and its storage only.
+"""
+import argparse
+import celery
+import celery_longterm_scheduler
+import celery_longterm_scheduler.backend
+import contextlib
+import datetime
+import importlib.metadata
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import testing.redis
+import time
+import tracemalloc
+
+
+DUE = datetime.datetime(2017, 1, 20, tzinfo=datetime.timezone.utc)
+# Number of entries for the apply_async, revoke and memory measurements.
+SAMPLE_SIZE = 10000
+# Lower is better for these, higher for all others.
+LOWER_IS_BETTER = ('_ms', 'bytes/entry')
+# Prepended with the backend name to the redis keys, so we only touch ours.
+KEY_PREFIX = 'longterm_scheduler_benchmark:'
+# Settings per backend name, in addition to longterm_scheduler_backend.
+BACKEND_CONF = {
+    # About 100 entries per bucket for the memory measurement.
+    'redis-buckets': {'longterm_scheduler_payload_buckets': 100},
+}
+
+
+@contextlib.contextmanager
+def backend_urls(names, redis_url):
+    with contextlib.ExitStack() as stack:
+        urls = {}
+        for name in names:
+            if name == 'memory':
+                urls[name] = 'memory://'
+            elif name == 'sqlite':
+                tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+                urls[name] = 'sqlite://' + os.path.join(tmpdir, 'schedule.db')
+            elif name.startswith('redis') and redis_url:
+                urls[name] = redis_url
+            elif name.startswith('redis'):
+                server = testing.redis.RedisServer(redis_conf={
+                    'hash-max-ziplist-value': 1024})
+                stack.callback(server.stop)
+                urls[name] = 'redis://{host}:{port}/{db}'.format(
+                    **server.dsn())
+            else:
+                raise ValueError('Unknown backend %r' % name)
+        yield urls
+
+
+def create_app(name, url):
+    """Returns a celery app with an empty schedule stored at ``url``."""
+    app = celery.Celery(task_cls=celery_longterm_scheduler.Task)
+    app.conf['broker_url'] = 'memory://'
+    app.conf['longterm_scheduler_backend'] = url
+    app.conf['longterm_scheduler_log_tasks'] = False
+    app.conf['longterm_scheduler_key_prefix'] = '%s%s:' % (KEY_PREFIX, name)
+    app.conf.update(BACKEND_CONF.get(name, {}))
+    backend = celery_longterm_scheduler.get_scheduler(app).backend
+    if hasattr(backend, 'client'):
+        keys = backend.client.scan_iter(
+            match=backend.key_prefix + '*', count=1000)
+        for chunk in celery_longterm_scheduler.backend.chunked(keys, 1000):
+            backend.client.delete(*chunk)
+    elif hasattr(backend, 'connection'):
+        backend.connection.execute('DELETE FROM scheduled_task')
+    app.task(name='benchmark.remind')(remind)
+    # We only want to measure the scheduler, not the broker.
+    app.send_task = lambda *args, **kw: None
+    return app
+
+
+def remind(user_id, article):
+    pass
+
+
+def entries(count):
+    for i in range(count):
+        yield (
+            (i, 'article-%s' % i), {}, DUE + datetime.timedelta(seconds=i),
+            {'queue': 'reminders'})
+
+
+def measure_apply_async(name, url):
+    app = create_app(name, url)
+    task = app.tasks['benchmark.remind']
+    start = time.perf_counter()
+    for args, kwargs, eta, options in entries(SAMPLE_SIZE):
+        task.apply_async(args, kwargs, eta=eta, **options)
+    return {'apply_async/s': SAMPLE_SIZE / (time.perf_counter() - start)}
+
+
+def measure_revoke(name, url):
+    app = create_app(name, url)
+    ids = app.tasks['benchmark.remind'].apply_async_many(
+        entries(SAMPLE_SIZE))
+    scheduler = celery_longterm_scheduler.get_scheduler(app)
+    latencies = []
+    for id in ids:
+        start = time.perf_counter()
+        scheduler.revoke(id)
+        latencies.append((time.perf_counter() - start) * 1000)
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {'revoke_p50_ms': percentiles[49],
+            'revoke_p99_ms': percentiles[98]}
+
+
+def measure_drain(name, url, size):
+    app = create_app(name, url)
+    app.tasks['benchmark.remind'].apply_async_many(entries(size))
+    scheduler = celery_longterm_scheduler.get_scheduler(app)
+    start = time.perf_counter()
+    scheduler.execute_pending(DUE + datetime.timedelta(seconds=size))
+    duration = time.perf_counter() - start
+    assert scheduler.backend.next_due() is None
+    return {'drain/s@%s' % size: size / duration}
+
+
+def measure_memory(name, url):
+    app = create_app(name, url)
+    backend = celery_longterm_scheduler.get_scheduler(app).backend
+    task = app.tasks['benchmark.remind']
+    if hasattr(backend, 'client'):
+        def used():
+            return backend.client.info('memory')['used_memory']
+    elif hasattr(backend, 'connection'):
+        def pragma(name):
+            return backend.connection.execute(
+                'PRAGMA %s' % name).fetchone()[0]
+
+        def used():
+            # Pages freed by earlier runs are reused, so the file size does
+            # not tell us much.
+            return pragma('page_size') * (
+                pragma('page_count') - pragma('freelist_count'))
+    else:
+        tracemalloc.start()
+
+        def used():
+            return tracemalloc.get_traced_memory()[0]
+    before = used()
+    task.apply_async_many(entries(SAMPLE_SIZE))
+    result = (used() - before) / SAMPLE_SIZE
+    tracemalloc.stop()
+    return {'bytes/entry': result}
+
+
+def run(options):
+    sizes = [int(x) for x in options.sizes.split(',')]
+    results = {}
+    with backend_urls(options.backend, options.redis_url) as urls:
+        for name, url in urls.items():
+            result = results[name] = {}
+            print('Measuring %s' % name, file=sys.stderr)
+            result.update(measure_apply_async(name, url))
+            result.update(measure_revoke(name, url))
+            for size in sizes:
+                result.update(measure_drain(name, url, size))
+            result.update(measure_memory(name, url))
+    return {
+        'meta': {
+            'version': importlib.metadata.version(
+                'celery_longterm_scheduler'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': datetime.datetime.now(
+                datetime.timezone.utc).isoformat(),
+            'sample_size': SAMPLE_SIZE,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Prints the relative change of each metric in ``current`` compared to
+    ``baseline``, returns whether any got worse by more than ``threshold``
+    percent."""
+    regressed = False
+    print('%-8s %-16s %14s %14s %9s' % (
+        'backend', 'metric', 'baseline', 'current', 'change'))
+    for name, result in current['results'].items():
+        for metric, value in result.items():
+            old = baseline['results'].get(name, {}).get(metric)
+            if not old:
+                continue
+            change = (value - old) / old * 100
+            worse = -change if not metric.endswith(LOWER_IS_BETTER) \
+                else change
+            flag = ''
+            if worse > threshold:
+                regressed = True
+                flag = ' !'
+            print('%-8s %-16s %14.6g %14.6g %+8.1f%%%s' % (
+                name, metric, old, value, change, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--backend', action='append',
+        choices=['memory', 'redis', 'redis-buckets', 'sqlite'],
+        help='Backend to measure, can be given several times '
+        '(default: memory and redis)')
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--redis-url')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=10)
+    options = parser.parse_args()
+    options.backend = options.backend or ['memory', 'redis']
+    current = run(options)
+    output = json.dumps(current, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    elif not options.compare:
+        print(output)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, current, options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
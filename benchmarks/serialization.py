@@ -0,0 +1,70 @@
+"""Compares the stored entry format of version 1.3 and earlier (pickled Task
+instance) with the current one (task name only), and the available
+serializers and compressions, in bytes per entry and serialize/deserialize
+time.
+
+Usage: python benchmarks/serialization.py [--number N]
+"""
+from celery_longterm_scheduler.serializer import Codec
+import argparse
+import celery
+import celery_longterm_scheduler
+import timeit
+
+
+app = celery.Celery(task_cls=celery_longterm_scheduler.Task)
+
+
+@app.task(name='benchmark.remind', queue='reminders')
+def remind(user_id, article_id):
+    pass
+
+
+def entry(with_task_type):
+    """Returns (args, kw) like Task._schedule() stores them."""
+    kw = dict(
+        args=(1234, 'article-5678'), kwargs={}, task_id='a' * 36,
+        producer=None, link=None, link_error=None, shadow=None,
+        ignore_result=False, queue='reminders')
+    if with_task_type:
+        kw['task_type'] = remind.__maybe_evaluate__()
+    return ((remind.name,), kw)
+
+
+def measure(codec, task, number):
+    raw = codec.dumps(task)
+    return {
+        'bytes': len(raw),
+        'serialize_us': timeit.timeit(
+            lambda: codec.dumps(task), number=number) / number * 1e6,
+        'deserialize_us': timeit.timeit(
+            lambda: codec.loads(raw), number=number) / number * 1e6,
+    }
+
+
+def codecs():
+    for serializer in ['json', 'pickle', 'msgpack']:
+        for compression in [None, 'zlib', 'lz4']:
+            try:
+                codec = Codec(serializer, compression, 0)
+            except ImportError:
+                continue
+            yield '%s+%s' % (serializer, compression or 'none'), codec
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=10000)
+    options = parser.parse_args()
+    print('%-8s %-20s %8s %14s %16s' % (
+        'task', 'codec', 'bytes', 'serialize µs', 'deserialize µs'))
+    for task, with_task_type in [('pickle', True), ('name', False)]:
+        for name, codec in codecs():
+            result = measure(codec, entry(with_task_type), options.number)
+            print('%-8s %-20s %8d %14.1f %16.1f' % (
+                task, name, result['bytes'], result['serialize_us'],
+                result['deserialize_us']))
+
+
+if __name__ == '__main__':
+    main()
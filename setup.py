@@ -21,15 +21,26 @@ setup(
         'pendulum',
         'redis>=3.0',
         'setuptools',
+        'sortedcontainers',
     ],
-    extras_require={'test': [
-        'pytest',
-        'testing.redis',
-    ]},
+    extras_require={
+        'lz4': ['lz4'],
+        'msgpack': ['msgpack'],
+        'test': [
+            'pytest',
+            'testing.redis',
+        ],
+    },
     entry_points={
         'celery.commands': [
             'longterm_scheduler = celery_longterm_scheduler.scheduler:main',
-        ]
+        ],
+        'celery_longterm_scheduler.backends': [
+            'memory = celery_longterm_scheduler.backend:MemoryBackend',
+            'redis = celery_longterm_scheduler.backend:RedisBackend',
+            'rediss = celery_longterm_scheduler.backend:RedisBackend',
+            'sqlite = celery_longterm_scheduler.backend:SQLiteBackend',
+        ],
     },
     classifiers=[
         'Programming Language :: Python',
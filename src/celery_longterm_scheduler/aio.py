@@ -0,0 +1,325 @@
+"""asyncio variant of the scheduler API, for applications that run in an
+event loop (e.g. async web frontends), so storing and revoking tasks does not
+block the loop.
+
+This only supports the redis storage. It uses ``redis.asyncio`` (which
+requires redis>=4.2) with its own connection pool, and the same key schema
+and serialization as ``celery_longterm_scheduler.backend.RedisBackend``, so
+it can be used alongside the synchronous scheduler on the same database.
+"""
+from celery_longterm_scheduler import backend
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class AsyncRedisBackend(backend.RedisSchema):
+    """asyncio implementation of the redis backend, its methods are
+    coroutines that otherwise behave like those of ``RedisBackend``."""
+
+    def _create_client(self):
+        import redis.asyncio
+        connparams = dict(self.connparams)
+        # celery's URL parsing chooses the connection class for unix sockets
+        # and TLS from the synchronous redis module.
+        connection_class = connparams.get('connection_class')
+        if connection_class is not None:
+            connparams['connection_class'] = getattr(
+                redis.asyncio, connection_class.__name__)
+        return redis.asyncio.StrictRedis(
+            connection_pool=redis.asyncio.ConnectionPool(**connparams))
+
+    async def _execute(self, pipe):
+        commands = list(pipe.command_stack)
+        results = await pipe.execute(raise_on_error=False)
+        retry = self._unknown_scripts(results)
+        if retry:
+            pipe = self.client.pipeline(transaction=False)
+            self._pipe_retry(pipe, commands, retry)
+            retried = (await pipe.execute(raise_on_error=False))[-len(retry):]
+            for i, result in zip(retry, retried):
+                results[i] = result
+        return self._checked(results)
+
+    async def set(self, timestamp, task_id, args, kw):
+        pipe = self.client.pipeline(transaction=True)
+        self._pipe_set_many(pipe, [self._dump(timestamp, task_id, args, kw)])
+        await self._execute(pipe)
+
+    async def set_earliest(self, timestamp, task_id, args, kw):
+        pipe = self.client.pipeline(transaction=True)
+        self._pipe_set_many(
+            pipe, [self._dump(timestamp, task_id, args, kw)],
+            keep_earliest=True)
+        return bool((await self._execute(pipe))[0])
+
+    async def set_many(self, entries):
+        for chunk in backend.chunked(entries, self.batch_size):
+            tasks = [self._dump(*entry) for entry in chunk]
+            pipe = self.client.pipeline(transaction=False)
+            self._pipe_set_many(pipe, tasks)
+            await self._execute(pipe)
+
+    async def reschedule(self, task_id, timestamp):
+        return bool(await self.reschedule_many([(task_id, timestamp)]))
+
+    async def reschedule_many(self, entries):
+        rescheduled = 0
+        for chunk in backend.chunked(entries, self.batch_size):
+            pipe = self.client.pipeline(transaction=False)
+            self._pipe_reschedule_many(pipe, chunk)
+            rescheduled += sum((await self._execute(pipe))[:-1])
+        return rescheduled
+
+    async def get(self, task_id):
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_get(pipe, task_id)
+        task = self._got(await self._execute(pipe))
+        if task is None:
+            raise KeyError(task_id)
+        return self._load(task)
+
+    async def delete(self, task_id):
+        if not await self.delete_many([task_id]):
+            raise KeyError(task_id)
+
+    async def delete_many(self, task_ids):
+        if not task_ids:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_delete_many(pipe, task_ids)
+        return sum(await self._execute(pipe))
+
+    async def claim(self, timestamp, limit, lease):
+        now = backend.serialize_timestamp(timestamp)
+        max_score = self._max_score(now)
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_promote(pipe, now)
+        if self.shards == 1:
+            limits = {0: limit}
+        else:
+            self._pipe_peek(pipe, max_score, limit)
+            limits = self._claim_limits(
+                (await self._execute(pipe))[self.shards:], limit)
+            pipe = self.client.pipeline(transaction=False)
+        self._pipe_claim(pipe, max_score, limits, lease)
+        results = await self._execute(pipe)
+        return self._claimed(results[len(results) - len(limits):])
+
+    async def ack(self, entries):
+        if not entries:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_ack(pipe, entries)
+        return sum(await self._execute(pipe))
+
+    async def release(self, entries):
+        if not entries:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_release(pipe, entries)
+        return sum(await self._execute(pipe))
+
+    async def requeue_expired(self):
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_requeue_expired(pipe)
+        pipe.zcard(self._legacy_key())
+        *requeued, legacy = await self._execute(pipe)
+        if legacy:
+            await self._migrate_legacy()
+        return sum(requeued)
+
+    async def _migrate_legacy(self):
+        key = self._legacy_key()
+        moved = 0
+        while True:
+            ids = await self.client.zrange(key, 0, self.batch_size - 1)
+            if not ids:
+                break
+            pipe = self.client.pipeline(transaction=False)
+            self._pipe_migrate(
+                pipe, key, ids, self.BY_TIME_KEY, 1000 * self.SCORE_FACTOR)
+            moved += sum(await self._execute(pipe))
+        log.warning(self.LEGACY_WARNING, moved)
+        return moved
+
+    async def fail(self, entries, timestamp, backoff, max_retries):
+        if not entries:
+            return []
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_fail(pipe, entries, timestamp, backoff, max_retries)
+        return self._failed(await self._execute(pipe))
+
+    async def count(self, start=None, end=None):
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_count(pipe, start, end)
+        return sum(await self._execute(pipe))
+
+    async def list(self, start=None, end=None, limit=100, cursor=None,
+                   payloads=False):
+        pipe = self.client.pipeline(transaction=False)
+        after = self._pipe_list(pipe, start, end, limit, cursor)
+        entries, cursor = self._listed(await self._execute(pipe), after, limit)
+        tasks = None
+        if payloads and entries:
+            ids = [(id, shard) for _, id, shard in entries]
+            pipe = self.client.pipeline(transaction=False)
+            queued = self._pipe_get_payloads(pipe, ids)
+            tasks = self._got_payloads(ids, queued, await self._execute(pipe))
+        return (self._list_entries(entries, tasks), cursor)
+
+    async def next_due(self):
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_next_due(pipe)
+        return self._next_due(await self._execute(pipe))
+
+    async def close(self):
+        await self.client.connection_pool.disconnect()
+
+
+class AsyncScheduler:
+    """asyncio variant of ``celery_longterm_scheduler.Scheduler``:
+
+    :store: schedule tasks for later
+    :store_many: schedule many tasks for later
+    :revoke: revoke scheduled tasks
+    :pending: iterate over scheduled tasks due by a given timestamp
+
+    Clients should use ``get_async_scheduler(app)`` with their celery app
+    instance to get hold of the corresponding AsyncScheduler instance. Like
+    any ``redis.asyncio`` client, it must only be used from one event loop.
+    """
+
+    CONF_KEY = '__longterm_scheduler_async_backend'
+
+    def __init__(self, app):
+        self.app = app
+        # Singleton behaviour
+        if self.CONF_KEY not in app.conf:
+            url = app.conf['longterm_scheduler_backend']
+            if backend.backend_class(url.split('://')[0]) is not \
+                    backend.RedisBackend:
+                raise ValueError(
+                    'AsyncScheduler requires a redis backend, got %r' % url)
+            app.conf[self.CONF_KEY] = AsyncRedisBackend(url, app)
+        self.backend = app.conf[self.CONF_KEY]
+        self.batch_size = int(
+            app.conf.get('longterm_scheduler_batch_size') or
+            backend.DEFAULT_BATCH_SIZE)
+        self.lease = int(
+            app.conf.get('longterm_scheduler_lease') or backend.DEFAULT_LEASE)
+        max_retries = app.conf.get('longterm_scheduler_max_retries')
+        self.max_retries = int(
+            backend.DEFAULT_MAX_RETRIES if max_retries is None
+            else max_retries)
+        self.retry_backoff = float(
+            app.conf.get('longterm_scheduler_retry_backoff') or
+            backend.DEFAULT_RETRY_BACKOFF)
+
+    @classmethod
+    def from_app(cls, app):
+        return cls(app)
+
+    async def store(self, timestamp, task_id, args, kw, keep_earliest=False):
+        """Schedules the task, see ``Scheduler.store()``."""
+        if keep_earliest:
+            return await self.backend.set_earliest(
+                timestamp, task_id, args, kw)
+        await self.backend.set(timestamp, task_id, args, kw)
+        return True
+
+    async def store_many(self, entries):
+        """Schedules many tasks at once, see ``Scheduler.store_many()``.
+
+        :param entries: iterable of tuple (timestamp, task_id, args, kw), it
+          is consumed lazily
+        """
+        await self.backend.set_many(entries)
+
+    async def reschedule(self, task_id, eta):
+        """Changes the due time of a scheduled task, see
+        ``Scheduler.reschedule()``."""
+        return await self.backend.reschedule(task_id, eta)
+
+    async def reschedule_many(self, entries):
+        """Changes the due time of many scheduled tasks, see
+        ``Scheduler.reschedule_many()``."""
+        return await self.backend.reschedule_many(entries)
+
+    async def count(self, start=None, end=None):
+        """Returns the number of scheduled tasks, see
+        ``Scheduler.count()``."""
+        return await self.backend.count(start, end)
+
+    async def next_due(self):
+        """Returns the time the earliest scheduled task is due, or None."""
+        return await self.backend.next_due()
+
+    async def list(self, start=None, end=None, limit=100, cursor=None,
+                   payloads=False):
+        """Returns one page of the scheduled tasks, see
+        ``Scheduler.list()``."""
+        return await self.backend.list(start, end, limit, cursor, payloads)
+
+    async def revoke(self, task_id):
+        """Removes the task scheduled under ``task_id`` from scheduler
+        storage.
+
+        :returns: True if ``task_id`` was found and removed, False otherwise"""
+        try:
+            await self.backend.delete(task_id)
+            log.info('Revoked %s', task_id)
+            return True
+        except KeyError:
+            return False
+
+    async def pending(self, timestamp):
+        """Yields (task_id, args, kw) of the scheduled tasks that are due on
+        or before ``timestamp``, in due order, and removes them from scheduler
+        storage once the loop body is done with them.
+
+        The tasks are claimed in batches of ``longterm_scheduler_batch_size``,
+        like ``Scheduler.execute_pending()`` does, so several consumers can
+        run at the same time. If the loop is left early (or raises), the
+        tasks that were claimed but not yet handled are put back after
+        ``longterm_scheduler_lease`` seconds. (Wrap the iterator in
+        ``contextlib.aclosing()`` in that case, so the handled ones are
+        removed right away, not only when it is garbage collected.)
+
+        Tasks that cannot be loaded are not yielded, but retried and
+        eventually quarantined like in ``Scheduler.execute_pending()``.
+
+        :param timestamp: timezone-aware datetime
+        """
+        await self.backend.requeue_expired()
+        while True:
+            batch = await self.backend.claim(
+                timestamp, self.batch_size, self.lease)
+            if not batch:
+                break
+            done = []
+            failed = []
+            try:
+                for entry in batch:
+                    task_id, task, _ = entry
+                    if isinstance(task, backend.UnreadableTask):
+                        log.warning('Cannot load %s: %s', task_id, task)
+                        failed.append((task_id, '%s: %s' % (
+                            type(task).__name__, task)))
+                        continue
+                    args, kw = task
+                    kw.pop('longterm_tags', None)
+                    yield (task_id, args, kw)
+                    done.append(entry)
+            finally:
+                await self.backend.ack(done)
+                await self.backend.fail(
+                    failed, timestamp, self.retry_backoff, self.max_retries)
+
+    async def close(self):
+        """Closes the connections to the storage."""
+        await self.backend.close()
+
+
+get_async_scheduler = AsyncScheduler.from_app
@@ -1,11 +1,37 @@
-import base64
-import binascii
-import celery.backends.redis
+from celery_longterm_scheduler.serializer import Codec
+# BBB The JSON serialization used to live here.
+from celery_longterm_scheduler.serializer import (  # noqa
+    PickleFallbackJSONEncoder, serialize, deserialize)
+import calendar
 import collections
-import json
-import pendulum
-import pickle
-import redis
+import contextlib
+import datetime
+import hashlib
+import heapq
+import importlib
+import itertools
+import logging
+import math
+import re
+import threading
+import time
+import zlib
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_LEASE = 600
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_BACKOFF = 60
+
+
+class UnreadableTask(Exception):
+    """Returned by ``claim()`` instead of the (args, kw) of an entry whose
+    payload cannot be deserialized (e.g. a pickled Task instance whose class
+    no longer exists), so it does not prevent claiming the other entries.
+    The original exception is its ``__cause__``."""
 
 
 class AbstractBackend:
@@ -26,7 +52,13 @@ class AbstractBackend:
 
     def set(self, timestamp, task_id, args, kw):
         """Stores ``args`` and ``kw`` under ``task_id`` and ``timestamp``.
-        args and kw are serialized using JSON.
+        args and kw are serialized using the ``Codec`` configured in
+        ``app.conf`` (by default JSON).
+
+        The entry is indexed by the tags in ``kw['longterm_tags']`` (if any)
+        and, with the setting ``longterm_scheduler_index_task_names``, by
+        the task name ``args[0]``, see ``delete_by_tag()``. Storing an entry
+        that is currently claimed ends the claim, see ``ack()``.
 
         :param timestamp: timezone-aware datetime
         :param task_id: string
@@ -35,6 +67,25 @@ class AbstractBackend:
         """
         raise NotImplementedError()
 
+    def set_earliest(self, timestamp, task_id, args, kw):
+        """Stores the entry like ``set()``, unless an entry with ``task_id``
+        is already scheduled at or before ``timestamp`` or is currently
+        claimed; both checking and storing are done atomically.
+
+        :returns: True if the entry was stored
+        """
+        raise NotImplementedError()
+
+    def set_many(self, entries):
+        """Stores many task entries like ``set()``, but in bulk. Raises
+        ValueError like ``set()``; entries of the failed batch may or may not
+        have been stored then.
+
+        :param entries: iterable of tuple (timestamp, task_id, args, kw), it
+          is consumed lazily
+        """
+        raise NotImplementedError()
+
     def get(self, task_id):
         """Retrieves a task entry stored by ``set()``
 
@@ -50,64 +101,1076 @@ class AbstractBackend:
         """
         raise NotImplementedError()
 
+    def delete_many(self, task_ids):
+        """Removes the task entries stored by ``set()`` for all ``task_ids``.
+        Ids that are not found are ignored.
+
+        :param task_ids: list of strings
+        :returns: int, the number of entries that were actually removed
+        """
+        raise NotImplementedError()
+
+    def delete_by_tag(self, tag):
+        """Removes all entries stored with ``tag`` in ``kw['longterm_tags']``,
+        in batches, so this is O(number of matching entries).
+
+        :returns: int, the number of entries that were removed
+        """
+        raise NotImplementedError()
+
+    def delete_by_name(self, name):
+        """Removes all entries of the task ``name`` like ``delete_by_tag()``.
+        Requires the setting ``longterm_scheduler_index_task_names``, only
+        entries stored with it are found.
+
+        :returns: int, the number of entries that were removed
+        """
+        raise NotImplementedError()
+
+    def reschedule(self, task_id, timestamp):
+        """Changes the due time of a scheduled entry, without rewriting its
+        payload. Claimed entries are not changed.
+
+        :param timestamp: timezone-aware datetime
+        :returns: True if ``task_id`` was scheduled, False otherwise
+        """
+        raise NotImplementedError()
+
+    def reschedule_many(self, entries):
+        """Like ``reschedule()`` for each entry, but in batches. Ids that are
+        not scheduled are ignored.
+
+        :param entries: iterable of tuple (task_id, timestamp)
+        :returns: int, the number of entries that were actually rescheduled
+        """
+        raise NotImplementedError()
+
     def get_older_than(self, timestamp):
         """Retrieves task entries scheduled for times older or equal than
         ``timestamp``.
 
+        The entries are returned in due-time order, as a generator, so
+        implementations should fetch them incrementally instead of loading
+        everything at once. Entries that are deleted concurrently are skipped.
+
         :param timestamp: timezone-aware datetime
         :return: iterable of tuple (task_id, (args, kw))
         """
         raise NotImplementedError()
 
+    def claim(self, timestamp, limit, lease):
+        """Atomically takes up to ``limit`` entries scheduled for times older
+        or equal than ``timestamp`` out of the schedule, and marks them as
+        in-flight for ``lease`` seconds. Claimed entries are not returned by
+        ``get_older_than()`` or another ``claim()``, so several scheduler
+        processes can work in parallel without dispatching a task twice.
+
+        The caller must remove the claimed entries with ``ack()`` once they
+        have been dispatched. Claims that were not removed before their lease
+        expires are put back into the schedule by ``requeue_expired()``.
+
+        :param timestamp: timezone-aware datetime
+        :param limit: int, maximum number of entries
+        :param lease: int, seconds
+        :return: list of tuple (task_id, (args, kw), timestamp), in due-time
+          order; (args, kw) is an ``UnreadableTask`` instance if the payload
+          cannot be deserialized
+        """
+        raise NotImplementedError()
+
+    def ack(self, entries):
+        """Removes claimed entries once they have been dispatched. Unlike
+        ``delete_many()``, an entry is only removed while it is still claimed,
+        so an entry that was stored again in the meantime is kept.
+
+        :param entries: list of tuple (task_id, (args, kw), timestamp), as
+          returned by ``claim()``
+        :returns: int, the number of entries that were still claimed
+        """
+        raise NotImplementedError()
+
+    def release(self, entries):
+        """Puts claimed entries back into the schedule under their original
+        due time, e.g. because they cannot be dispatched right now.
+
+        :param entries: list of tuple (task_id, (args, kw), timestamp), as
+          returned by ``claim()``
+        :returns: int, the number of entries that were still claimed
+        """
+        raise NotImplementedError()
+
+    def fail(self, entries, timestamp, backoff, max_retries):
+        """Records that claimed entries could not be dispatched. Each entry
+        is put back into the schedule, due ``backoff * 2 ** (failures - 1)``
+        seconds after ``timestamp``, where failures is how often it failed
+        so far. Entries that failed more than ``max_retries`` times are moved
+        into the quarantine instead, see ``quarantined()``. Removing an
+        entry with ``ack()`` or ``delete_many()`` also resets its failures.
+
+        :param entries: list of tuple (task_id, error), error is a string
+          describing the failure
+        :param timestamp: timezone-aware datetime
+        :param backoff: float, seconds
+        :param max_retries: int
+        :returns: list of tuple (task_id, failures, timestamp) of the entries
+          that were still claimed; timestamp is the new due time, or None if
+          the entry was quarantined
+        """
+        raise NotImplementedError()
+
+    def quarantined(self):
+        """Retrieves the quarantined entries, in the order they were
+        quarantined, as a generator. Their payloads are kept, so ``get()``
+        and ``delete()`` work as usual.
+
+        :return: iterable of tuple (task_id, error, timestamp), error is the
+          last one passed to ``fail()``, timestamp the time of quarantine
+        """
+        raise NotImplementedError()
+
+    def replay(self, task_ids, timestamp):
+        """Puts quarantined entries back into the schedule, due at
+        ``timestamp``, and resets their failures.
+
+        :param task_ids: iterable of task ids, or None for all quarantined
+          entries
+        :param timestamp: timezone-aware datetime
+        :returns: int, the number of entries that were quarantined
+        """
+        raise NotImplementedError()
+
+    def count(self, start=None, end=None):
+        """Returns the number of scheduled (not claimed) entries, optionally
+        only those due between ``start`` and ``end`` (inclusive). This only
+        reads the index, not the payloads.
+
+        :param start: timezone-aware datetime, or None for no lower bound
+        :param end: timezone-aware datetime, or None for no upper bound
+        """
+        raise NotImplementedError()
+
+    def list(self, start=None, end=None, limit=100, cursor=None,
+             payloads=False):
+        """Returns one page of the scheduled (not claimed) entries due
+        between ``start`` and ``end`` (inclusive), in due-time order. Only
+        the index is read, unless ``payloads`` is True.
+
+        :param limit: int, maximum number of entries
+        :param cursor: string, as returned by the previous call, to get the
+          next page; None for the first page
+        :returns: tuple (entries, cursor) -- entries is a list of tuple
+          (task_id, (args, kw) or None, timestamp), cursor is None if there
+          are no more entries
+        """
+        raise NotImplementedError()
+
+    def requeue_expired(self):
+        """Puts claimed entries whose lease has expired back into the schedule
+        (as due immediately), e.g. after a scheduler process crashed. This is
+        called at the start of each run, so backends also move entries
+        stored in an older layout that ``claim()`` would not see (e.g. by
+        producers of an older version during a deploy), see ``migrate()``.
+
+        :returns: int, the number of entries that were requeued
+        """
+        raise NotImplementedError()
+
+    def next_due(self):
+        """Returns the time the earliest scheduled entry is due.
+
+        :returns: timezone-aware datetime, or None if nothing is scheduled
+        """
+        raise NotImplementedError()
+
+    def wait(self, before, timeout):
+        """Blocks until an entry due earlier than ``before`` is stored with
+        ``set()`` or rescheduled (by any process), or until ``timeout``
+        seconds have passed.
+        Implementations start listening for new entries on the first call,
+        so callers should call ``wait(None, 0)`` once before looking at the
+        schedule.
+
+        :param before: timezone-aware datetime, or None to wake up for any
+          new entry
+        :param timeout: float, seconds
+        :returns: True if woken up by a new entry, False on timeout
+        """
+        raise NotImplementedError()
+
+    def cleanup(self, force=False):
+        """Removes inconsistent leftovers from storage: payloads that are not
+        scheduled, and schedule entries that have no payload. This is a
+        maintenance operation that should be safe to run at any time, also
+        on large databases.
+
+        Raises ValueError if the backend cannot tell its payloads apart from
+        other data in the same database, unless ``force`` is True, in which
+        case such data is removed as well.
+
+        :returns: tuple (int, int), the number of removed payloads and of
+          removed schedule entries
+        """
+        raise NotImplementedError()
+
+    def migrate(self):
+        """Moves entries stored in an older storage layout into the one that
+        is currently configured. This should be idempotent and safe to run
+        while schedulers are running.
+
+        :returns: int, the number of moved entries
+        """
+        raise NotImplementedError()
+
 
 class MemoryBackend(AbstractBackend):
-    """In-memory backend implementation, for tests."""
+    """In-memory backend implementation, for tests, load tests and
+    single-process deployments. It is thread-safe.
 
-    def __init__(self, unused_url, unused_app):
+    Entries are indexed in a sorted list of (timestamp, sequence, task_id),
+    so inserting, deleting and claiming are O(log n); the sequence keeps
+    entries with the same timestamp in insertion order.
+    """
+
+    def __init__(self, unused_url, app):
+        import sortedcontainers
+        self.codec = Codec.from_conf(app.conf)
+        self.batch_size = int(
+            app.conf.get('longterm_scheduler_batch_size') or
+            DEFAULT_BATCH_SIZE)
         self.by_id = {}
-        self.by_time = collections.defaultdict(list)
+        self.by_time = sortedcontainers.SortedList()
+        # task_id: its key in by_time
+        self.index_keys = {}
+        # task_id: lease deadline
+        self.in_flight = {}
+        # task_id: (failures, last error)
+        self.failures = {}
+        # task_id: timestamp, in the order they were quarantined
+        self.quarantine = {}
+        self.index_task_names = bool(
+            app.conf.get('longterm_scheduler_index_task_names'))
+        # label: set of task_ids, see labels()
+        self.by_label = collections.defaultdict(set)
+        # task_id: its labels
+        self.labels = {}
+        self.sequence = itertools.count()
+        self.lock = threading.RLock()
+        self.stored = threading.Condition(self.lock)
+        self.earliest_stored = None
 
     def set(self, timestamp, task_id, args, kw):
         if timestamp.tzinfo is None:
             raise ValueError('Timezone required, got %s', timestamp)
-        self.by_id[task_id] = serialize([args, kw])
-        self.by_time[serialize_timestamp(timestamp)].append(task_id)
+        timestamp = serialize_timestamp(timestamp)
+        task = self.codec.dumps([args, kw])
+        with self.lock:
+            self._unindex(task_id)
+            self.by_id[task_id] = task
+            self._index(timestamp, task_id)
+            for label in labels(args, kw, self.index_task_names):
+                self.by_label[label].add(task_id)
+                self.labels.setdefault(task_id, []).append(label)
+            self._stored(timestamp)
+
+    def set_earliest(self, timestamp, task_id, args, kw):
+        if timestamp.tzinfo is None:
+            raise ValueError('Timezone required, got %s', timestamp)
+        with self.lock:
+            key = self.index_keys.get(task_id)
+            if task_id in self.in_flight or (
+                    key is not None and
+                    key[0] <= serialize_timestamp(timestamp)):
+                return False
+            self.set(timestamp, task_id, args, kw)
+            return True
+
+    def _stored(self, timestamp):
+        if self.earliest_stored is None or timestamp < self.earliest_stored:
+            self.earliest_stored = timestamp
+        self.stored.notify_all()
+
+    def _index(self, timestamp, task_id):
+        key = (timestamp, next(self.sequence), task_id)
+        self.by_time.add(key)
+        self.index_keys[task_id] = key
+
+    def _unindex(self, task_id):
+        """Removes ``task_id`` from the schedule, the claimed entries or the
+        quarantine, and forgets its failures.
+
+        :returns: True if it was found
+        """
+        self.failures.pop(task_id, None)
+        for label in self.labels.pop(task_id, ()):
+            ids = self.by_label[label]
+            ids.discard(task_id)
+            if not ids:
+                del self.by_label[label]
+        key = self.index_keys.pop(task_id, None)
+        if key is not None:
+            self.by_time.remove(key)
+            return True
+        return (self.in_flight.pop(task_id, None) is not None or
+                self.quarantine.pop(task_id, None) is not None)
+
+    def set_many(self, entries):
+        for timestamp, task_id, args, kw in entries:
+            self.set(timestamp, task_id, args, kw)
+
+    def reschedule(self, task_id, timestamp):
+        return bool(self.reschedule_many([(task_id, timestamp)]))
+
+    def reschedule_many(self, entries):
+        rescheduled = 0
+        for task_id, timestamp in entries:
+            if timestamp.tzinfo is None:
+                raise ValueError('Timezone required, got %s', timestamp)
+            timestamp = serialize_timestamp(timestamp)
+            with self.lock:
+                key = self.index_keys.pop(task_id, None)
+                if key is None:
+                    continue
+                self.by_time.remove(key)
+                self._index(timestamp, task_id)
+                self._stored(timestamp)
+            rescheduled += 1
+        return rescheduled
 
     def get(self, task_id):
-        args, kw = deserialize(self.by_id[task_id])
+        with self.lock:
+            task = self.by_id[task_id]
+        return self._load(task)
+
+    def _load(self, task):
+        args, kw = self.codec.loads(task)
         if isinstance(kw.get('args'), list):
             kw['args'] = tuple(kw['args'])
         return (tuple(args), kw)
 
     def delete(self, task_id):
-        del self.by_id[task_id]
-        for ts, id in self.by_time.items():
-            if id == task_id:
-                break
-        bucket = self.by_time[ts]
-        bucket.remove(task_id)
-        if not bucket:
-            del self.by_time[ts]
+        with self.lock:
+            del self.by_id[task_id]
+            self._unindex(task_id)
+
+    def delete_many(self, task_ids):
+        removed = 0
+        with self.lock:
+            for task_id in task_ids:
+                if self.by_id.pop(task_id, None) is not None:
+                    self._unindex(task_id)
+                    removed += 1
+        return removed
+
+    def delete_by_tag(self, tag):
+        return self._delete_by_label('tag:' + tag)
+
+    def delete_by_name(self, name):
+        return self._delete_by_label('name:' + name)
+
+    def _delete_by_label(self, label):
+        with self.lock:
+            return self.delete_many(list(self.by_label.get(label, ())))
 
     def get_older_than(self, timestamp):
-        timestamp = serialize_timestamp(timestamp)
-        for ts in sorted(self.by_time.keys()):
-            if ts > timestamp:
+        maximum = (serialize_timestamp(timestamp), math.inf)
+        after = None
+        while True:
+            # We only hold the lock per batch, and continue after the last
+            # key we returned, so callers can modify entries while iterating.
+            with self.lock:
+                keys = list(itertools.islice(self.by_time.irange(
+                    after, maximum, inclusive=(False, True)),
+                    self.batch_size))
+                tasks = [self.by_id[id] for _, _, id in keys]
+            if not keys:
                 break
-            for id in self.by_time[ts]:
-                yield (id, self.get(id))
+            for (_, _, id), task in zip(keys, tasks):
+                yield (id, self._load(task))
+            after = keys[-1]
+
+    def claim(self, timestamp, limit, lease):
+        maximum = (serialize_timestamp(timestamp), math.inf)
+        deadline = int(time.time()) + lease
+        with self.lock:
+            count = min(self.by_time.bisect_right(maximum), limit)
+            keys = self.by_time[:count]
+            del self.by_time[:count]
+            tasks = []
+            for _, _, id in keys:
+                del self.index_keys[id]
+                self.in_flight[id] = deadline
+                tasks.append(self.by_id[id])
+        return [(id, load_claimed(self._load, task),
+                 deserialize_timestamp(timestamp))
+                for (timestamp, _, id), task in zip(keys, tasks)]
+
+    def ack(self, entries):
+        removed = 0
+        with self.lock:
+            for task_id, _, _ in entries:
+                if task_id in self.in_flight:
+                    del self.by_id[task_id]
+                    self._unindex(task_id)
+                    removed += 1
+        return removed
+
+    def release(self, entries):
+        released = 0
+        with self.lock:
+            for task_id, _, timestamp in entries:
+                if self.in_flight.pop(task_id, None) is not None:
+                    self._index(serialize_timestamp(timestamp), task_id)
+                    released += 1
+        return released
+
+    def fail(self, entries, timestamp, backoff, max_retries):
+        now = serialize_timestamp(timestamp)
+        result = []
+        with self.lock:
+            for task_id, error in entries:
+                if self.in_flight.pop(task_id, None) is None:
+                    continue
+                failures = self.failures.get(task_id, (0,))[0] + 1
+                self.failures[task_id] = (failures, error)
+                if failures > max_retries:
+                    self.quarantine[task_id] = now
+                    result.append((task_id, failures, None))
+                    continue
+                due = now + int(backoff * 1000 * 2 ** (failures - 1))
+                self._index(due, task_id)
+                result.append(
+                    (task_id, failures, deserialize_timestamp(due)))
+        return result
+
+    def quarantined(self):
+        with self.lock:
+            entries = [(id, self.failures[id][1], timestamp)
+                       for id, timestamp in self.quarantine.items()]
+        for id, error, timestamp in entries:
+            yield (id, error, deserialize_timestamp(timestamp))
+
+    def replay(self, task_ids, timestamp):
+        if timestamp.tzinfo is None:
+            raise ValueError('Timezone required, got %s', timestamp)
+        timestamp = serialize_timestamp(timestamp)
+        replayed = 0
+        with self.lock:
+            if task_ids is None:
+                task_ids = list(self.quarantine)
+            for task_id in task_ids:
+                if self.quarantine.pop(task_id, None) is None:
+                    continue
+                self.failures.pop(task_id, None)
+                self._index(timestamp, task_id)
+                replayed += 1
+            if replayed:
+                self._stored(timestamp)
+        return replayed
+
+    def requeue_expired(self):
+        now = int(time.time())
+        with self.lock:
+            expired = [id for id, deadline in self.in_flight.items()
+                       if deadline <= now]
+            for id in expired:
+                self._index(self.in_flight.pop(id) * 1000, id)
+        return len(expired)
+
+    def count(self, start=None, end=None):
+        minimum, maximum = self._range(start, end)
+        with self.lock:
+            if minimum is None and maximum is None:
+                return len(self.by_time)
+            return self.by_time.bisect_right(maximum or (math.inf,)) - \
+                self.by_time.bisect_left(minimum or (-math.inf,))
+
+    def _range(self, start, end):
+        """Returns the keys bounding the entries due between ``start`` and
+        ``end`` in ``by_time``, None for no bound."""
+        return (
+            None if start is None else (serialize_timestamp(start),),
+            None if end is None else (serialize_timestamp(end), math.inf))
+
+    def list(self, start=None, end=None, limit=100, cursor=None,
+             payloads=False):
+        minimum, maximum = self._range(start, end)
+        if cursor is not None:
+            timestamp, sequence = cursor.split(':')
+            # Sequence numbers are unique, so this starts after the cursor.
+            minimum = (int(timestamp), int(sequence) + 1)
+        with self.lock:
+            keys = list(itertools.islice(
+                self.by_time.irange(minimum, maximum), limit))
+            tasks = [self.by_id[id] if payloads else None
+                     for _, _, id in keys]
+        entries = [
+            (id, task and self._load(task), deserialize_timestamp(timestamp))
+            for (timestamp, _, id), task in zip(keys, tasks)]
+        if len(keys) < limit:
+            return (entries, None)
+        return (entries, '%s:%s' % keys[-1][:2])
+
+    def next_due(self):
+        with self.lock:
+            if not self.by_time:
+                return None
+            return deserialize_timestamp(self.by_time[0][0])
+
+    def wait(self, before, timeout):
+        if before is not None:
+            before = serialize_timestamp(before)
+
+        def woken():
+            return self.earliest_stored is not None and (
+                before is None or self.earliest_stored < before)
 
+        with self.stored:
+            result = self.stored.wait_for(woken, timeout)
+            self.earliest_stored = None
+            return result
 
-class RedisBackend(AbstractBackend):
-    """Default backend implementation: redis"""
+    def cleanup(self, force=False):
+        # We cannot get inconsistent in the first place.
+        return (0, 0)
 
-    redis = redis
+    def migrate(self):
+        # There is only one layout.
+        return 0
+
+
+class RedisSchema:
+    """Key schema, scripts and configuration of the redis storage.
+
+    This is shared by ``RedisBackend`` and the asyncio variant
+    ``celery_longterm_scheduler.aio.AsyncRedisBackend``, so both can operate
+    on the same database at the same time. Subclasses create the client.
+
+    By default, all entries are indexed in the single sorted set
+    ``BY_TIME_KEY`` and the payloads are stored under the task id. With the
+    setting ``longterm_scheduler_shards`` set to more than 1, the entries are
+    instead spread over that many shards, by a hash of the task id. Each
+    shard has its own sorted sets, and all keys of a shard share a redis
+    cluster hash tag, so they are stored in the same hash slot.
+
+    With the setting ``longterm_scheduler_payload_buckets`` set to N > 0,
+    the payloads of each shard are instead packed into N hashes, by a hash
+    of the task id, which saves the per-key overhead of redis. All keys are
+    prefixed with the setting ``longterm_scheduler_key_prefix``, so several
+    applications can share a redis database.
+
+    With the setting ``longterm_scheduler_hot_window`` set to W seconds, the
+    index of each shard is split in two tiers: entries due before the
+    "horizon" are in ``BY_TIME_KEY`` (the hot tier), later ones in
+    ``COLD_KEY``. ``claim()`` first promotes the entries of the cold tier
+    that come within the window into the hot tier, and moves the horizon
+    ahead in steps of W, so the hot tier only holds entries due within the
+    next one to two windows. Claiming, which scans the hot tier, then stays
+    cheap however many entries are scheduled far ahead.
+
+    Entries with labels (see ``labels()``) are added to one set per label,
+    ``LABEL_KEY:<label>``, and their labels are kept in the hash
+    ``LABELS_KEY``, so deleting an entry can remove it from those sets.
+
+    The score of an entry is its due time in milliseconds times
+    ``SCORE_FACTOR`` plus a sequence number that redis assigns on insert,
+    one more than the highest of the entries due in the same millisecond, so
+    they keep their insertion order (up to ``SCORE_FACTOR`` entries, further
+    ones share the last score and are ordered by id). Versions 1.3 and
+    earlier indexed entries by seconds in ``LEGACY_BY_TIME_KEY``,
+    ``migrate()`` moves them over.
+    """
+
+    # The redis client module, imported on first use if not overridden.
+    redis = None
     # This is persisted in redis, only change when also having a migration plan
-    BY_TIME_KEY = 'scheduled_task_id_by_time'
+    BY_TIME_KEY = 'scheduled_task_id_by_time_v2'
+    LEGACY_BY_TIME_KEY = 'scheduled_task_id_by_time'
+    IN_FLIGHT_KEY = 'scheduled_task_id_in_flight'
+    COLD_KEY = 'scheduled_task_id_by_time_cold'
+    HORIZON_KEY = 'scheduled_task_hot_until'
+    QUARANTINE_KEY = 'scheduled_task_quarantine'
+    FAILURES_KEY = 'scheduled_task_failures'
+    LABEL_KEY = 'scheduled_task_label'
+    LABELS_KEY = 'scheduled_task_labels'
+    PAYLOAD_KEY = 'scheduled_task'
+    BUCKET_KEY = 'scheduled_task_bucket'
+    SHARD_KEY = '%s:{%s}'
+    SHARD_PAYLOAD_KEY = re.compile(
+        r'^%s:\{(\d+)\}:' % PAYLOAD_KEY, re.DOTALL)
+    # set() publishes the due time of each new entry here, see wait().
+    STORED_CHANNEL = 'scheduled_task_stored'
+    SCORE_FACTOR = 1000
+
+    LEGACY_WARNING = (
+        'Moved %s entries that were indexed by seconds (by version 1.3 or'
+        ' earlier), run celery longterm_scheduler migrate after upgrading')
+
+    # The scripts get the location of the payloads of the shard, since the
+    # task ids are read from the index, so we cannot pass in their keys.
+    # This means they only declare the index KEYS, which is fine with redis
+    # cluster since all keys of a shard share the same hash slot.
+
+    # Scores exceed the precision of the default number formatting of Lua,
+    # so we use string.format() when passing them to redis.
+
+    # Prepended to the scripts that access payloads, the first three ARGV are
+    # the payload location of the shard, see _payload_location(). With
+    # buckets, payloads that were not migrated yet are still found under
+    # their own key.
+    PAYLOADS = """
+    local payload_prefix, bucket_prefix = ARGV[1], ARGV[2]
+    local buckets = tonumber(ARGV[3])
+    local function bucket_key(id)
+        return bucket_prefix .. string.format('%d', tonumber(
+            string.sub(redis.sha1hex(id), 1, 8), 16) % buckets)
+    end
+    local function get_payload(id)
+        if buckets > 0 then
+            local task = redis.call('HGET', bucket_key(id), id)
+            if task then
+                return task
+            end
+        end
+        return redis.call('GET', payload_prefix .. id)
+    end
+    local function has_payload(id)
+        return redis.call('EXISTS', payload_prefix .. id) == 1 or (
+            buckets > 0 and redis.call('HEXISTS', bucket_key(id), id) == 1)
+    end
+    local function set_payload(id, task)
+        if buckets > 0 then
+            redis.call('HSET', bucket_key(id), id, task)
+            redis.call('DEL', payload_prefix .. id)
+        else
+            redis.call('SET', payload_prefix .. id, task)
+        end
+    end
+    local function delete_payload(id)
+        local deleted = redis.call('DEL', payload_prefix .. id)
+        if buckets > 0 then
+            deleted = deleted + redis.call('HDEL', bucket_key(id), id)
+        end
+        return deleted
+    end
+    """
+
+    # Prepended to the scripts that add entries to the index, with the KEYS
+    # by_time, cold, horizon. Without a horizon, everything goes into the hot
+    # tier. The sequence number of an entry is one more than the highest in
+    # its millisecond, in either tier (the horizon may have moved since).
+    TIERS = """
+    local horizon = redis.call('GET', KEYS[3])
+    horizon = horizon and tonumber(horizon) * 1000
+    local function last_sequence(key, start)
+        local last = redis.call(
+            'ZREVRANGEBYSCORE', key, string.format('%.0f', start + 999),
+            string.format('%.0f', start), 'WITHSCORES', 'LIMIT', 0, 1)
+        if last[2] then
+            return tonumber(last[2]) - start
+        end
+        return -1
+    end
+    local function index(id, due)
+        local start = tonumber(due) * 1000
+        redis.call('ZREM', KEYS[1], id)
+        redis.call('ZREM', KEYS[2], id)
+        local score = start + math.min(999, 1 + math.max(
+            last_sequence(KEYS[1], start), last_sequence(KEYS[2], start)))
+        local key = KEYS[1]
+        if horizon and score >= horizon then
+            key = KEYS[2]
+        end
+        redis.call('ZADD', key, string.format('%.0f', score), id)
+    end
+    """
+
+    # Prepended to the scripts that maintain the label sets, with the labels
+    # hash and the prefix of the label sets of the shard. The labels of an
+    # entry are joined by NUL, which tags cannot contain.
+    LABELS = """
+    local function unlabel(labels_key, label_prefix, id)
+        local labels = redis.call('HGET', labels_key, id)
+        if labels then
+            for label in string.gmatch(labels, '[^%z]+') do
+                redis.call('SREM', label_prefix .. label, id)
+            end
+            redis.call('HDEL', labels_key, id)
+        end
+    end
+    local function label(labels_key, label_prefix, id, labels)
+        unlabel(labels_key, label_prefix, id)
+        if labels ~= '' then
+            for label in string.gmatch(labels, '[^%z]+') do
+                redis.call('SADD', label_prefix .. label, id)
+            end
+            redis.call('HSET', labels_key, id, labels)
+        end
+    end
+    """
+
+    # KEYS: by_time, cold, horizon, labels, in_flight, quarantine, failures;
+    # ARGV: location, label prefix, keep earliest (0 or 1),
+    # (id, due ms, payload, labels)...
+    # Stored entries replace claimed and quarantined ones and start without
+    # failures. With keep earliest, entries that are scheduled at or before
+    # the new due time or are claimed are kept instead. Returns the number of
+    # stored entries.
+    SET_MANY = PAYLOADS + TIERS + LABELS + """
+    local stored = 0
+    for i = 6, #ARGV, 4 do
+        local id = ARGV[i]
+        local keep = false
+        if ARGV[5] == '1' then
+            local score = redis.call('ZSCORE', KEYS[1], id) or
+                redis.call('ZSCORE', KEYS[2], id)
+            keep = redis.call('ZSCORE', KEYS[5], id) or (score and
+                math.floor(tonumber(score) / 1000) <= tonumber(ARGV[i + 1]))
+        end
+        if not keep then
+            set_payload(id, ARGV[i + 2])
+            index(id, ARGV[i + 1])
+            label(KEYS[4], ARGV[4], id, ARGV[i + 3])
+            redis.call('ZREM', KEYS[5], id)
+            redis.call('ZREM', KEYS[6], id)
+            redis.call('HDEL', KEYS[7], id)
+            stored = stored + 1
+        end
+    end
+    return stored
+    """
+
+    # KEYS: by_time, in_flight, cold, quarantine, failures, labels;
+    # ARGV: location, label prefix, ids...
+    DELETE = PAYLOADS + LABELS + """
+    local removed = 0
+    for i = 5, #ARGV do
+        local deleted = delete_payload(ARGV[i])
+        local unindexed = redis.call('ZREM', KEYS[1], ARGV[i]) +
+            redis.call('ZREM', KEYS[2], ARGV[i]) +
+            redis.call('ZREM', KEYS[3], ARGV[i]) +
+            redis.call('ZREM', KEYS[4], ARGV[i])
+        redis.call('HDEL', KEYS[5], ARGV[i])
+        unlabel(KEYS[6], ARGV[4], ARGV[i])
+        if deleted > 0 and unindexed > 0 then
+            removed = removed + 1
+        end
+    end
+    return removed
+    """
+
+    # KEYS: in_flight, failures, labels; ARGV: location, label prefix, ids...
+    # Like DELETE, but only for the ids that are still claimed.
+    ACK = PAYLOADS + LABELS + """
+    local removed = 0
+    for i = 5, #ARGV do
+        if redis.call('ZREM', KEYS[1], ARGV[i]) > 0 then
+            delete_payload(ARGV[i])
+            redis.call('HDEL', KEYS[2], ARGV[i])
+            unlabel(KEYS[3], ARGV[4], ARGV[i])
+            removed = removed + 1
+        end
+    end
+    return removed
+    """
+
+    # KEYS: by_time, cold, horizon; ARGV: (id, due ms)...
+    RESCHEDULE = TIERS + """
+    local rescheduled = 0
+    for i = 1, #ARGV, 2 do
+        if redis.call('ZSCORE', KEYS[1], ARGV[i])
+                or redis.call('ZSCORE', KEYS[2], ARGV[i]) then
+            index(ARGV[i], ARGV[i + 1])
+            rescheduled = rescheduled + 1
+        end
+    end
+    return rescheduled
+    """
+
+    # KEYS: by_time, cold; ARGV: min score, max score, limit
+    # Returns up to limit entries more per tier, if they have exactly the min
+    # score, so the caller can skip those it already returned on the
+    # previous page.
+    LIST = """
+    local result = {}
+    for _, key in ipairs(KEYS) do
+        local same = redis.call('ZCOUNT', key, ARGV[1], ARGV[1])
+        local entries = redis.call(
+            'ZRANGEBYSCORE', key, ARGV[1], ARGV[2], 'WITHSCORES',
+            'LIMIT', 0, tonumber(ARGV[3]) + same)
+        for _, x in ipairs(entries) do
+            table.insert(result, x)
+        end
+    end
+    return result
+    """
+
+    # KEYS: by_time, cold, horizon;
+    # ARGV: claim time ms, window ms (0 to disable), limit
+    # Moves the horizon to the end of the window after the current one and
+    # up to limit entries before it, or due by the claim time if that is
+    # later (the earliest first), into the hot tier. The horizon follows the
+    # server time, so claiming for a time far ahead does not move it there.
+    PROMOTE = """
+    local window = tonumber(ARGV[2])
+    local max_score = '+inf'
+    if window > 0 then
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) * 1000 +
+            math.floor(tonumber(time[2]) / 1000)
+        local horizon = (math.floor(now / window) + 2) * window
+        if tonumber(redis.call('GET', KEYS[3]) or 0) ~= horizon then
+            redis.call('SET', KEYS[3], string.format('%.0f', horizon))
+        end
+        max_score = string.format('(%.0f', math.max(
+            horizon, tonumber(ARGV[1]) + 1) * 1000)
+    elseif redis.call('EXISTS', KEYS[3]) == 1 then
+        redis.call('DEL', KEYS[3])
+    end
+    local entries = redis.call(
+        'ZRANGEBYSCORE', KEYS[2], '-inf', max_score, 'WITHSCORES',
+        'LIMIT', 0, ARGV[3])
+    if #entries == 0 then
+        return 0
+    end
+    for i = 1, #entries, 2 do
+        redis.call('ZADD', KEYS[1], entries[i + 1], entries[i])
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, #entries / 2 - 1)
+    return #entries / 2
+    """
+
+    # KEYS: by_time, cold, horizon; ARGV: limit
+    # Moves up to limit entries after the horizon into the cold tier.
+    DEMOTE = """
+    local horizon = redis.call('GET', KEYS[3])
+    if not horizon then
+        return 0
+    end
+    local entries = redis.call(
+        'ZRANGEBYSCORE', KEYS[1], string.format(
+            '%.0f', tonumber(horizon) * 1000), '+inf', 'WITHSCORES',
+        'LIMIT', 0, ARGV[1])
+    for i = 1, #entries, 2 do
+        redis.call('ZADD', KEYS[2], entries[i + 1], entries[i])
+        redis.call('ZREM', KEYS[1], entries[i])
+    end
+    return #entries / 2
+    """
+
+    # KEYS: by_time, in_flight; ARGV: location, max score, limit, lease
+    # Uses the server time, so the leases of all scheduler hosts agree.
+    CLAIM = PAYLOADS + """
+    local ids = redis.call(
+        'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[4], 'WITHSCORES',
+        'LIMIT', 0, ARGV[5])
+    if #ids == 0 then
+        return {}
+    end
+    -- Since we start at -inf, the due ids are exactly the first ranks.
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #ids / 2 - 1)
+    local deadline = tonumber(redis.call('TIME')[1]) + tonumber(ARGV[6])
+    local result = {}
+    for i = 1, #ids, 2 do
+        local task = get_payload(ids[i])
+        -- Entries without payload are orphans, we simply drop them.
+        if task then
+            redis.call('ZADD', KEYS[2], deadline, ids[i])
+            table.insert(result, ids[i])
+            table.insert(result, ids[i + 1])
+            table.insert(result, task)
+        end
+    end
+    return result
+    """
+
+    # KEYS: by_time, in_flight; ARGV: (id, score)...
+    RELEASE = """
+    local released = 0
+    for i = 1, #ARGV, 2 do
+        if redis.call('ZREM', KEYS[2], ARGV[i]) == 1 then
+            redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+            released = released + 1
+        end
+    end
+    return released
+    """
+
+    # KEYS: by_time, cold, horizon, in_flight, quarantine, failures;
+    # ARGV: now ms, backoff ms, max retries, (id, error)...
+    # The failures hash contains "<failures> <last error>" per id. Returns
+    # (id, failures, new due ms or -1 if quarantined) per claimed entry.
+    FAIL = TIERS + """
+    local now, backoff = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local result = {}
+    for i = 4, #ARGV, 2 do
+        local id = ARGV[i]
+        if redis.call('ZREM', KEYS[4], id) > 0 then
+            local failures = tonumber(string.match(
+                redis.call('HGET', KEYS[6], id) or '0', '^%d+')) + 1
+            redis.call('HSET', KEYS[6], id, failures .. ' ' .. ARGV[i + 1])
+            local due = -1
+            if failures > tonumber(ARGV[3]) then
+                redis.call('ZADD', KEYS[5], string.format('%.0f', now), id)
+            else
+                due = now + backoff * 2 ^ (failures - 1)
+                index(id, string.format('%.0f', due))
+            end
+            table.insert(result, id)
+            table.insert(result, failures)
+            table.insert(result, due)
+        end
+    end
+    return result
+    """
+
+    # KEYS: by_time, cold, horizon, quarantine, failures; ARGV: due ms, ids...
+    REPLAY = TIERS + """
+    local replayed = 0
+    for i = 2, #ARGV do
+        if redis.call('ZREM', KEYS[4], ARGV[i]) > 0 then
+            redis.call('HDEL', KEYS[5], ARGV[i])
+            index(ARGV[i], ARGV[1])
+            replayed = replayed + 1
+        end
+    end
+    return replayed
+    """
+
+    # KEYS: by_time, in_flight
+    REQUEUE_EXPIRED = """
+    local time = redis.call('TIME')
+    local score = string.format('%.0f', (tonumber(time[1]) * 1000 +
+        math.floor(tonumber(time[2]) / 1000)) * 1000)
+    local ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', time[1])
+    for _, id in ipairs(ids) do
+        redis.call('ZADD', KEYS[1], score, id)
+        redis.call('ZREM', KEYS[2], id)
+    end
+    return #ids
+    """
+
+    # KEYS: by_time, in_flight, cold, quarantine, [legacy by_time];
+    # ARGV: payload prefix, candidate ids...
+    REMOVE_ORPHANED_PAYLOADS = """
+    local removed = 0
+    for i = 2, #ARGV do
+        local key = ARGV[1] .. ARGV[i]
+        if redis.call('TYPE', key)['ok'] == 'string'
+                and not redis.call('ZSCORE', KEYS[1], ARGV[i])
+                and not redis.call('ZSCORE', KEYS[2], ARGV[i])
+                and not redis.call('ZSCORE', KEYS[3], ARGV[i])
+                and not redis.call('ZSCORE', KEYS[4], ARGV[i])
+                and not (KEYS[5] and
+                         redis.call('ZSCORE', KEYS[5], ARGV[i])) then
+            removed = removed + redis.call('DEL', key)
+        end
+    end
+    return removed
+    """
+
+    # KEYS: by_time, in_flight, cold, quarantine, bucket;
+    # ARGV: candidate ids...
+    REMOVE_ORPHANED_FIELDS = """
+    local removed = 0
+    for _, id in ipairs(ARGV) do
+        if not redis.call('ZSCORE', KEYS[1], id)
+                and not redis.call('ZSCORE', KEYS[2], id)
+                and not redis.call('ZSCORE', KEYS[3], id)
+                and not redis.call('ZSCORE', KEYS[4], id) then
+            removed = removed + redis.call('HDEL', KEYS[5], id)
+        end
+    end
+    return removed
+    """
+
+    # KEYS: by_time, in_flight, cold or quarantine;
+    # ARGV: location, candidate ids...
+    REMOVE_DANGLING_IDS = PAYLOADS + """
+    local removed = 0
+    for i = 4, #ARGV do
+        if not has_payload(ARGV[i]) then
+            removed = removed + redis.call('ZREM', KEYS[1], ARGV[i])
+        end
+    end
+    return removed
+    """
+
+    # KEYS: old index, new index, old labels, new labels, old failures, new
+    # failures, [cold, horizon]; ARGV: location, id, factor to convert the
+    # score, old payload key, old bucket key (or ''), old label prefix, new
+    # label prefix
+    # With cold and horizon, entries after the horizon go into the cold tier
+    # instead of the new index, see TIERS.
+    MIGRATE = PAYLOADS + LABELS + """
+    local id = ARGV[4]
+    local score = redis.call('ZSCORE', KEYS[1], id)
+    if not score then
+        return 0
+    end
+    redis.call('ZREM', KEYS[1], id)
+    local labels = redis.call('HGET', KEYS[3], id)
+    unlabel(KEYS[3], ARGV[8], id)
+    local failures = redis.call('HGET', KEYS[5], id)
+    redis.call('HDEL', KEYS[5], id)
+    local task = redis.call('GET', ARGV[6])
+    if task then
+        redis.call('DEL', ARGV[6])
+    elseif ARGV[7] ~= '' then
+        task = redis.call('HGET', ARGV[7], id)
+        redis.call('HDEL', ARGV[7], id)
+    end
+    if not task then
+        return 0
+    end
+    set_payload(id, task)
+    if labels then
+        label(KEYS[4], ARGV[9], id, labels)
+    end
+    if failures then
+        redis.call('HSET', KEYS[6], id, failures)
+    end
+    score = tonumber(score) * tonumber(ARGV[5])
+    local key = KEYS[2]
+    local horizon = KEYS[8] and redis.call('GET', KEYS[8])
+    if horizon and score >= tonumber(horizon) * 1000 then
+        key = KEYS[7]
+    end
+    redis.call('ZADD', key, string.format('%.0f', score), id)
+    return 1
+    """
+
+    # KEYS: by_time (for routing only); ARGV: location, ids...
+    MOVE_INTO_BUCKETS = PAYLOADS + """
+    local moved = 0
+    for i = 4, #ARGV do
+        local task = redis.call('GET', payload_prefix .. ARGV[i])
+        if task then
+            set_payload(ARGV[i], task)
+            moved = moved + 1
+        end
+    end
+    return moved
+    """
 
     def __init__(self, url, app):
+        import celery.backends.redis
+        if self.redis is None:
+            import redis
+            self.redis = redis
         self.url = url
         self.app = app
+        self.codec = Codec.from_conf(app.conf)
+        self.batch_size = int(
+            app.conf.get('longterm_scheduler_batch_size') or
+            DEFAULT_BATCH_SIZE)
+        self.shards = int(app.conf.get('longterm_scheduler_shards') or 1)
+        self.buckets = int(
+            app.conf.get('longterm_scheduler_payload_buckets') or 0)
+        self.key_prefix = app.conf.get('longterm_scheduler_key_prefix') or ''
+        self.hot_window = int(
+            app.conf.get('longterm_scheduler_hot_window') or 0)
+        self.index_task_names = bool(
+            app.conf.get('longterm_scheduler_index_task_names'))
         # Taken from celery.backends.redis.RedisBackend.__init__()
         max_connections = app.conf.get('redis_max_connections')
         socket_timeout = app.conf.get('redis_socket_timeout')
@@ -122,48 +1185,1275 @@ class RedisBackend(AbstractBackend):
         self._params_from_url = celery.backends.redis.RedisBackend.\
             _params_from_url.__get__(self)
         self.connparams = self._params_from_url(url, self.connparams)
+        self.client = self._create_client()
+        # sha: source of the scripts, see _pipe_script()
+        self._scripts = {}
+        self._set_many = self._register(self.SET_MANY)
+        self._delete = self._register(self.DELETE)
+        self._ack = self._register(self.ACK)
+        self._reschedule = self._register(self.RESCHEDULE)
+        self._list = self._register(self.LIST)
+        self._promote = self._register(self.PROMOTE)
+        self._demote = self._register(self.DEMOTE)
+        self._claim = self._register(self.CLAIM)
+        self._release = self._register(self.RELEASE)
+        self._fail = self._register(self.FAIL)
+        self._replay = self._register(self.REPLAY)
+        self._requeue_expired = self._register(
+            self.REQUEUE_EXPIRED)
+        self._remove_orphaned_payloads = self._register(
+            self.REMOVE_ORPHANED_PAYLOADS)
+        self._remove_orphaned_fields = self._register(
+            self.REMOVE_ORPHANED_FIELDS)
+        self._remove_dangling_ids = self._register(
+            self.REMOVE_DANGLING_IDS)
+        self._migrate = self._register(self.MIGRATE)
+        self._move_into_buckets = self._register(
+            self.MOVE_INTO_BUCKETS)
+
+    def _create_client(self):
+        raise NotImplementedError()
+
+    def _register(self, source):
+        script = self.client.register_script(source)
+        self._scripts[script.sha] = source
+        return script
+
+    def _shard(self, task_id):
+        if self.shards == 1:
+            return 0
+        return zlib.crc32(task_id.encode('utf-8')) % self.shards
+
+    def _key(self, name, shard=0):
+        """Returns the key ``name`` of ``shard``, with the key prefix."""
+        if self.shards == 1:
+            return self.key_prefix + name
+        return self.key_prefix + self.SHARD_KEY % (name, shard)
+
+    def _index_keys(self, shard):
+        """Returns the keys (by_time, in_flight) of ``shard``."""
+        return [self._key(self.BY_TIME_KEY, shard),
+                self._key(self.IN_FLIGHT_KEY, shard)]
+
+    def _tier_keys(self, shard):
+        """Returns the keys (cold, horizon) of ``shard``."""
+        return [self._key(self.COLD_KEY, shard),
+                self._key(self.HORIZON_KEY, shard)]
+
+    def _failure_keys(self, shard):
+        """Returns the keys (quarantine, failures) of ``shard``."""
+        return [self._key(self.QUARANTINE_KEY, shard),
+                self._key(self.FAILURES_KEY, shard)]
+
+    def _entry_keys(self, shard):
+        """Returns the keys of all sorted sets of ``shard`` that an entry
+        can be in."""
+        return (self._index_keys(shard) + self._tier_keys(shard)[:1] +
+                self._failure_keys(shard)[:1])
+
+    def _insert_keys(self, shard):
+        """Returns the KEYS of the scripts that use ``TIERS``."""
+        return self._index_keys(shard)[:1] + self._tier_keys(shard)
+
+    def _label_keys(self, shard):
+        """Returns the labels hash and the prefix of the label sets of
+        ``shard``."""
+        return [self._key(self.LABELS_KEY, shard),
+                self._key(self.LABEL_KEY, shard) + ':']
+
+    @property
+    def stored_channel(self):
+        return self.key_prefix + self.STORED_CHANNEL
+
+    def _max_score(self, timestamp):
+        """Returns the highest score of entries due at ``timestamp`` (ms)."""
+        return timestamp * self.SCORE_FACTOR + self.SCORE_FACTOR - 1
+
+    def _timestamp(self, score):
+        return deserialize_timestamp(int(float(score)) // self.SCORE_FACTOR)
+
+    def _payload_prefix(self, shard):
+        """Returns the prefix of the payload keys (without buckets)."""
+        if self.shards == 1:
+            return self.key_prefix
+        return self._key(self.PAYLOAD_KEY, shard) + ':'
+
+    def _payload_key(self, task_id):
+        return self._payload_prefix(self._shard(task_id)) + task_id
+
+    def _bucket_prefix(self, shard):
+        return self._key(self.BUCKET_KEY, shard) + ':'
+
+    def _bucket_key(self, task_id):
+        """Returns the key of the hash that stores the payload of
+        ``task_id``, the same as computed by the scripts."""
+        bucket = int(hashlib.sha1(
+            task_id.encode('utf-8')).hexdigest()[:8], 16) % self.buckets
+        return self._bucket_prefix(self._shard(task_id)) + str(bucket)
+
+    def _payload_location(self, shard):
+        """Returns the first ARGV of the scripts that access payloads."""
+        return [self._payload_prefix(shard), self._bucket_prefix(shard),
+                self.buckets]
+
+    def _by_shard(self, items, task_id=lambda x: x):
+        """Groups ``items`` into a dict shard: list of items."""
+        result = collections.defaultdict(list)
+        for item in items:
+            result[self._shard(task_id(item))].append(item)
+        return result
+
+    def _dump(self, timestamp, task_id, args, kw):
+        """Returns (task_id, due ms, payload, labels) of an entry."""
+        if timestamp.tzinfo is None:
+            raise ValueError('Timezone required, got %s', timestamp)
+        return (task_id, serialize_timestamp(timestamp),
+                self.codec.dumps([args, kw]),
+                '\0'.join(labels(args, kw, self.index_task_names)))
+
+    def _load(self, task):
+        args, kw = self.codec.loads(task)
+        if isinstance(kw.get('args'), list):
+            kw['args'] = tuple(kw['args'])
+        return (tuple(args), kw)
+
+    # The following methods queue commands on a pipeline, so the sync and
+    # asyncio backends only differ in how they execute it.
+
+    def _pipe_script(self, pipe, script, keys, args=()):
+        # Queued as a plain EVALSHA: given the Script, redis-py would first
+        # check whether it exists with a separate round trip. If it doesn't,
+        # _execute() loads it and sends the command again.
+        pipe.evalsha(script.sha, len(keys), *keys, *args)
+
+    def _unknown_scripts(self, results):
+        """Returns the indexes of the pipeline ``results`` that failed
+        because redis does not know the script (e.g. after a restart)."""
+        return [i for i, result in enumerate(results)
+                if isinstance(result, self.redis.exceptions.NoScriptError)]
+
+    def _pipe_retry(self, pipe, commands, retry):
+        """Queues loading the scripts of the ``retry`` indexes of
+        ``commands`` and sending those again."""
+        for sha in {commands[i][0][1] for i in retry}:
+            pipe.script_load(self._scripts[sha])
+        for i in retry:
+            args, options = commands[i]
+            pipe.execute_command(*args, **options)
+
+    @staticmethod
+    def _checked(results):
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def _pipe_set_many(self, pipe, tasks, keep_earliest=False):
+        """Queues storing the ``_dump()`` ed tasks, one result per shard is
+        the number of stored entries."""
+        for shard, items in self._by_shard(tasks, lambda x: x[0]).items():
+            labels_key, label_prefix = self._label_keys(shard)
+            self._pipe_script(
+                pipe, self._set_many,
+                keys=self._insert_keys(shard) + [labels_key] +
+                self._index_keys(shard)[1:] + self._failure_keys(shard),
+                args=self._payload_location(shard) +
+                [label_prefix, int(keep_earliest)] +
+                [x for item in items for x in item])
+        pipe.publish(self.stored_channel, min(x[1] for x in tasks))
+
+    def _pipe_reschedule_many(self, pipe, entries):
+        """Queues the rescheduling of (task_id, timestamp) entries, one
+        result per shard is the number of rescheduled entries."""
+        for _, timestamp in entries:
+            if timestamp.tzinfo is None:
+                raise ValueError('Timezone required, got %s', timestamp)
+        entries = [(task_id, serialize_timestamp(timestamp))
+                   for task_id, timestamp in entries]
+        for shard, items in self._by_shard(
+                entries, lambda x: x[0]).items():
+            self._pipe_script(
+                pipe, self._reschedule, keys=self._insert_keys(shard),
+                args=[x for item in items for x in item])
+        pipe.publish(self.stored_channel, min(x[1] for x in entries))
+
+    def _pipe_delete_many(self, pipe, task_ids):
+        for shard, ids in self._by_shard(task_ids).items():
+            labels_key, label_prefix = self._label_keys(shard)
+            self._pipe_script(
+                pipe, self._delete,
+                keys=self._entry_keys(shard) + self._failure_keys(shard)[1:] +
+                [labels_key],
+                args=self._payload_location(shard) + [label_prefix] + ids)
+
+    def _pipe_ack(self, pipe, entries):
+        for shard, items in self._by_shard(
+                entries, lambda x: x[0]).items():
+            labels_key, label_prefix = self._label_keys(shard)
+            self._pipe_script(
+                pipe, self._ack,
+                keys=self._index_keys(shard)[1:] +
+                self._failure_keys(shard)[1:] + [labels_key],
+                args=self._payload_location(shard) + [label_prefix] +
+                [task_id for task_id, _, _ in items])
+
+    def _pipe_promote(self, pipe, now):
+        for shard in range(self.shards):
+            self._pipe_script(
+                pipe, self._promote,
+                keys=self._index_keys(shard)[:1] + self._tier_keys(shard),
+                args=[now, self.hot_window * 1000, self.batch_size])
+
+    def _pipe_peek(self, pipe, max_score, limit):
+        for shard in range(self.shards):
+            pipe.zrangebyscore(
+                self._index_keys(shard)[0], '-inf', max_score,
+                start=0, num=limit, withscores=True)
+
+    def _claim_limits(self, peeked, limit):
+        """Returns a dict shard: how many entries to claim from it, so we
+        claim the oldest entries overall, given the result of _pipe_peek()."""
+        oldest = heapq.nsmallest(limit, (
+            (score, shard)
+            for shard, result in enumerate(peeked)
+            for _, score in result))
+        return collections.Counter(shard for _, shard in oldest)
+
+    def _pipe_claim(self, pipe, max_score, limits, lease):
+        for shard, shard_limit in limits.items():
+            self._pipe_script(
+                pipe, self._claim, keys=self._index_keys(shard),
+                args=self._payload_location(shard) +
+                [max_score, shard_limit, lease])
+
+    def _claimed(self, results):
+        entries = heapq.merge(*[
+            zip(map(float, result[1::3]), result[::3], result[2::3])
+            for result in results])
+        return [(id.decode('utf-8'), load_claimed(self._load, task),
+                 self._timestamp(score))
+                for score, id, task in entries]
+
+    def _pipe_release(self, pipe, entries):
+        for shard, items in self._by_shard(
+                entries, lambda x: x[0]).items():
+            self._pipe_script(
+                pipe, self._release, keys=self._index_keys(shard),
+                args=[x for task_id, _, timestamp in items
+                      for x in (task_id, serialize_timestamp(timestamp) *
+                                self.SCORE_FACTOR)])
+
+    def _pipe_fail(self, pipe, entries, timestamp, backoff, max_retries):
+        """Queues recording the failures of (task_id, error) entries, see
+        ``_failed()``."""
+        for shard, items in self._by_shard(
+                entries, lambda x: x[0]).items():
+            self._pipe_script(
+                pipe, self._fail, keys=self._insert_keys(shard) +
+                self._index_keys(shard)[1:] + self._failure_keys(shard),
+                args=[serialize_timestamp(timestamp), int(backoff * 1000),
+                      max_retries] + [x for item in items for x in item])
+
+    def _failed(self, results):
+        return [(id.decode('utf-8'), failures,
+                 deserialize_timestamp(due) if due >= 0 else None)
+                for result in results
+                for id, failures, due in zip(
+                    result[::3], result[1::3], result[2::3])]
+
+    def _pipe_replay(self, pipe, task_ids, timestamp):
+        if timestamp.tzinfo is None:
+            raise ValueError('Timezone required, got %s', timestamp)
+        due = serialize_timestamp(timestamp)
+        for shard, ids in self._by_shard(task_ids).items():
+            self._pipe_script(
+                pipe, self._replay, keys=self._insert_keys(shard) +
+                self._failure_keys(shard), args=[due] + ids)
+        pipe.publish(self.stored_channel, due)
+
+    def _quarantined(self, entries, errors):
+        """Returns (task_id, error, timestamp) of (id, score) entries of the
+        quarantine, given their values in the failures hash."""
+        return [(id.decode('utf-8'),
+                 error.decode('utf-8').split(' ', 1)[1] if error else None,
+                 deserialize_timestamp(score))
+                for (id, score), error in zip(entries, errors)]
+
+    def _legacy_key(self):
+        """Returns the index of version 1.3 and earlier."""
+        return self.key_prefix + self.LEGACY_BY_TIME_KEY
+
+    def _pipe_migrate(self, pipe, key, ids, name, factor):
+        """Queues moving ``ids`` from the unsharded sorted set ``key`` into
+        the sorted set ``name`` of their shard, multiplying their scores by
+        ``factor``. Their payloads, labels and failures are moved along, and
+        entries for ``BY_TIME_KEY`` go into the tier they belong to."""
+        old_labels = [self.key_prefix + self.LABELS_KEY,
+                      self.key_prefix + self.LABEL_KEY + ':']
+        old_failures = self.key_prefix + self.FAILURES_KEY
+        for id in ids:
+            task_id = id.decode('utf-8')
+            shard = self._shard(task_id)
+            labels = self._label_keys(shard)
+            self._pipe_script(
+                pipe, self._migrate,
+                keys=[key, self._key(name, shard), old_labels[0], labels[0],
+                      old_failures, self._failure_keys(shard)[1]] +
+                (self._tier_keys(shard) if name == self.BY_TIME_KEY else []),
+                args=self._payload_location(shard) + [
+                    task_id, factor, self.key_prefix + task_id,
+                    self._unsharded_bucket_key(task_id),
+                    old_labels[1], labels[1]])
+
+    def _unsharded_bucket_key(self, task_id):
+        if not self.buckets or self.shards == 1:
+            return ''
+        bucket = int(self._bucket_key(task_id).rsplit(':', 1)[1])
+        return '%s%s:%s' % (self.key_prefix, self.BUCKET_KEY, bucket)
+
+    def _pipe_requeue_expired(self, pipe):
+        for shard in range(self.shards):
+            self._pipe_script(
+                pipe, self._requeue_expired, keys=self._index_keys(shard))
+
+    def _score_range(self, start, end):
+        return (
+            '-inf' if start is None else
+            serialize_timestamp(start) * self.SCORE_FACTOR,
+            '+inf' if end is None else
+            self._max_score(serialize_timestamp(end)))
+
+    def _pipe_count(self, pipe, start=None, end=None):
+        min_score, max_score = self._score_range(start, end)
+        for shard in range(self.shards):
+            for key in self._scheduled_keys(shard):
+                pipe.zcount(key, min_score, max_score)
+
+    def _scheduled_keys(self, shard):
+        """Returns the keys of both tiers of ``shard``."""
+        return self._index_keys(shard)[:1] + self._tier_keys(shard)[:1]
+
+    def _pipe_list(self, pipe, start, end, limit, cursor):
+        """Queues reading the index for ``list()``, returns the position
+        after which the page starts, see ``_listed()``."""
+        min_score, max_score = self._score_range(start, end)
+        after = None
+        if cursor is not None:
+            score, id = cursor.split(':', 1)
+            after = (int(score), id.encode('utf-8'))
+            min_score = after[0]
+        for shard in range(self.shards):
+            self._pipe_script(
+                pipe, self._list, keys=self._scheduled_keys(shard),
+                args=[min_score, max_score, limit])
+        return after
+
+    def _listed(self, results, after, limit):
+        """Returns the page of (score, id, shard) for the results of
+        ``_pipe_list()``, in due-time order, and the cursor of the next."""
+        entries = []
+        for shard, result in enumerate(results):
+            for id, score in zip(result[::2], result[1::2]):
+                # Entries with the same score are sorted by id, like here.
+                if after is None or (int(score), id) > after:
+                    entries.append((int(score), id, shard))
+        entries.sort()
+        entries = entries[:limit]
+        if len(entries) < limit:
+            return (entries, None)
+        score, id, _ = entries[-1]
+        return (entries, '%s:%s' % (score, id.decode('utf-8')))
+
+    def _list_entries(self, entries, tasks=None):
+        """Returns the result of ``list()`` for a page of (score, id, shard)
+        and, optionally, their (id, payload) from ``_got_payloads()``."""
+        if tasks is None:
+            return [(id.decode('utf-8'), None, self._timestamp(score))
+                    for score, id, _ in entries]
+        return [(id.decode('utf-8'), self._load(task), self._timestamp(score))
+                for (score, _, _), (id, task) in zip(entries, tasks)
+                # Skip entries deleted after we read the index.
+                if task is not None]
+
+    def _pipe_get(self, pipe, task_id):
+        if self.buckets:
+            pipe.hget(self._bucket_key(task_id), task_id)
+        pipe.get(self._payload_key(task_id))
+
+    def _got(self, results):
+        """Returns the payload for the results of ``_pipe_get()``."""
+        return next((x for x in results if x is not None), None)
+
+    def _pipe_get_payloads(self, pipe, ids):
+        """Queues one MGET per shard (so we stay within one hash slot) and
+        with buckets one HMGET per bucket for a list of (id, shard), returns
+        the ids per command for ``_got_payloads()``."""
+        by_key = collections.defaultdict(list)
+        if self.buckets:
+            for id, _ in ids:
+                by_key[self._bucket_key(id.decode('utf-8'))].append(id)
+            for key, key_ids in by_key.items():
+                pipe.hmget(key, key_ids)
+        # Without buckets, or not migrated into them yet.
+        by_shard = collections.defaultdict(list)
+        for id, shard in ids:
+            by_shard[shard].append(id)
+        for shard, shard_ids in by_shard.items():
+            prefix = self._payload_prefix(shard).encode('utf-8')
+            pipe.mget([prefix + id for id in shard_ids])
+        return list(by_key.values()) + list(by_shard.values())
+
+    def _got_payloads(self, ids, queued, results):
+        """Returns list of (id, payload or None) for a list of (id, shard)."""
+        tasks = {}
+        for queued_ids, result in zip(queued, results):
+            for id, task in zip(queued_ids, result):
+                if task is not None:
+                    tasks[id] = task
+        return [(id, tasks.get(id)) for id, _ in ids]
+
+    def _pipe_next_due(self, pipe):
+        for shard in range(self.shards):
+            for key in self._scheduled_keys(shard):
+                pipe.zrange(key, 0, 0, withscores=True)
+
+    def _next_due(self, results):
+        scores = [result[0][1] for result in results if result]
+        if not scores:
+            return None
+        return self._timestamp(min(scores))
+
+
+class RedisBackend(RedisSchema, AbstractBackend):
+    """Default backend implementation: redis
+
+    See ``RedisSchema`` for how the entries are stored. Use ``migrate()`` to
+    move existing entries into the shards, buckets or tiers after setting
+    ``longterm_scheduler_shards``, ``longterm_scheduler_payload_buckets`` or
+    ``longterm_scheduler_hot_window``.
+    """
+
+    def __init__(self, url, app):
+        super().__init__(url, app)
+        self.pubsub = None
+
+    def _create_client(self):
         # We probably don't need a parameterizeable ConnectionPool, like
         # celery.backends.redis.RedisBackend._create_client() does.
-        self.client = self.redis.StrictRedis(
+        return self.redis.StrictRedis(
             connection_pool=self.redis.ConnectionPool(**self.connparams))
 
+    def _execute(self, pipe):
+        commands = list(pipe.command_stack)
+        results = pipe.execute(raise_on_error=False)
+        retry = self._unknown_scripts(results)
+        if retry:
+            pipe = self.client.pipeline(transaction=False)
+            self._pipe_retry(pipe, commands, retry)
+            retried = pipe.execute(raise_on_error=False)[-len(retry):]
+            for i, result in zip(retry, retried):
+                results[i] = result
+        return self._checked(results)
+
     def set(self, timestamp, task_id, args, kw):
-        if timestamp.tzinfo is None:
-            raise ValueError('Timezone required, got %s', timestamp)
-        timestamp = serialize_timestamp(timestamp)
-        self.client.set(task_id, serialize([args, kw]))
-        self.client.zadd(self.BY_TIME_KEY, mapping={task_id: timestamp})
+        # MULTI, so the notification is sent together with storing.
+        pipe = self.client.pipeline(transaction=True)
+        self._pipe_set_many(pipe, [self._dump(timestamp, task_id, args, kw)])
+        self._execute(pipe)
+
+    def set_earliest(self, timestamp, task_id, args, kw):
+        pipe = self.client.pipeline(transaction=True)
+        self._pipe_set_many(
+            pipe, [self._dump(timestamp, task_id, args, kw)],
+            keep_earliest=True)
+        return bool(self._execute(pipe)[0])
+
+    def set_many(self, entries):
+        for chunk in chunked(entries, self.batch_size):
+            tasks = [self._dump(*entry) for entry in chunk]
+            pipe = self.client.pipeline(transaction=False)
+            self._pipe_set_many(pipe, tasks)
+            self._execute(pipe)
+
+    def reschedule(self, task_id, timestamp):
+        return bool(self.reschedule_many([(task_id, timestamp)]))
+
+    def reschedule_many(self, entries):
+        rescheduled = 0
+        for chunk in chunked(entries, self.batch_size):
+            pipe = self.client.pipeline(transaction=False)
+            self._pipe_reschedule_many(pipe, chunk)
+            # The last result is the number of PUBLISH receivers.
+            rescheduled += sum(self._execute(pipe)[:-1])
+        return rescheduled
 
     def get(self, task_id):
-        task = self.client.get(task_id)
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_get(pipe, task_id)
+        task = self._got(self._execute(pipe))
         if task is None:
             raise KeyError(task_id)
-        args, kw = deserialize(task)
+        return self._load(task)
+
+    def delete(self, task_id):
+        if not self.delete_many([task_id]):
+            raise KeyError(task_id)
+
+    def delete_many(self, task_ids):
+        if not task_ids:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_delete_many(pipe, task_ids)
+        return sum(self._execute(pipe))
+
+    def delete_by_tag(self, tag):
+        return self._delete_by_label('tag:' + tag)
+
+    def delete_by_name(self, name):
+        return self._delete_by_label('name:' + name)
+
+    def _delete_by_label(self, label):
+        # Deleting removes the ids from the set while we scan it, which SSCAN
+        # allows. It may return an id twice, delete_many() only counts it
+        # the first time.
+        removed = 0
+        for shard in range(self.shards):
+            key = self._label_keys(shard)[1] + label
+            for chunk in chunked(self.client.sscan_iter(
+                    key, count=self.batch_size), self.batch_size):
+                removed += self.delete_many(
+                    [id.decode('utf-8') for id in chunk])
+        return removed
+
+    def get_older_than(self, timestamp):
+        max_score = self._max_score(serialize_timestamp(timestamp))
+        # k-way merge of the shards, so we return entries in due-time order.
+        entries = heapq.merge(*[
+            self._iter_shard(shard, max_score)
+            for shard in range(self.shards)])
+        for chunk in chunked(entries, self.batch_size):
+            for id, task in self._get_payloads(
+                    [(id, shard) for _, id, shard in chunk]):
+                if task is None:
+                    # Deleted after we read the index, e.g. by revoke().
+                    continue
+                # Typically celery uses uuid, so ascii would suffice, but who
+                # knows what kind of ids random applications use in the wild.
+                yield (id.decode('utf-8'), self._load(task))
+
+    def _iter_shard(self, shard, max_score):
+        return heapq.merge(*[
+            self._iter_index(key, shard, max_score)
+            for key in self._scheduled_keys(shard)])
+
+    def _iter_index(self, key, shard, max_score):
+        for chunk in self._scan_index(key, max_score):
+            for id, score in chunk:
+                yield (score, id, shard)
+
+    def _get_payloads(self, ids):
+        """Returns list of (id, payload or None) for a list of (id, shard)."""
+        pipe = self.client.pipeline(transaction=False)
+        queued = self._pipe_get_payloads(pipe, ids)
+        return self._got_payloads(ids, queued, self._execute(pipe))
+
+    def claim(self, timestamp, limit, lease):
+        now = serialize_timestamp(timestamp)
+        max_score = self._max_score(now)
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_promote(pipe, now)
+        if self.shards == 1:
+            limits = {0: limit}
+        else:
+            # Look at the oldest entries of each shard first, so we claim
+            # the oldest entries overall.
+            self._pipe_peek(pipe, max_score, limit)
+            limits = self._claim_limits(
+                self._execute(pipe)[self.shards:], limit)
+            pipe = self.client.pipeline(transaction=False)
+        self._pipe_claim(pipe, max_score, limits, lease)
+        results = self._execute(pipe)
+        return self._claimed(results[len(results) - len(limits):])
+
+    def ack(self, entries):
+        if not entries:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_ack(pipe, entries)
+        return sum(self._execute(pipe))
+
+    def release(self, entries):
+        if not entries:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_release(pipe, entries)
+        return sum(self._execute(pipe))
+
+    def requeue_expired(self):
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_requeue_expired(pipe)
+        pipe.zcard(self._legacy_key())
+        *requeued, legacy = self._execute(pipe)
+        if legacy:
+            self._migrate_legacy()
+        return sum(requeued)
+
+    def _migrate_legacy(self):
+        key = self._legacy_key()
+        moved = 0
+        while True:
+            ids = self.client.zrange(key, 0, self.batch_size - 1)
+            if not ids:
+                break
+            pipe = self.client.pipeline(transaction=False)
+            self._pipe_migrate(
+                pipe, key, ids, self.BY_TIME_KEY, 1000 * self.SCORE_FACTOR)
+            moved += sum(self._execute(pipe))
+        log.warning(self.LEGACY_WARNING, moved)
+        return moved
+
+    def fail(self, entries, timestamp, backoff, max_retries):
+        if not entries:
+            return []
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_fail(pipe, entries, timestamp, backoff, max_retries)
+        return self._failed(self._execute(pipe))
+
+    def quarantined(self):
+        return heapq.merge(
+            *[self._iter_quarantine(shard) for shard in range(self.shards)],
+            key=lambda x: x[2])
+
+    def _iter_quarantine(self, shard):
+        key, failures = self._failure_keys(shard)
+        for chunk in self._scan_index(key, '+inf'):
+            errors = self.client.hmget(failures, [id for id, _ in chunk])
+            yield from self._quarantined(chunk, errors)
+
+    def replay(self, task_ids, timestamp):
+        if task_ids is None:
+            task_ids = (
+                id.decode('utf-8') for shard in range(self.shards)
+                for id, _ in self.client.zscan_iter(
+                    self._failure_keys(shard)[0], count=self.batch_size))
+        replayed = 0
+        for chunk in chunked(task_ids, self.batch_size):
+            pipe = self.client.pipeline(transaction=False)
+            self._pipe_replay(pipe, chunk, timestamp)
+            replayed += sum(self._execute(pipe)[:-1])
+        return replayed
+
+    def count(self, start=None, end=None):
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_count(pipe, start, end)
+        return sum(self._execute(pipe))
+
+    def list(self, start=None, end=None, limit=100, cursor=None,
+             payloads=False):
+        pipe = self.client.pipeline(transaction=False)
+        after = self._pipe_list(pipe, start, end, limit, cursor)
+        entries, cursor = self._listed(self._execute(pipe), after, limit)
+        tasks = None
+        if payloads and entries:
+            tasks = self._get_payloads(
+                [(id, shard) for _, id, shard in entries])
+        return (self._list_entries(entries, tasks), cursor)
+
+    def next_due(self):
+        pipe = self.client.pipeline(transaction=False)
+        self._pipe_next_due(pipe)
+        return self._next_due(self._execute(pipe))
+
+    def wait(self, before, timeout):
+        if self.pubsub is None:
+            self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(self.stored_channel)
+        if before is not None:
+            before = serialize_timestamp(before)
+        deadline = time.monotonic() + timeout
+        while True:
+            message = self.pubsub.get_message(
+                timeout=max(deadline - time.monotonic(), 0))
+            if message is not None:
+                if before is None or float(message['data']) < before:
+                    return True
+            elif time.monotonic() >= deadline:
+                return False
+
+    def cleanup(self, force=False):
+        # We use SCAN, so we don't block redis on large databases, and check
+        # each batch again in a script, since things may have changed
+        # between scanning and removing.
+        if self.shards == 1 and not self.key_prefix and not force:
+            # Payloads are stored under the bare task id then, so every
+            # string key of the database would look like an orphan, e.g. the
+            # results of the celery redis result backend.
+            raise ValueError(
+                'Without longterm_scheduler_key_prefix, cleanup would remove'
+                ' all other string keys of the database, pass force=True if'
+                ' it only contains the schedule')
+        if self.shards == 1:
+            pattern = self.key_prefix + '*'
+        else:
+            pattern = self.key_prefix + self.PAYLOAD_KEY + ':*'
+        keys = self.client.scan_iter(
+            match=self._escape_pattern(pattern), count=self.batch_size)
+        payloads = 0
+        for chunk in chunked(keys, self.batch_size):
+            pipe = self.client.pipeline(transaction=False)
+            for shard, ids in self._split_payload_keys(chunk).items():
+                keys = self._entry_keys(shard)
+                if self.shards == 1:
+                    # Entries that were not migrated yet, see migrate().
+                    keys.append(self.key_prefix + self.LEGACY_BY_TIME_KEY)
+                self._pipe_script(
+                    pipe, self._remove_orphaned_payloads, keys=keys,
+                    args=[self._payload_prefix(shard)] + ids)
+            payloads += sum(self._execute(pipe))
+        for shard in range(self.shards):
+            for bucket in range(self.buckets):
+                key = self._bucket_prefix(shard) + str(bucket)
+                for chunk in chunked(self.client.hscan_iter(
+                        key, count=self.batch_size), self.batch_size):
+                    payloads += self._remove_orphaned_fields(
+                        keys=self._entry_keys(shard) + [key],
+                        args=[id for id, _ in chunk])
+        ids = 0
+        for shard in range(self.shards):
+            for key in self._entry_keys(shard):
+                for chunk in chunked(self.client.zscan_iter(
+                        key, count=self.batch_size), self.batch_size):
+                    ids += self._remove_dangling_ids(
+                        keys=[key], args=self._payload_location(shard) +
+                        [id for id, _ in chunk])
+        return (payloads, ids)
+
+    @staticmethod
+    def _escape_pattern(pattern):
+        """Escapes the glob characters of SCAN MATCH, except a trailing *."""
+        return re.sub(r'([\\*?\[\]])', r'\\\1', pattern[:-1]) + '*'
+
+    def _split_payload_keys(self, keys):
+        """Groups payload keys into a dict shard: list of task ids."""
+        prefix = self.key_prefix.encode('utf-8')
+        keys = [key[len(prefix):] for key in keys if key.startswith(prefix)]
+        if self.shards == 1:
+            own = {self.HORIZON_KEY.encode('utf-8')}
+            return {0: [key for key in keys if key not in own]}
+        result = collections.defaultdict(list)
+        for key in keys:
+            match = self.SHARD_PAYLOAD_KEY.match(key.decode('utf-8'))
+            if match and int(match.group(1)) < self.shards:
+                result[int(match.group(1))].append(
+                    key[len(match.group(0)):])
+        return result
+
+    def migrate(self):
+        # Moves entries indexed by seconds (by version 1.3 and earlier) and,
+        # if sharding is configured, entries stored without sharding into the
+        # current layout. Schedulers only see the entries once they were
+        # moved. The key prefix stays the same, we cannot tell which
+        # unprefixed entries belong to this application.
+        prefix = self.key_prefix
+        sources = [(self._legacy_key(), self.BY_TIME_KEY,
+                    1000 * self.SCORE_FACTOR)]
+        if self.shards > 1:
+            sources += [(prefix + self.BY_TIME_KEY, self.BY_TIME_KEY, 1),
+                        (prefix + self.COLD_KEY, self.BY_TIME_KEY, 1),
+                        (prefix + self.IN_FLIGHT_KEY, self.IN_FLIGHT_KEY, 1),
+                        (prefix + self.QUARANTINE_KEY, self.QUARANTINE_KEY,
+                         1)]
+        moved = 0
+        for key, name, factor in sources:
+            while True:
+                ids = self.client.zrange(key, 0, self.batch_size - 1)
+                if not ids:
+                    break
+                pipe = self.client.pipeline(transaction=False)
+                self._pipe_migrate(pipe, key, ids, name, factor)
+                moved += sum(self._execute(pipe))
+        # Payloads stored under their own key are moved into the buckets;
+        # until then, they are still found there.
+        for shard in range(self.shards if self.buckets else 0):
+            for key in self._entry_keys(shard):
+                for chunk in chunked(self.client.zscan_iter(
+                        key, count=self.batch_size), self.batch_size):
+                    moved += self._move_into_buckets(
+                        keys=[key], args=self._payload_location(shard) +
+                        [id for id, _ in chunk])
+        # Entries after the horizon are moved into the cold tier (and back,
+        # if the hot window was disabled).
+        now = int(time.time() * 1000)
+        for shard in range(self.shards):
+            keys = self._index_keys(shard)[:1] + self._tier_keys(shard)
+            self._promote(keys=keys, args=[now, self.hot_window * 1000, 0])
+            while True:
+                count = self._demote(keys=keys, args=[self.batch_size])
+                if not self.hot_window:
+                    count = self._promote(
+                        keys=keys, args=[now, 0, self.batch_size])
+                if not count:
+                    break
+                moved += count
+        return moved
+
+    def _scan_index(self, key, max_score):
+        """Yields the entries of the sorted set ``key`` with a score up to
+        ``max_score`` as lists of (id, score) of at most ``batch_size`` items,
+        in score order.
+
+        We page by score instead of by offset, since callers may well delete
+        the entries we already returned while iterating (which would shift
+        any offset). Entries that share the score of the previous page are
+        skipped by remembering their ids.
+        """
+        start = '-inf'
+        seen = set()
+        while True:
+            chunk = self.client.zrangebyscore(
+                key, start, max_score,
+                start=0, num=self.batch_size + len(seen), withscores=True)
+            chunk = [(id, score) for id, score in chunk if id not in seen]
+            if not chunk:
+                break
+            yield chunk
+            last = chunk[-1][1]
+            if last != start:
+                start = last
+                seen = set()
+            seen.update(id for id, score in chunk if score == last)
+
+
+class SQLiteBackend(AbstractBackend):
+    """File-based backend implementation, for single-node deployments without
+    redis. Configure it with an URL like ``sqlite:///path/to/schedule.db``.
+
+    Entries are stored in one table, with a partial index on the due time of
+    the scheduled (i.e. not claimed) entries. The database uses WAL mode, so
+    readers don't block the writer, and each thread uses its own connection.
+    Several processes may use the same file; ``claim()`` takes the write lock
+    so they don't claim the same entries. Due times are stored in
+    milliseconds, entries due at the same time are returned in insertion
+    order. Quarantined entries are moved into a separate table. The labels of
+    the entries (see ``labels()``) are stored in another one.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS scheduled_task (
+        id TEXT PRIMARY KEY,
+        due INTEGER NOT NULL,
+        payload BLOB NOT NULL,
+        claimed_until INTEGER,
+        failures INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS scheduled_task_due
+        ON scheduled_task (due) WHERE claimed_until IS NULL;
+    CREATE INDEX IF NOT EXISTS scheduled_task_claimed_until
+        ON scheduled_task (claimed_until) WHERE claimed_until IS NOT NULL;
+    CREATE TABLE IF NOT EXISTS quarantined_task (
+        id TEXT PRIMARY KEY,
+        payload BLOB NOT NULL,
+        failures INTEGER NOT NULL,
+        error TEXT,
+        quarantined INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS quarantined_task_quarantined
+        ON quarantined_task (quarantined);
+    CREATE TABLE IF NOT EXISTS scheduled_task_label (
+        label TEXT NOT NULL,
+        id TEXT NOT NULL,
+        PRIMARY KEY (label, id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS scheduled_task_label_id
+        ON scheduled_task_label (id);
+    """
+
+    # Seconds, how often wait() looks for changes by other connections.
+    WAIT_POLL_INTERVAL = 0.1
+
+    def __init__(self, url, app):
+        self.path = url.split('://', 1)[1]
+        self.codec = Codec.from_conf(app.conf)
+        self.batch_size = int(
+            app.conf.get('longterm_scheduler_batch_size') or
+            DEFAULT_BATCH_SIZE)
+        self.index_task_names = bool(
+            app.conf.get('longterm_scheduler_index_task_names'))
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.earliest_stored = None
+        self.connection.executescript(self.SCHEMA)
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            import sqlite3
+            # We manage transactions ourselves, see _transaction().
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA busy_timeout=10000')
+            self.local.connection = connection
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock right away, so concurrent
+        # read-modify-write transactions (like claim) don't interleave.
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+    def _stored(self, timestamp):
+        with self.lock:
+            if self.earliest_stored is None or \
+                    timestamp < self.earliest_stored:
+                self.earliest_stored = timestamp
+
+    def set(self, timestamp, task_id, args, kw):
+        self.set_many([(timestamp, task_id, args, kw)])
+
+    def set_earliest(self, timestamp, task_id, args, kw):
+        rows, label_rows = self._rows([(timestamp, task_id, args, kw)])
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT due, claimed_until FROM scheduled_task WHERE id = ?',
+                (task_id,)).fetchone()
+            if row is not None and (
+                    row[1] is not None or row[0] <= rows[0][1]):
+                return False
+            self._insert(connection, rows, label_rows)
+        self._stored(rows[0][1])
+        return True
+
+    def set_many(self, entries):
+        for chunk in chunked(entries, self.batch_size):
+            rows, label_rows = self._rows(chunk)
+            with self._transaction() as connection:
+                self._insert(connection, rows, label_rows)
+            self._stored(min(row[1] for row in rows))
+
+    def _rows(self, entries):
+        """Returns the rows of scheduled_task and scheduled_task_label for
+        the (timestamp, task_id, args, kw) entries."""
+        rows = []
+        label_rows = []
+        for timestamp, task_id, args, kw in entries:
+            if timestamp.tzinfo is None:
+                raise ValueError('Timezone required, got %s', timestamp)
+            rows.append((task_id, serialize_timestamp(timestamp),
+                         self.codec.dumps([args, kw])))
+            label_rows.extend(
+                (label, task_id)
+                for label in labels(args, kw, self.index_task_names))
+        return rows, label_rows
+
+    def _insert(self, connection, rows, label_rows):
+        # Replacing also resets the failures.
+        connection.executemany(
+            'INSERT OR REPLACE INTO scheduled_task (id, due, payload)'
+            ' VALUES (?, ?, ?)', rows)
+        ids = [row[:1] for row in rows]
+        connection.executemany(
+            'DELETE FROM quarantined_task WHERE id = ?', ids)
+        connection.executemany(
+            'DELETE FROM scheduled_task_label WHERE id = ?', ids)
+        connection.executemany(
+            'INSERT OR IGNORE INTO scheduled_task_label (label, id)'
+            ' VALUES (?, ?)', label_rows)
+
+    def reschedule(self, task_id, timestamp):
+        return bool(self.reschedule_many([(task_id, timestamp)]))
+
+    def reschedule_many(self, entries):
+        rescheduled = 0
+        for chunk in chunked(entries, self.batch_size):
+            rows = []
+            for task_id, timestamp in chunk:
+                if timestamp.tzinfo is None:
+                    raise ValueError('Timezone required, got %s', timestamp)
+                rows.append((serialize_timestamp(timestamp), task_id))
+            with self._transaction() as connection:
+                count = connection.executemany(
+                    'UPDATE scheduled_task SET due = ?'
+                    ' WHERE id = ? AND claimed_until IS NULL', rows).rowcount
+            if count:
+                self._stored(min(row[0] for row in rows))
+            rescheduled += count
+        return rescheduled
+
+    def get(self, task_id):
+        row = self.connection.execute(
+            'SELECT payload FROM scheduled_task WHERE id = ?'
+            ' UNION ALL SELECT payload FROM quarantined_task WHERE id = ?',
+            (task_id, task_id)).fetchone()
+        if row is None:
+            raise KeyError(task_id)
+        return self._load(row[0])
+
+    def _load(self, task):
+        args, kw = self.codec.loads(task)
         if isinstance(kw.get('args'), list):
             kw['args'] = tuple(kw['args'])
         return (tuple(args), kw)
 
     def delete(self, task_id):
-        removed = 0
-        removed += self.client.delete(task_id)
-        removed += self.client.zrem(self.BY_TIME_KEY, task_id)
-        if removed != 2:
+        if not self.delete_many([task_id]):
             raise KeyError(task_id)
 
+    def delete_many(self, task_ids):
+        if not task_ids:
+            return 0
+        rows = [(id,) for id in task_ids]
+        with self._transaction() as connection:
+            connection.executemany(
+                'DELETE FROM scheduled_task_label WHERE id = ?', rows)
+            return connection.executemany(
+                'DELETE FROM scheduled_task WHERE id = ?', rows).rowcount + \
+                connection.executemany(
+                    'DELETE FROM quarantined_task WHERE id = ?', rows).rowcount
+
+    def delete_by_tag(self, tag):
+        return self._delete_by_label('tag:' + tag)
+
+    def delete_by_name(self, name):
+        return self._delete_by_label('name:' + name)
+
+    def _delete_by_label(self, label):
+        removed = 0
+        while True:
+            ids = [row[0] for row in self.connection.execute(
+                'SELECT id FROM scheduled_task_label WHERE label = ? LIMIT ?',
+                (label, self.batch_size))]
+            if not ids:
+                return removed
+            removed += self.delete_many(ids)
+
     def get_older_than(self, timestamp):
         timestamp = serialize_timestamp(timestamp)
-        for id in self.client.zrangebyscore(self.BY_TIME_KEY, 0, timestamp):
-            # Typically celery uses uuid, so ascii would suffice, but who knows
-            # what kind of ids random applications use in the wild.
-            yield (id.decode('utf-8'), self.get(id))
+        after = (-math.inf, -1)
+        while True:
+            # Keyset pagination (instead of one long-running SELECT), so
+            # callers can modify entries while iterating.
+            rows = self.connection.execute(
+                'SELECT due, rowid, id, payload FROM scheduled_task'
+                ' WHERE claimed_until IS NULL AND due <= ?'
+                ' AND (due, rowid) > (?, ?)'
+                ' ORDER BY due, rowid LIMIT ?',
+                (timestamp, after[0], after[1],
+                 self.batch_size)).fetchall()
+            if not rows:
+                break
+            for _, _, id, task in rows:
+                yield (id, self._load(task))
+            after = rows[-1][:2]
+
+    def claim(self, timestamp, limit, lease):
+        timestamp = serialize_timestamp(timestamp)
+        deadline = int(time.time()) + lease
+        with self._transaction() as connection:
+            rows = connection.execute(
+                'SELECT id, payload, due FROM scheduled_task'
+                ' WHERE claimed_until IS NULL AND due <= ?'
+                ' ORDER BY due, rowid LIMIT ?', (timestamp, limit)).fetchall()
+            connection.executemany(
+                'UPDATE scheduled_task SET claimed_until = ? WHERE id = ?',
+                [(deadline, id) for id, _, _ in rows])
+        return [(id, load_claimed(self._load, task),
+                 deserialize_timestamp(due))
+                for id, task, due in rows]
+
+    def ack(self, entries):
+        if not entries:
+            return 0
+        rows = [(task_id,) for task_id, _, _ in entries]
+        with self._transaction() as connection:
+            # Storing an entry again resets claimed_until, see _insert().
+            removed = [row for row in rows if connection.execute(
+                'DELETE FROM scheduled_task'
+                ' WHERE id = ? AND claimed_until IS NOT NULL', row).rowcount]
+            connection.executemany(
+                'DELETE FROM scheduled_task_label WHERE id = ?', removed)
+        return len(removed)
+
+    def release(self, entries):
+        if not entries:
+            return 0
+        # Claimed rows keep their due time, so we only need to unclaim them.
+        with self._transaction() as connection:
+            return connection.executemany(
+                'UPDATE scheduled_task SET claimed_until = NULL'
+                ' WHERE id = ? AND claimed_until IS NOT NULL',
+                [(task_id,) for task_id, _, _ in entries]).rowcount
+
+    def requeue_expired(self):
+        with self._transaction() as connection:
+            return connection.execute(
+                'UPDATE scheduled_task SET due = claimed_until * 1000,'
+                ' claimed_until = NULL WHERE claimed_until <= ?',
+                (int(time.time()),)).rowcount
+
+    def fail(self, entries, timestamp, backoff, max_retries):
+        now = serialize_timestamp(timestamp)
+        result = []
+        with self._transaction() as connection:
+            for task_id, error in entries:
+                row = connection.execute(
+                    'SELECT failures FROM scheduled_task'
+                    ' WHERE id = ? AND claimed_until IS NOT NULL',
+                    (task_id,)).fetchone()
+                if row is None:
+                    continue
+                failures = row[0] + 1
+                if failures > max_retries:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO quarantined_task'
+                        ' (id, payload, failures, error, quarantined)'
+                        ' SELECT id, payload, ?, ?, ? FROM scheduled_task'
+                        ' WHERE id = ?', (failures, error, now, task_id))
+                    connection.execute(
+                        'DELETE FROM scheduled_task WHERE id = ?', (task_id,))
+                    result.append((task_id, failures, None))
+                    continue
+                due = now + int(backoff * 1000 * 2 ** (failures - 1))
+                connection.execute(
+                    'UPDATE scheduled_task SET due = ?, claimed_until = NULL,'
+                    ' failures = ? WHERE id = ?', (due, failures, task_id))
+                result.append(
+                    (task_id, failures, deserialize_timestamp(due)))
+        return result
+
+    def quarantined(self):
+        after = (-math.inf, -1)
+        while True:
+            rows = self.connection.execute(
+                'SELECT quarantined, rowid, id, error FROM quarantined_task'
+                ' WHERE (quarantined, rowid) > (?, ?)'
+                ' ORDER BY quarantined, rowid LIMIT ?',
+                after + (self.batch_size,)).fetchall()
+            if not rows:
+                break
+            for timestamp, _, id, error in rows:
+                yield (id, error, deserialize_timestamp(timestamp))
+            after = rows[-1][:2]
+
+    def replay(self, task_ids, timestamp):
+        if timestamp.tzinfo is None:
+            raise ValueError('Timezone required, got %s', timestamp)
+        due = serialize_timestamp(timestamp)
+        if task_ids is None:
+            with self._transaction() as connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO scheduled_task (id, due, payload)'
+                    ' SELECT id, ?, payload FROM quarantined_task'
+                    ' ORDER BY quarantined, rowid', (due,))
+                replayed = connection.execute(
+                    'DELETE FROM quarantined_task').rowcount
+        else:
+            replayed = 0
+            for chunk in chunked(task_ids, self.batch_size):
+                with self._transaction() as connection:
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO scheduled_task'
+                        ' (id, due, payload) SELECT id, ?, payload'
+                        ' FROM quarantined_task WHERE id = ?',
+                        [(due, id) for id in chunk])
+                    replayed += connection.executemany(
+                        'DELETE FROM quarantined_task WHERE id = ?',
+                        [(id,) for id in chunk]).rowcount
+        if replayed:
+            self._stored(due)
+        return replayed
 
+    def count(self, start=None, end=None):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM scheduled_task'
+            ' WHERE claimed_until IS NULL AND due BETWEEN ? AND ?',
+            self._range(start, end)).fetchone()[0]
 
-# Could be made extensible via entrypoints, like in celery.app.backends.
+    def _range(self, start, end):
+        return (
+            -math.inf if start is None else serialize_timestamp(start),
+            math.inf if end is None else serialize_timestamp(end))
+
+    def list(self, start=None, end=None, limit=100, cursor=None,
+             payloads=False):
+        after = (-math.inf, -1)
+        if cursor is not None:
+            after = tuple(int(x) for x in cursor.split(':'))
+        rows = self.connection.execute(
+            'SELECT due, rowid, id, %s FROM scheduled_task'
+            ' WHERE claimed_until IS NULL AND due BETWEEN ? AND ?'
+            ' AND (due, rowid) > (?, ?)'
+            ' ORDER BY due, rowid LIMIT ?' % (
+                'payload' if payloads else 'NULL'),
+            self._range(start, end) + after + (limit,)).fetchall()
+        entries = [
+            (id, task and self._load(task), deserialize_timestamp(due))
+            for due, _, id, task in rows]
+        if len(rows) < limit:
+            return (entries, None)
+        return (entries, '%s:%s' % rows[-1][:2])
+
+    def next_due(self):
+        timestamp = self._next_due()
+        if timestamp is None:
+            return None
+        return deserialize_timestamp(timestamp)
+
+    def _next_due(self):
+        return self.connection.execute(
+            'SELECT MIN(due) FROM scheduled_task'
+            ' WHERE claimed_until IS NULL').fetchone()[0]
+
+    def wait(self, before, timeout):
+        # We cannot be notified about changes by other processes, so we poll
+        # `data_version`, which changes on each commit by other connections.
+        if before is not None:
+            before = serialize_timestamp(before)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                stored, self.earliest_stored = self.earliest_stored, None
+            version = self.connection.execute(
+                'PRAGMA data_version').fetchone()[0]
+            if version != getattr(self.local, 'data_version', version):
+                stored = self._next_due()
+            self.local.data_version = version
+            if stored is not None and (before is None or stored < before):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(remaining, self.WAIT_POLL_INTERVAL))
+
+    def cleanup(self, force=False):
+        # We cannot get inconsistent in the first place.
+        return (0, 0)
+
+    def migrate(self):
+        # There is only one layout.
+        return 0
+
+
+# The built-in backends, as "module:attribute" so we only import the one we
+# use (and its dependencies). Other packages can register backends with the
+# entry point group ``celery_longterm_scheduler.backends``.
 BACKENDS = {
-    'memory': MemoryBackend,
-    'redis': RedisBackend,
-    'rediss': RedisBackend,
+    'memory': 'celery_longterm_scheduler.backend:MemoryBackend',
+    'redis': 'celery_longterm_scheduler.backend:RedisBackend',
+    'rediss': 'celery_longterm_scheduler.backend:RedisBackend',
+    'sqlite': 'celery_longterm_scheduler.backend:SQLiteBackend',
 }
+ENTRY_POINT_GROUP = 'celery_longterm_scheduler.backends'
 
 
 def by_url(url, app):
@@ -171,47 +2461,72 @@ def by_url(url, app):
         raise ValueError(
             'longterm_scheduler_backend must be an URL, got %r' % url)
     scheme = url.split('://')[0]
-    return BACKENDS[scheme](url, app)
+    return backend_class(scheme)(url, app)
 
 
-class PickleFallbackJSONEncoder(json.JSONEncoder):
-    """Serializes non-native JSON types using pickle.
+def backend_class(scheme):
+    cls = BACKENDS.get(scheme)
+    if cls is None:
+        # Only look at the entry points if we have to, since that means
+        # looking at the metadata of all installed packages.
+        from importlib import metadata
+        try:
+            entry_points = metadata.entry_points(
+                group=ENTRY_POINT_GROUP)
+        except TypeError:  # Python < 3.10
+            entry_points = metadata.entry_points().get(
+                ENTRY_POINT_GROUP, ())
+        for entry_point in entry_points:
+            if entry_point.name == scheme:
+                return entry_point.load()
+        raise KeyError('No longterm_scheduler backend for %r' % scheme)
+    if isinstance(cls, str):
+        module, _, name = cls.partition(':')
+        cls = getattr(importlib.import_module(module), name)
+    return cls
 
-    We need this mostly because Task.apply_async() needs to store itself (the
-    Task instance), since send_task() needs it e.g. for routing information.
-    So we *hope* that nobody puts anything non-pickleable onto their tasks.
-    """
 
-    PICKLE_MARKER = '__python_pickle__'
+def labels(args, kw, index_task_names):
+    """Returns the labels an entry is indexed by: ``tag:<tag>`` for each of
+    ``kw['longterm_tags']``, and ``name:<task name>`` if
+    ``index_task_names``."""
+    result = ['tag:%s' % tag for tag in kw.get('longterm_tags') or ()]
+    if index_task_names:
+        result.insert(0, 'name:%s' % args[0])
+    return result
 
-    def default(self, o):
-        raw = pickle.dumps(o)
-        raw = base64.b64encode(raw).decode('ascii')
-        return self.PICKLE_MARKER + raw
 
-    @classmethod
-    def decode_dict(cls, o):
-        for key, value in o.items():
-            if isinstance(value, str) and value.startswith(cls.PICKLE_MARKER):
-                raw = value.replace(cls.PICKLE_MARKER, '', 1)
-                try:
-                    raw = base64.b64decode(raw)
-                except binascii.Error:
-                    # We hopefully have a py2 pickle.
-                    raw = raw.encode('ascii')
-                o[key] = pickle.loads(raw)
-        return o
+def load_claimed(load, task):
+    """Returns ``load(task)``, or an ``UnreadableTask`` if that fails."""
+    try:
+        return load(task)
+    except Exception as e:
+        error = UnreadableTask('%s: %s' % (type(e).__name__, e))
+        error.__cause__ = e
+        return error
 
 
-def serialize(obj):
-    return json.dumps(obj, cls=PickleFallbackJSONEncoder)
+def chunked(iterable, size):
+    """Yields lists of at most ``size`` items from ``iterable``, consuming it
+    lazily."""
+    iterable = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
 
 
-def deserialize(string):
-    return json.loads(
-        string, object_hook=PickleFallbackJSONEncoder.decode_dict)
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
 
 
 def serialize_timestamp(timestamp):
-    """Converts a datetime into seconds since the epoch."""
-    return int(pendulum.instance(timestamp).timestamp())
+    """Converts a datetime into milliseconds since the epoch."""
+    # Exact, unlike timestamp(), whose float may round up to the next second.
+    return (calendar.timegm(timestamp.utctimetuple()) * 1000 +
+            timestamp.microsecond // 1000)
+
+
+def deserialize_timestamp(timestamp):
+    """Converts milliseconds since the epoch into a datetime (in UTC)."""
+    return EPOCH + datetime.timedelta(milliseconds=int(timestamp))
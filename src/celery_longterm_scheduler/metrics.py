@@ -0,0 +1,273 @@
+"""Instrumentation hooks for the scheduler.
+
+Configure them with the setting ``longterm_scheduler_metrics``, either as an
+URL for one of the built-in exporters (``statsd://host:port/prefix`` or
+``prometheus://host:port``), or as an instance of a ``Metrics`` subclass to
+plug in other systems.
+
+The following metrics are recorded, histograms with names ending in
+``_seconds`` measure durations:
+
+:stored, rescheduled, revoked, dispatched, failed, retried, quarantined:
+  counters of tasks
+:backend_<method>_seconds: histogram of storage backend calls
+:serialize_seconds, deserialize_seconds, payload_bytes: histograms of task
+  entry (de)serialization and the size of serialized entries
+:dispatch_lag_seconds: histogram of the time between a task being due and it
+  being sent
+:schedule_size, oldest_due_age_seconds: gauges of the number of scheduled
+  tasks and how long the earliest one is overdue, updated after each run of
+  ``Scheduler.execute_pending()``
+"""
+import bisect
+import contextlib
+import math
+import threading
+import time
+import urllib.parse
+
+
+class Metrics:
+    """Base class of the instrumentation hooks, which does nothing."""
+
+    def increment(self, name, value=1):
+        pass
+
+    def observe(self, name, value):
+        """Records ``value`` in the histogram ``name``."""
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Context manager that observes the duration of its block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def start(self):
+        """Called by ``celery longterm_scheduler`` on startup, so exporters
+        can e.g. start serving their metrics."""
+        pass
+
+
+class StatsdMetrics(Metrics):
+    """Sends the metrics via UDP to StatsD, configured with an URL like
+    ``statsd://localhost:8125/prefix``. Durations are sent as timers in
+    milliseconds, other histograms with the type ``h``."""
+
+    def __init__(self, url):
+        import socket
+        url = urllib.parse.urlsplit(url)
+        self.address = (url.hostname or 'localhost', url.port or 8125)
+        self.prefix = url.path.strip('/') or 'longterm_scheduler'
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def increment(self, name, value=1):
+        self._send(name, value, 'c')
+
+    def observe(self, name, value):
+        if name.endswith('_seconds'):
+            self._send(name, round(value * 1000, 3), 'ms')
+        else:
+            self._send(name, value, 'h')
+
+    def gauge(self, name, value):
+        self._send(name, value, 'g')
+
+    def _send(self, name, value, type):
+        message = '%s.%s:%s|%s' % (self.prefix, name, value, type)
+        try:
+            self.socket.sendto(message.encode('utf-8'), self.address)
+        except OSError:
+            pass  # Metrics must never break scheduling.
+
+
+class PrometheusMetrics(Metrics):
+    """Collects the metrics in memory and renders them in the Prometheus text
+    exposition format with ``render()``. Configured with an URL like
+    ``prometheus://0.0.0.0:9100``, ``celery longterm_scheduler`` serves them
+    via HTTP on that address; with ``prometheus://`` applications can serve
+    ``render()`` themselves.
+    """
+
+    PREFIX = 'longterm_scheduler_'
+    DURATION_BUCKETS = (
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+        2.5, 5, 10)
+    LAG_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 21600, 86400)
+    SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+    def __init__(self, url):
+        url = urllib.parse.urlsplit(url)
+        self.address = None
+        if url.port is not None:
+            self.address = (url.hostname or '', url.port)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # name: [bucket counts..., count, sum]
+        self.histograms = {}
+        self.server = None
+
+    def _buckets(self, name):
+        if name == 'dispatch_lag_seconds':
+            return self.LAG_BUCKETS
+        if name.endswith('_seconds'):
+            return self.DURATION_BUCKETS
+        return self.SIZE_BUCKETS
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        buckets = self._buckets(name)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * (len(buckets) + 2)
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                name = self.PREFIX + name + '_total'
+                lines.append('# TYPE %s counter' % name)
+                lines.append('%s %s' % (name, value))
+            for name, value in sorted(self.gauges.items()):
+                name = self.PREFIX + name
+                lines.append('# TYPE %s gauge' % name)
+                lines.append('%s %s' % (name, value))
+            for name, histogram in sorted(self.histograms.items()):
+                buckets = self._buckets(name)
+                name = self.PREFIX + name
+                lines.append('# TYPE %s histogram' % name)
+                count = 0
+                for bound, value in zip(
+                        buckets + (math.inf,), histogram[:-1]):
+                    count += value
+                    lines.append('%s_bucket{le="%s"} %s' % (
+                        name, '+Inf' if bound == math.inf else bound, count))
+                lines.append('%s_count %s' % (name, count))
+                lines.append('%s_sum %s' % (name, histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        if self.address is None or self.server is not None:
+            return
+        import http.server
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(self.address, Handler)
+        threading.Thread(
+            target=self.server.serve_forever, daemon=True).start()
+
+
+class InstrumentedBackend:
+    """Wraps a storage backend and records the duration of its calls."""
+
+    METHODS = frozenset([
+        'set', 'set_earliest', 'set_many', 'reschedule', 'reschedule_many',
+        'get', 'delete', 'delete_many', 'delete_by_tag', 'delete_by_name',
+        'claim', 'ack', 'release', 'fail', 'requeue_expired', 'next_due',
+        'count', 'list'])
+
+    def __init__(self, backend, metrics):
+        self.backend = backend
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name in self.METHODS:
+            def timed(*args, **kw):
+                with self.metrics.timer('backend_%s_seconds' % name):
+                    return attr(*args, **kw)
+            return timed
+        if name == 'get_older_than':
+            return self._get_older_than
+        return attr
+
+    def _get_older_than(self, timestamp):
+        # Only measures the time spent in the backend, not in the caller.
+        entries = self.backend.get_older_than(timestamp)
+        duration = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    break
+                finally:
+                    duration += time.perf_counter() - start
+                yield entry
+        finally:
+            self.metrics.observe('backend_get_older_than_seconds', duration)
+
+
+class InstrumentedCodec:
+    """Wraps a ``serializer.Codec`` and records the duration of
+    (de)serializing and the size of the serialized entries."""
+
+    def __init__(self, codec, metrics):
+        self.codec = codec
+        self.metrics = metrics
+
+    def dumps(self, obj):
+        with self.metrics.timer('serialize_seconds'):
+            data = self.codec.dumps(obj)
+        self.metrics.observe('payload_bytes', len(data))
+        return data
+
+    def loads(self, data):
+        with self.metrics.timer('deserialize_seconds'):
+            return self.codec.loads(data)
+
+
+EXPORTERS = {
+    'statsd': StatsdMetrics,
+    'prometheus': PrometheusMetrics,
+}
+
+CONF_KEY = '__longterm_scheduler_metrics'
+
+
+def from_conf(conf):
+    """Returns the ``Metrics`` configured in ``longterm_scheduler_metrics``,
+    the same instance for each call, or None if not configured."""
+    if CONF_KEY not in conf:
+        metrics = conf.get('longterm_scheduler_metrics')
+        if isinstance(metrics, str):
+            scheme = metrics.split('://')[0]
+            if scheme not in EXPORTERS:
+                raise ValueError(
+                    'Unknown longterm_scheduler_metrics %r, use one of %s' % (
+                        metrics, ', '.join(sorted(EXPORTERS))))
+            metrics = EXPORTERS[scheme](metrics)
+        conf[CONF_KEY] = metrics
+    return conf[CONF_KEY]
@@ -0,0 +1,45 @@
+import time
+
+
+class TokenBucket:
+    """Allows ``rate`` operations per second on average, with bursts of up to
+    ``capacity`` operations (default: one second worth).
+
+    This is not thread-safe; the scheduler only takes tokens from its main
+    thread.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count):
+        """Takes up to ``count`` tokens without blocking.
+
+        :returns: int, the number of tokens taken
+        """
+        self._refill()
+        taken = min(count, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+    def give_back(self, count):
+        """Returns unused tokens, e.g. when fewer operations than expected
+        were performed."""
+        self.tokens = min(self.capacity, self.tokens + count)
+
+    def delay(self, count=1):
+        """Returns the seconds until ``count`` tokens (at most ``capacity``)
+        are available."""
+        self._refill()
+        missing = min(count, self.capacity) - self.tokens
+        return max(missing / self.rate, 0)
@@ -1,22 +1,36 @@
 from celery_longterm_scheduler import backend
+from celery_longterm_scheduler import metrics
+from celery_longterm_scheduler.ratelimit import TokenBucket
+import celery.utils.time
 import click
-import celery.bin.base
+import collections
+import concurrent.futures
 import contextlib
+import datetime
 import fcntl
+import kombu.exceptions
 import logging
+import math
 import os
-import pendulum
+import signal
+import time
 
 
 log = logging.getLogger(__name__)
 
+# Errors of send_task() that mean the broker is unavailable, rather than that
+# something is wrong with the task being sent.
+BROKER_ERRORS = (kombu.exceptions.OperationalError, ConnectionError)
+
 
 class Scheduler:
     """Main scheduler functionality:
 
     :store: schedule tasks for later
+    :store_many: schedule many tasks for later
     :revoke: revoke scheduled tasks
     :execute_pending: execute scheduled tasks due by a given timestamp
+    :execute_forever: execute scheduled tasks as soon as they are due
 
     Clients should use ``get_scheduler(app)`` with their celery app instance
     to get hold of the corresponding Scheduler instance.
@@ -24,6 +38,9 @@ class Scheduler:
 
     CONF_KEY = '__longterm_scheduler_backend'
 
+    # Seconds, how quickly execute_forever() notices a stop() request.
+    STOP_CHECK_INTERVAL = 1
+
     def __init__(self, app):
         self.app = app
         # Singleton behaviour
@@ -31,40 +48,408 @@ class Scheduler:
             app.conf[self.CONF_KEY] = backend.by_url(
                 app.conf['longterm_scheduler_backend'], app)
         self.backend = app.conf[self.CONF_KEY]
+        self.metrics = metrics.from_conf(app.conf)
+        if self.metrics is not None:
+            self.backend = metrics.InstrumentedBackend(
+                self.backend, self.metrics)
+        # Logging each task is costly at high volume.
+        self.log_tasks = app.conf.get('longterm_scheduler_log_tasks', True)
+        self.batch_size = int(
+            app.conf.get('longterm_scheduler_batch_size') or
+            backend.DEFAULT_BATCH_SIZE)
+        self.lease = int(
+            app.conf.get('longterm_scheduler_lease') or backend.DEFAULT_LEASE)
+        max_retries = app.conf.get('longterm_scheduler_max_retries')
+        self.max_retries = int(
+            backend.DEFAULT_MAX_RETRIES if max_retries is None
+            else max_retries)
+        self.retry_backoff = float(
+            app.conf.get('longterm_scheduler_retry_backoff') or
+            backend.DEFAULT_RETRY_BACKOFF)
+        self.max_tasks_per_run = int(
+            app.conf.get('longterm_scheduler_max_tasks_per_run') or 0)
+        # Rates use the celery format, e.g. 100 or '100/s', '10/m', '1/h'.
+        rate = celery.utils.time.rate(app.conf.get('longterm_scheduler_rate'))
+        self.rate = TokenBucket(rate) if rate else None
+        self.rate_limits = {
+            name: TokenBucket(celery.utils.time.rate(value))
+            for name, value in (
+                app.conf.get('longterm_scheduler_rate_limits') or {}).items()
+            if celery.utils.time.rate(value)}
+        self.stopped = False
 
     @classmethod
     def from_app(cls, app):
         return cls(app)
 
-    def store(self, timestamp, task_id, args, kw):
+    def store(self, timestamp, task_id, args, kw, keep_earliest=False):
         """Schedules the task (represented by the ``args`` and ``kw`` of the
         postponed send_task() call) under ``task_id`` and ``timestamp``.
+        A task already stored under ``task_id`` is replaced.
 
         :param timestamp: timezone-aware datetime
         :param task_id: string, the task id, can be used in revoke()
         :param args: tuple, positional arguments for the task
         :param kw: dict, keyword arguments for the task
+        :param keep_earliest: if True, a task stored under ``task_id`` that
+          is due at or before ``timestamp`` (or is being sent) is kept instead
+        :returns: True if the task was stored
+        """
+        if keep_earliest:
+            if not self.backend.set_earliest(timestamp, task_id, args, kw):
+                return False
+        else:
+            self.backend.set(timestamp, task_id, args, kw)
+        if self.metrics is not None:
+            self.metrics.increment('stored')
+        return True
+
+    def store_many(self, entries):
+        """Schedules many tasks at once, like calling ``store()`` for each of
+        them, but in batches of ``longterm_scheduler_batch_size``.
+
+        :param entries: iterable of tuple (timestamp, task_id, args, kw), it
+          is consumed lazily
         """
-        self.backend.set(timestamp, task_id, args, kw)
+        if self.metrics is not None:
+            entries = self._count_stored(entries)
+        self.backend.set_many(entries)
+
+    def _count_stored(self, entries):
+        for entry in entries:
+            yield entry
+            self.metrics.increment('stored')
 
-    def execute_pending(self, timestamp):
+    def execute_pending(self, timestamp, concurrency=1):
         """Looks up scheduled tasks that are due on or before ``timestamp``,
         creates normal celery tasks for them, and removes them from the
         scheduler storage.
 
+        Tasks are processed in batches of ``longterm_scheduler_batch_size``,
+        each batch is claimed atomically (so several scheduler processes can
+        run at the same time without executing a task twice), published
+        using a single producer and then removed from storage in one go.
+        Tasks that were claimed but not published (e.g. because the process
+        crashed) are put back after ``longterm_scheduler_lease`` seconds.
+
+        A task that cannot be loaded or published is put back into the
+        schedule, due ``longterm_scheduler_retry_backoff`` seconds (default:
+        60, doubled for each further failure) after ``timestamp``, while the
+        remaining tasks are published as usual. A task that failed more than
+        ``longterm_scheduler_max_retries`` times (default: 5) is quarantined
+        instead, see ``quarantined()`` and ``replay()``.
+
+        If the broker is unavailable (publishing raises a connection error,
+        or no producer can be acquired), the unpublished tasks are put back
+        under their original due time without counting this as their
+        failure, and the run ends early.
+
+        At most ``longterm_scheduler_max_tasks_per_run`` tasks are published
+        per call, and at most ``longterm_scheduler_rate`` per second overall
+        (and per task name as configured in
+        ``longterm_scheduler_rate_limits``); the remaining tasks stay in
+        storage in due order.
+
         :param timestamp: timezone-aware datetime
+        :param concurrency: int, number of threads that publish a batch in
+          parallel, each with its own producer, and each removing the tasks
+          it has published. The tasks are then not sent in due order.
+        :returns: bool, False if the run ended because the broker is
+          unavailable
         """
         log.info('Start executing tasks older than %s', timestamp)
-        for id, task in self.backend.get_older_than(timestamp):
-            self._execute_task(id, task[0], task[1])
+        self.backend.requeue_expired()
+        remaining = self.max_tasks_per_run or math.inf
+        available = True
+        with (concurrent.futures.ThreadPoolExecutor(concurrency)
+              if concurrency > 1 else contextlib.nullcontext()) as executor:
+            while not self.stopped and remaining > 0:
+                limit = self._take_tokens(min(self.batch_size, remaining))
+                if not limit:
+                    break
+                batch = self.backend.claim(timestamp, limit, self.lease)
+                batch, deferred = self._apply_rate_limits(batch)
+                if self.rate is not None:
+                    self.rate.give_back(limit - len(batch))
+                if batch:
+                    remaining -= len(batch)
+                    if executor is None:
+                        available = self._execute_batch(batch, timestamp)
+                    else:
+                        available = self._execute_batch_parallel(
+                            batch, timestamp, executor, concurrency)
+                    if not available:
+                        break
+                elif not deferred:
+                    break
+                else:
+                    self._sleep(self._rate_limit_delay(deferred))
+        if self.metrics is not None:
+            self._report_schedule()
         log.info('End executing tasks older than %s', timestamp)
+        return available
+
+    def _report_schedule(self):
+        self.metrics.gauge('schedule_size', self.backend.count())
+        next_due = self.backend.next_due()
+        age = 0
+        if next_due is not None:
+            age = max((utcnow() - next_due).total_seconds(), 0)
+        self.metrics.gauge('oldest_due_age_seconds', age)
 
-    def _execute_task(self, task_id, args, kw):
-        log.info('Enqueuing %s', task_id)
+    def _take_tokens(self, count):
+        """Returns how many tasks we may publish now, up to ``count``, waiting
+        for ``longterm_scheduler_rate`` if necessary (0 if stopped)."""
+        if self.rate is None:
+            return count
+        while not self.stopped:
+            taken = self.rate.take(count)
+            if taken:
+                return taken
+            self._sleep(self.rate.delay())
+        return 0
+
+    def _apply_rate_limits(self, tasks):
+        """Splits claimed ``tasks`` into those we may publish now and those
+        exceeding the limit of their task name, which we put back."""
+        if not self.rate_limits:
+            return (tasks, [])
+        allowed = []
+        deferred = []
+        for task in tasks:
+            if isinstance(task[1], backend.UnreadableTask):
+                allowed.append(task)
+                continue
+            bucket = self.rate_limits.get(task[1][0][0])
+            if bucket is None or bucket.take(1):
+                allowed.append(task)
+            else:
+                deferred.append(task)
+        self.backend.release(deferred)
+        return (allowed, deferred)
+
+    def _rate_limit_delay(self, deferred):
+        # When a batch consists only of rate limited tasks, wait until a
+        # number of them can be published, so we don't claim and release the
+        # same batch over and over again.
+        names = collections.Counter(task[1][0][0] for task in deferred)
+        return min(self.rate_limits[name].delay(count)
+                   for name, count in names.items())
+
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.stopped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, self.STOP_CHECK_INTERVAL))
+
+    def execute_forever(self, max_interval=60, concurrency=1):
+        """Executes scheduled tasks as soon as they are due, until ``stop()``
+        is called.
+
+        Between runs of ``execute_pending()`` we sleep until the earliest
+        scheduled task is due, but wake up early when a task that is due
+        even earlier is stored (by any process).
+
+        :param max_interval: int, maximum seconds to sleep before looking at
+          the schedule again
+        :param concurrency: int, see ``execute_pending()``
+        """
+        self.backend.wait(None, 0)  # Start listening for new entries
+        while not self.stopped:
+            available = self.execute_pending(utcnow(), concurrency)
+            now = utcnow()
+            if not available:
+                # The released tasks are due right away, so give the broker
+                # some time before we try again.
+                until = now + datetime.timedelta(
+                    seconds=min(self.retry_backoff, max_interval))
+            else:
+                until = now + datetime.timedelta(seconds=max_interval)
+                next_due = self.backend.next_due()
+                if next_due is not None and next_due < until:
+                    until = next_due
+            while not self.stopped and now < until:
+                timeout = min(
+                    (until - now).total_seconds(), self.STOP_CHECK_INTERVAL)
+                if self.backend.wait(until, timeout):
+                    break
+                now = utcnow()
+
+    def stop(self):
+        """Makes ``execute_pending()`` and ``execute_forever()`` return after
+        the current batch is done."""
+        self.stopped = True
+
+    def _execute_batch(self, tasks, timestamp):
+        """Publishes the claimed ``tasks``; returns False if the broker is
+        unavailable, see ``execute_pending()``."""
+        sent = []
+        failed = []
+        available = True
         # XXX No transactions, so we accept the risk of executing a task twice,
         # rather than not executing it at all (with regards to revoke failing).
+        try:
+            with self.app.producer_or_acquire() as producer:
+                for entry in tasks:
+                    task_id, task, due = entry
+                    # A failing task must not keep the others from being
+                    # sent, so we retry it later, see _fail().
+                    try:
+                        if isinstance(task, backend.UnreadableTask):
+                            raise task
+                        args, kw = task
+                        self._execute_task(task_id, args, kw, producer)
+                    except BROKER_ERRORS:
+                        log.warning(
+                            'Failed to send %s, broker unavailable', task_id,
+                            exc_info=True)
+                        available = False
+                        break
+                    except Exception as e:
+                        log.warning(
+                            'Failed to send %s', task_id, exc_info=True)
+                        failed.append(
+                            (entry, '%s: %s' % (type(e).__name__, e)))
+                        if self.metrics is not None:
+                            self.metrics.increment('failed')
+                        continue
+                    sent.append(entry)
+                    if self.metrics is not None:
+                        self.metrics.increment('dispatched')
+                        self.metrics.observe(
+                            'dispatch_lag_seconds',
+                            (utcnow() - due).total_seconds())
+        except Exception:
+            # The tasks handle their own errors above, so this comes from
+            # acquiring (or releasing) the producer.
+            log.warning('Broker unavailable', exc_info=True)
+            available = False
+        finally:
+            # Only removes the entries that were not stored again meanwhile.
+            self.backend.ack(sent)
+            if not available:
+                handled = {entry[0] for entry in sent}
+                handled.update(entry[0] for entry, _ in failed)
+                self.backend.release(
+                    [x for x in tasks if x[0] not in handled])
+            if failed:
+                self._fail(
+                    [(entry[0], error) for entry, error in failed], timestamp)
+        return available
+
+    def _fail(self, failed, timestamp):
+        for task_id, failures, eta in self.backend.fail(
+                failed, timestamp, self.retry_backoff, self.max_retries):
+            if eta is None:
+                log.error(
+                    'Quarantined %s after %s failures', task_id, failures)
+                if self.metrics is not None:
+                    self.metrics.increment('quarantined')
+            else:
+                log.info('Retrying %s at %s', task_id, eta)
+                if self.metrics is not None:
+                    self.metrics.increment('retried')
+
+    def _execute_batch_parallel(self, tasks, timestamp, executor,
+                                concurrency):
+        # Each part gets its own producer (and thus broker connection) from
+        # the pool in _execute_batch(), since they are not thread-safe.
+        size = -(-len(tasks) // concurrency)
+        futures = [
+            executor.submit(self._execute_batch, tasks[i:i + size], timestamp)
+            for i in range(0, len(tasks), size)]
+        # Wait for all parts, so a failing one does not leave the others
+        # running while we claim the next batch.
+        concurrent.futures.wait(futures)
+        return all([future.result() for future in futures])
+
+    def _execute_task(self, task_id, args, kw, producer=None):
+        if self.log_tasks:
+            log.info('Enqueuing %s', task_id)
+        kw['producer'] = producer
+        # Only for our index, see Task._schedule_kw().
+        kw.pop('longterm_tags', None)
+        # Entries stored by version 1.3 and earlier contain the pickled Task
+        # instance, newer ones only its name.
+        if 'task_type' not in kw:
+            kw['task_type'] = self.app.tasks.get(args[0])
         self.app.send_task(*args, **kw)
-        self.revoke(task_id)
+
+    def reschedule(self, task_id, eta):
+        """Changes the due time of the task scheduled by ``store(task_id)``
+        to ``eta``. Only the schedule index is updated, the stored task is
+        not rewritten.
+
+        :param eta: timezone-aware datetime
+        :returns: True if ``task_id`` was found and rescheduled, False
+          otherwise (also if it is currently being sent)"""
+        if not self.backend.reschedule(task_id, eta):
+            return False
+        if self.log_tasks:
+            log.info('Rescheduled %s to %s', task_id, eta)
+        if self.metrics is not None:
+            self.metrics.increment('rescheduled')
+        return True
+
+    def reschedule_many(self, entries):
+        """Changes the due time of many tasks at once, like calling
+        ``reschedule()`` for each of them, but in batches of
+        ``longterm_scheduler_batch_size``.
+
+        :param entries: iterable of tuple (task_id, eta)
+        :returns: int, the number of tasks that were found and rescheduled
+        """
+        rescheduled = self.backend.reschedule_many(entries)
+        if self.metrics is not None:
+            self.metrics.increment('rescheduled', rescheduled)
+        return rescheduled
+
+    def count(self, start=None, end=None):
+        """Returns the number of scheduled tasks, optionally only those due
+        between ``start`` and ``end`` (inclusive, timezone-aware datetimes).
+        Tasks that are currently being sent are not included."""
+        return self.backend.count(start, end)
+
+    def next_due(self):
+        """Returns the time the earliest scheduled task is due, or None."""
+        return self.backend.next_due()
+
+    def list(self, start=None, end=None, limit=100, cursor=None,
+             payloads=False):
+        """Returns one page of the scheduled tasks due between ``start`` and
+        ``end`` (inclusive), in due-time order. Pass the returned cursor to
+        get the next page. The stored tasks are only loaded if ``payloads``
+        is True.
+
+        :returns: tuple (entries, cursor) -- entries is a list of tuple
+          (task_id, (args, kw) or None, timestamp), cursor is None if there
+          are no more entries
+        """
+        return self.backend.list(start, end, limit, cursor, payloads)
+
+    def quarantined(self):
+        """Returns the tasks that were quarantined after failing more than
+        ``longterm_scheduler_max_retries`` times, in the order they were
+        quarantined.
+
+        :returns: iterable of tuple (task_id, error, timestamp) -- error
+          describes the last failure, timestamp is the time of quarantine
+        """
+        return self.backend.quarantined()
+
+    def replay(self, task_ids=None, eta=None):
+        """Schedules quarantined tasks again, with their failures reset.
+
+        :param task_ids: iterable of task ids, or None for all quarantined
+          tasks
+        :param eta: timezone-aware datetime, default: now
+        :returns: int, the number of tasks that were quarantined
+        """
+        replayed = self.backend.replay(task_ids, eta or utcnow())
+        log.info('Replayed %s quarantined tasks', replayed)
+        return replayed
 
     def revoke(self, task_id):
         """Removes the task scheduled by ``store(task_id)`` from scheduler
@@ -73,40 +458,228 @@ class Scheduler:
         :returns: True if ``task_id`` was found and removed, False otherwise"""
         try:
             self.backend.delete(task_id)
-            log.info('Revoked %s', task_id)
+            if self.log_tasks:
+                log.info('Revoked %s', task_id)
+            if self.metrics is not None:
+                self.metrics.increment('revoked')
             return True
         except KeyError:
             return False
 
+    def revoke_many(self, task_ids):
+        """Removes many tasks at once, like calling ``revoke()`` for each of
+        them, but in batches of ``longterm_scheduler_batch_size``.
+
+        :param task_ids: iterable of task ids
+        :returns: int, the number of tasks that were found and removed
+        """
+        revoked = 0
+        for chunk in backend.chunked(task_ids, self.batch_size):
+            revoked += self.backend.delete_many(chunk)
+        return self._revoked(revoked, 'tasks')
+
+    def revoke_by_tag(self, tag):
+        """Removes all tasks scheduled with ``tag`` in ``longterm_tags``, see
+        ``Task.apply_async()``.
+
+        :returns: int, the number of tasks that were removed
+        """
+        return self._revoked(
+            self.backend.delete_by_tag(tag), 'tasks tagged %s' % tag)
+
+    def revoke_by_name(self, name):
+        """Removes all scheduled tasks of the task ``name``. Only finds tasks
+        stored with the setting ``longterm_scheduler_index_task_names``
+        enabled (it is off by default, since the index needs memory).
+
+        :returns: int, the number of tasks that were removed
+        """
+        return self._revoked(
+            self.backend.delete_by_name(name), 'tasks of %s' % name)
+
+    def _revoked(self, count, description):
+        log.info('Revoked %s %s', count, description)
+        if self.metrics is not None:
+            self.metrics.increment('revoked', count)
+        return count
+
 
 get_scheduler = Scheduler.from_app
 
 
-@click.command(name='longterm_scheduler', cls=celery.bin.base.CeleryCommand)
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+@click.group(name='longterm_scheduler', invoke_without_command=True)
 @click.option(
     '--timestamp', default='now',
     help='Execute tasks older/equal to TIMESTAMP, default: now')
 @click.option(
     '--lockfile', default='',
     help='Path to lockfile, to prevent multiple simultaneous runs')
+@click.option(
+    '--loop', is_flag=True,
+    help='Keep running and execute tasks as soon as they are due')
+@click.option(
+    '--max-interval', default=60, type=int,
+    help='With --loop, maximum seconds between looking at the schedule')
+@click.option(
+    '--concurrency', default=1, type=click.IntRange(min=1),
+    help='Number of threads that publish tasks in parallel, default: 1')
+@click.option(
+    '--max-tasks-per-run', type=click.IntRange(min=0),
+    help='Publish at most this many tasks per run, the rest stays scheduled')
+@click.option(
+    '--rate',
+    help='Publish at most RATE tasks, e.g. 100/s or 1000/m')
+@click.option(
+    '--rate-limit', multiple=True, metavar='NAME=RATE',
+    help='Publish at most RATE tasks named NAME, can be given several times')
 @click.pass_context
-def main(ctx, timestamp, lockfile):
+def main(ctx, timestamp, lockfile, loop, max_interval, concurrency,
+         max_tasks_per_run, rate, rate_limit):
     """The subcommand ``celery longterm_scheduler`` executes scheduled tasks
     that are due on or before a given time (default: now), by creating normal
     celery tasks for them.
+
+    With ``--loop`` it keeps running instead and executes tasks as soon as
+    they are due, until it receives SIGTERM or SIGINT.
     """
     app = ctx.obj.app
     app.log.setup(
         logging.WARNING if ctx.parent.params.get('quiet') else logging.INFO)
+    if ctx.invoked_subcommand is not None:
+        return
+    if loop and timestamp != 'now':
+        raise click.UsageError('--timestamp cannot be used with --loop')
     # The `tz` parameter applies only if no timezone information is
     # present in the string -- which is precisely what we want here;
     # tz=None means use the locale's timezone.
+    import pendulum
     timestamp = pendulum.parse(timestamp, tz=None)
-    if lockfile:
-        with locked(lockfile):
-            get_scheduler(app).execute_pending(timestamp)
-    else:
-        get_scheduler(app).execute_pending(timestamp)
+    if max_tasks_per_run is not None:
+        app.conf['longterm_scheduler_max_tasks_per_run'] = max_tasks_per_run
+    if rate is not None:
+        app.conf['longterm_scheduler_rate'] = rate
+    if rate_limit:
+        rate_limits = dict(
+            app.conf.get('longterm_scheduler_rate_limits') or {})
+        for value in rate_limit:
+            if '=' not in value:
+                raise click.BadParameter(
+                    'Expected NAME=RATE, got %r' % value,
+                    param_hint='--rate-limit')
+            name, value = value.rsplit('=', 1)
+            rate_limits[name] = value
+        app.conf['longterm_scheduler_rate_limits'] = rate_limits
+    scheduler = get_scheduler(app)
+    if scheduler.metrics is not None:
+        scheduler.metrics.start()
+    with (locked(lockfile) if lockfile else contextlib.nullcontext()):
+        if loop:
+            for signum in [signal.SIGTERM, signal.SIGINT]:
+                signal.signal(signum, lambda *args: scheduler.stop())
+            scheduler.execute_forever(max_interval, concurrency)
+        else:
+            scheduler.execute_pending(timestamp, concurrency)
+
+
+@main.command()
+@click.option(
+    '--force', is_flag=True,
+    help='Run without longterm_scheduler_key_prefix, which removes all other'
+    ' string keys of the redis database')
+@click.pass_context
+def cleanup(ctx, force):
+    """Removes stored tasks that are not scheduled, and schedule entries
+    without a stored task (which may be left behind by earlier versions)."""
+    try:
+        payloads, ids = get_scheduler(ctx.obj.app).backend.cleanup(force)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    click.echo('Removed %s unscheduled tasks and %s dangling entries' % (
+        payloads, ids))
+
+
+@main.command()
+@click.pass_context
+def stats(ctx):
+    """Shows the number of scheduled tasks, how many of them are due and when
+    the next one is due."""
+    scheduler = get_scheduler(ctx.obj.app)
+    next_due = scheduler.next_due()
+    click.echo('scheduled: %s' % scheduler.count())
+    click.echo('due: %s' % scheduler.count(end=utcnow()))
+    click.echo('next_due: %s' % (
+        next_due.isoformat() if next_due is not None else '-'))
+
+
+@main.command()
+@click.pass_context
+def quarantine(ctx):
+    """Lists quarantined tasks, which failed too often, one per line: time
+    of quarantine, task id and the last error."""
+    for task_id, error, timestamp in get_scheduler(
+            ctx.obj.app).quarantined():
+        click.echo('%s %s %s' % (timestamp.isoformat(), task_id, error))
+
+
+@main.command()
+@click.argument('task_ids', nargs=-1)
+@click.option(
+    '--all', 'all_', is_flag=True, help='Replay all quarantined tasks')
+@click.pass_context
+def replay(ctx, task_ids, all_):
+    """Schedules the quarantined tasks TASK_IDS (or with --all, all of them)
+    again, due now."""
+    if not task_ids and not all_:
+        raise click.UsageError('Pass TASK_IDS or --all')
+    replayed = get_scheduler(ctx.obj.app).replay(
+        None if all_ else task_ids)
+    click.echo('Replayed %s tasks' % replayed)
+
+
+@main.command(name='list')
+@click.option('--start', help='Only tasks due on or after START')
+@click.option('--end', help='Only tasks due on or before END')
+@click.option(
+    '--limit', default=100, type=click.IntRange(min=1),
+    help='Maximum number of tasks, default: 100')
+@click.option('--cursor', help='Show the page after the previous one')
+@click.option(
+    '--payloads', is_flag=True, help='Also show task names and arguments')
+@click.pass_context
+def list_(ctx, start, end, limit, cursor, payloads):
+    """Lists scheduled tasks in due-time order, one per line: due time and
+    task id (and with --payloads the task name and arguments)."""
+    import pendulum
+    start, end = [
+        pendulum.parse(x, tz=None) if x is not None else None
+        for x in (start, end)]
+    entries, cursor = get_scheduler(ctx.obj.app).list(
+        start, end, limit, cursor, payloads)
+    for task_id, task, timestamp in entries:
+        line = '%s %s' % (timestamp.isoformat(), task_id)
+        if task is not None:
+            args, kw = task
+            line += ' %s %r %r' % (
+                args[0], kw.get('args') or (), kw.get('kwargs') or {})
+        click.echo(line)
+    if cursor is not None:
+        click.echo('Next page: --cursor %s' % cursor)
+
+
+@main.command()
+@click.pass_context
+def migrate(ctx):
+    """Moves stored tasks into the storage layout that is currently
+    configured (e.g. into shards, buckets or tiers, see
+    ``longterm_scheduler_shards``, ``longterm_scheduler_payload_buckets`` and
+    ``longterm_scheduler_hot_window``, or from the index of version 1.3 and
+    earlier)."""
+    moved = get_scheduler(ctx.obj.app).backend.migrate()
+    click.echo('Migrated %s tasks' % moved)
 
 
 @contextlib.contextmanager
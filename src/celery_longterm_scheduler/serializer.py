@@ -0,0 +1,222 @@
+from celery_longterm_scheduler import metrics
+import base64
+import binascii
+import json
+import pickle
+import zlib
+
+
+class PickleFallbackJSONEncoder(json.JSONEncoder):
+    """Serializes non-native JSON types using pickle.
+
+    We need this mostly because Task.apply_async() needs to store itself (the
+    Task instance), since send_task() needs it e.g. for routing information.
+    So we *hope* that nobody puts anything non-pickleable onto their tasks.
+    """
+
+    PICKLE_MARKER = '__python_pickle__'
+
+    def default(self, o):
+        raw = pickle.dumps(o)
+        raw = base64.b64encode(raw).decode('ascii')
+        return self.PICKLE_MARKER + raw
+
+    @classmethod
+    def decode_dict(cls, o):
+        for key, value in o.items():
+            if isinstance(value, str) and value.startswith(cls.PICKLE_MARKER):
+                raw = value.replace(cls.PICKLE_MARKER, '', 1)
+                try:
+                    raw = base64.b64decode(raw)
+                except binascii.Error:
+                    # We hopefully have a py2 pickle.
+                    raw = raw.encode('ascii')
+                o[key] = pickle.loads(raw)
+        return o
+
+
+def serialize(obj):
+    return json.dumps(obj, cls=PickleFallbackJSONEncoder)
+
+
+def deserialize(string):
+    return json.loads(
+        string, object_hook=PickleFallbackJSONEncoder.decode_dict)
+
+
+class JSONSerializer:
+
+    id = 1
+
+    def dumps(self, obj):
+        return serialize(obj).encode('utf-8')
+
+    def loads(self, data):
+        return deserialize(data)
+
+
+class PickleSerializer:
+
+    id = 2
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, protocol=5)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackSerializer:
+    """Serializes non-native msgpack types using pickle, like
+    PickleFallbackJSONEncoder."""
+
+    id = 3
+    PICKLE_EXT_TYPE = 1
+
+    def __init__(self):
+        import msgpack  # Optional dependency
+        self.msgpack = msgpack
+
+    def dumps(self, obj):
+        return self.msgpack.packb(obj, default=self._pickle)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(
+            data, ext_hook=self._unpickle, strict_map_key=False)
+
+    def _pickle(self, o):
+        return self.msgpack.ExtType(self.PICKLE_EXT_TYPE, pickle.dumps(o))
+
+    def _unpickle(self, code, data):
+        if code != self.PICKLE_EXT_TYPE:
+            return self.msgpack.ExtType(code, data)
+        return pickle.loads(data)
+
+
+class ZlibCompression:
+
+    id = 1
+
+    def compress(self, data):
+        return zlib.compress(data)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LZ4Compression:
+
+    id = 2
+
+    def __init__(self):
+        import lz4.frame  # Optional dependency
+        self.lz4 = lz4.frame
+
+    def compress(self, data):
+        return self.lz4.compress(data)
+
+    def decompress(self, data):
+        return self.lz4.decompress(data)
+
+
+# The ids are persisted in the stored entries, only ever add new ones.
+SERIALIZERS = {
+    'json': JSONSerializer,
+    'pickle': PickleSerializer,
+    'msgpack': MsgpackSerializer,
+}
+COMPRESSIONS = {
+    'zlib': ZlibCompression,
+    'lz4': LZ4Compression,
+}
+
+
+class Codec:
+    """Converts task entries to bytes and back, using the configured
+    serializer and compression.
+
+    Entries are prefixed with a header (a zero byte, the serializer id and the
+    compression id), so entries written with a different configuration can
+    still be read. Entries without header are plain JSON; this is what
+    versions 1.3 and earlier wrote, and what we still write with the default
+    configuration, so older versions can read it, too.
+    """
+
+    HEADER_MARKER = 0
+    HEADER_SIZE = 3
+
+    DEFAULT_SERIALIZER = 'json'
+    DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+    def __init__(self, serializer=DEFAULT_SERIALIZER, compression=None,
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        """
+        :param serializer: string, name in ``SERIALIZERS``
+        :param compression: string, name in ``COMPRESSIONS``, or None
+        :param compression_threshold: int, only compress entries with at
+          least this many bytes
+        """
+        if serializer not in SERIALIZERS:
+            raise ValueError('Unknown serializer %r, use one of %s' % (
+                serializer, ', '.join(sorted(SERIALIZERS))))
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression %r, use one of %s' % (
+                compression, ', '.join(sorted(COMPRESSIONS))))
+        self.serializer = SERIALIZERS[serializer]()
+        self.compression = compression and COMPRESSIONS[compression]()
+        self.compression_threshold = compression_threshold
+        self.legacy = (serializer == 'json' and compression is None)
+        self._serializers = {self.serializer.id: self.serializer}
+        self._compressions = {}
+        if self.compression:
+            self._compressions[self.compression.id] = self.compression
+
+    @classmethod
+    def from_conf(cls, conf):
+        codec = cls(
+            conf.get('longterm_scheduler_serializer') or
+            cls.DEFAULT_SERIALIZER,
+            conf.get('longterm_scheduler_compression'),
+            int(conf.get('longterm_scheduler_compression_threshold') or
+                cls.DEFAULT_COMPRESSION_THRESHOLD))
+        instrumentation = metrics.from_conf(conf)
+        if instrumentation is not None:
+            codec = metrics.InstrumentedCodec(codec, instrumentation)
+        return codec
+
+    def dumps(self, obj):
+        data = self.serializer.dumps(obj)
+        if self.legacy:
+            return data
+        compression = 0
+        if self.compression and len(data) >= self.compression_threshold:
+            compressed = self.compression.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                compression = self.compression.id
+        return bytes(
+            [self.HEADER_MARKER, self.serializer.id, compression]) + data
+
+    def loads(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if not data or data[0] != self.HEADER_MARKER:
+            return deserialize(data)
+        serializer, compression = data[1], data[2]
+        data = data[self.HEADER_SIZE:]
+        if compression:
+            data = self._lookup(
+                compression, self._compressions, COMPRESSIONS).decompress(
+                    data)
+        return self._lookup(
+            serializer, self._serializers, SERIALIZERS).loads(data)
+
+    def _lookup(self, id, cache, registry):
+        if id not in cache:
+            for cls in registry.values():
+                if cls.id == id:
+                    cache[id] = cls()
+                    break
+            else:
+                raise ValueError('Unknown id %s in entry header' % id)
+        return cache[id]
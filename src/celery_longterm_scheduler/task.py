@@ -1,6 +1,12 @@
 import celery
 import celery.utils
 import celery_longterm_scheduler
+import uuid
+
+
+# Task ids for longterm_dedup_key are derived in this namespace.
+DEDUP_NAMESPACE = uuid.UUID('0c1e9f6c-5d2a-4f5e-9a61-3b7d2c8e4f10')
+DEDUP_POLICIES = ('replace', 'keep_earliest')
 
 
 class Task(celery.Task):
@@ -12,54 +18,174 @@ class Task(celery.Task):
     ``id`` is supported on it. This ID can be passed to
     ``celery_longterm_scheduler.revoke()`` to remove the scheduled job from
     storage.
+
+    Pass ``longterm_tags=[...]`` (strings) along with ``eta`` to revoke all
+    jobs with a tag at once, see ``Scheduler.revoke_by_tag()``. Without
+    ``eta`` the tags are ignored.
+
+    Pass ``longterm_dedup_key='...'`` along with ``eta`` to store at most one
+    job per key (and task name): the task id is derived from the key, so
+    scheduling again replaces the stored job. With
+    ``longterm_dedup_policy='keep_earliest'`` (instead of the default
+    ``'replace'``), a job that is due at the same time or earlier is kept.
     """
 
     def apply_async(self, args=None, kwargs=None, task_id=None, producer=None,
                     link=None, link_error=None, shadow=None, **options):
         if options.get('eta') is not None:
             timestamp = options.pop('eta')
-
-            # copy&paste from celery.app.task.Task.apply_async()
-            if self.__v2_compat__:
-                shadow = shadow or self.shadow_name(
-                    self(), args, kwargs, options)
-            else:
-                shadow = shadow or self.shadow_name(args, kwargs, options)
-
-            preopts = self._get_exec_options()
-            options = dict(preopts, **options) if options else preopts
-
-            options.setdefault('ignore_result', self.ignore_result)
-            if self.priority:
-                options.setdefault('priority', self.priority)
-            # end copy&paste
-
+            keep_earliest = self._keep_earliest(options)
+            options = self._schedule_options(
+                self._get_exec_options(), args, kwargs, shadow, options)
             return self._schedule(
-                timestamp,
+                timestamp, keep_earliest,
                 args=args, kwargs=kwargs, task_id=task_id, producer=producer,
-                link=link, link_error=link_error, shadow=shadow, **options)
+                link=link, link_error=link_error, **options)
         else:
+            options.pop('longterm_tags', None)
+            options.pop('longterm_dedup_key', None)
+            options.pop('longterm_dedup_policy', None)
             return super(Task, self).apply_async(
                 args=args, kwargs=kwargs, task_id=task_id, producer=producer,
                 link=link, link_error=link_error, shadow=shadow, **options)
 
-    def _schedule(self, timestamp, **kw):
-        # Store parameters apply_async() passes to app.send_task() in addition
-        # to its own **kw.
-        kw['task_type'] = self
+    def apply_async_many(self, tasks):
+        """Schedules many tasks at once, like calling
+        ``apply_async(args, kwargs, eta=eta, **options)`` for each of them,
+        but stores them in bulk, see ``Scheduler.store_many()``. The
+        ``longterm_dedup_policy`` ``'keep_earliest'`` is not supported here.
+
+        :param tasks: iterable of tuple (args, kwargs, eta, options), it is
+          consumed lazily
+        :returns: list of task ids
+        """
+        preopts = self._get_exec_options()
+        ids = []
+
+        def entries():
+            for args, kwargs, eta, options in tasks:
+                options = dict(options)
+                if self._keep_earliest(options):
+                    raise ValueError(
+                        'apply_async_many() only supports the '
+                        'longterm_dedup_policy replace')
+                entry = self._schedule_entry(
+                    preopts, args, kwargs, eta, options)
+                ids.append(entry[1])
+                yield entry
+
+        scheduler = celery_longterm_scheduler.get_scheduler(self.app)
+        scheduler.store_many(entries())
+        return ids
+
+    async def aapply_async(self, args=None, kwargs=None, eta=None, **options):
+        """asyncio variant of ``apply_async(args, kwargs, eta=eta, **options)``
+        that stores the task using
+        ``celery_longterm_scheduler.aio.AsyncScheduler``, so it does not block
+        the event loop. Only scheduling is supported, so ``eta`` is required.
+        """
+        from celery_longterm_scheduler import aio
+        keep_earliest = self._keep_earliest(options)
+        entry = self._schedule_entry(
+            self._get_exec_options(), args, kwargs, eta, options)
+        scheduler = aio.get_async_scheduler(self.app)
+        await scheduler.store(*entry, keep_earliest=keep_earliest)
+        return self.AsyncResult(entry[1])
+
+    def _schedule_entry(self, preopts, args, kwargs, eta, options):
+        """Returns the (timestamp, task_id, args, kw) for storing the task."""
+        if eta is None:
+            raise ValueError('eta required, got None')
+        options = dict(options)
+        shadow = options.pop('shadow', None)
+        options = self._schedule_options(
+            preopts, args, kwargs, shadow, options)
+        kw = dict(
+            args=args, kwargs=kwargs, task_id=None, producer=None,
+            link=None, link_error=None)
+        kw.update(options)
+        kw = self._schedule_kw(kw)
+        return (eta, kw['task_id'], (self.name,), kw)
+
+    def _schedule_options(self, preopts, args, kwargs, shadow, options):
+        # copy&paste from celery.app.task.Task.apply_async()
+        if self.__v2_compat__:
+            shadow = shadow or self.shadow_name(
+                self(), args, kwargs, options)
+        else:
+            shadow = shadow or self.shadow_name(args, kwargs, options)
+
+        options = dict(preopts, **options) if options else dict(preopts)
+
+        options.setdefault('ignore_result', self.ignore_result)
+        if self.priority:
+            options.setdefault('priority', self.priority)
+        # end copy&paste
+        options['shadow'] = shadow
+        return options
+
+    def _schedule(self, timestamp, keep_earliest=False, **kw):
+        kw = self._schedule_kw(kw)
+        scheduler = celery_longterm_scheduler.get_scheduler(self.app)
+        scheduler.store(
+            timestamp, kw['task_id'], (self.name,), kw,
+            keep_earliest=keep_earliest)
+        return self.AsyncResult(kw['task_id'])
+
+    @staticmethod
+    def _keep_earliest(options):
+        """Pops ``longterm_dedup_policy`` from ``options``, returns whether
+        it is ``'keep_earliest'``."""
+        policy = options.pop('longterm_dedup_policy', None)
+        if policy is None:
+            return False
+        if policy not in DEDUP_POLICIES:
+            raise ValueError('longterm_dedup_policy must be one of %s, got %r'
+                             % (', '.join(DEDUP_POLICIES), policy))
+        if options.get('longterm_dedup_key') is None:
+            raise ValueError(
+                'longterm_dedup_policy requires longterm_dedup_key')
+        return policy == 'keep_earliest'
+
+    def _schedule_kw(self, kw):
+        # apply_async() also passes `task_type=self` to app.send_task(). We
+        # don't store that, since pickling the whole Task instance into every
+        # entry is expensive and breaks when the task class changes between
+        # deployments; the scheduler looks it up by name instead, see
+        # Scheduler._execute_task(). (The routing-relevant task options have
+        # already been merged into **kw by apply_async()).
+        #
         # We don't set result_cls, since serializing instancemethods is a pain
         # and the additional settings of self.AsyncResult compared to
         # app.AsyncResult don't make a difference _inside_ send_task, so we
         # don't actually need it. And for the return value of apply_async we
-        # call it ourselves anyway, see below.
+        # call it ourselves anyway, see _schedule().
         # kw['result_cls'] = self.AsyncResult
 
         # We use the celery task_id also for our scheduler storage; this is
         # mostly for integration purposes, e.g. so that other Task subclasses
         # can be in control of the task_id and still work when inheriting us.
+        #
+        # With a dedup key, the task_id identifies the key, so storing
+        # replaces the entry of the same key, atomically and without needing
+        # another mapping that would have to be cleaned up.
+        dedup_key = kw.pop('longterm_dedup_key', None)
+        if dedup_key is not None:
+            if kw.get('task_id'):
+                raise ValueError(
+                    'Cannot pass both task_id and longterm_dedup_key')
+            kw['task_id'] = str(uuid.uuid5(
+                DEDUP_NAMESPACE, '%s\0%s' % (self.name, dedup_key)))
         if not kw.get('task_id'):
             kw['task_id'] = celery.utils.gen_unique_id()
-
-        scheduler = celery_longterm_scheduler.get_scheduler(self.app)
-        scheduler.store(timestamp, kw['task_id'], (self.name,), kw)
-        return self.AsyncResult(kw['task_id'])
+        tags = kw.pop('longterm_tags', None)
+        if tags:
+            if isinstance(tags, str):
+                raise ValueError(
+                    'longterm_tags must be a list of strings, got %r' % tags)
+            tags = [str(tag) for tag in tags]
+            for tag in tags:
+                if not tag or '\0' in tag:
+                    raise ValueError('Invalid tag %r' % tag)
+            kw['longterm_tags'] = tags
+        return kw
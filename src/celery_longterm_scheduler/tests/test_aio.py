@@ -0,0 +1,171 @@
+from celery_longterm_scheduler import aio
+import asyncio
+import celery
+import celery_longterm_scheduler
+import pendulum
+import pytest
+import sys
+
+
+ANYTIME = pendulum.datetime(2017, 1, 20)
+
+
+@pytest.fixture(params=[
+    {},
+    {'longterm_scheduler_shards': 3},
+    {'longterm_scheduler_payload_buckets': 4,
+     'longterm_scheduler_key_prefix': 'myapp:'},
+    {'longterm_scheduler_hot_window': 3600},
+], ids=['unsharded', 'sharded', 'buckets', 'tiered'])
+def app(request, redis_server):
+    app = celery.Celery(task_cls=celery_longterm_scheduler.Task)
+    app.conf['longterm_scheduler_backend'] = (
+        'redis://{host}:{port}/{db}'.format(**redis_server.dsn()))
+    app.conf.update(request.param)
+    return app
+
+
+def run(app, coroutine):
+    async def wrapper():
+        try:
+            return await coroutine(aio.get_async_scheduler(app))
+        finally:
+            await aio.get_async_scheduler(app).close()
+    return asyncio.run(wrapper())
+
+
+def test_async_store_is_visible_to_sync_scheduler(app):
+    run(app, lambda scheduler: scheduler.store(
+        ANYTIME, 'async', ('taskname',), {'kwargs': {'foo': 1}}))
+    assert celery_longterm_scheduler.get_scheduler(app).backend.get(
+        'async') == (('taskname',), {'kwargs': {'foo': 1}})
+
+
+def test_async_store_loads_scripts_again_after_flush(app):
+    async def scenario(scheduler):
+        await scheduler.backend.client.script_flush()
+        await scheduler.store(ANYTIME, 'async', ('taskname',), {})
+        return await scheduler.backend.count()
+    assert run(app, scenario) == 1
+
+
+def test_async_revoke_removes_entry_stored_by_sync_scheduler(app):
+    celery_longterm_scheduler.get_scheduler(app).store(
+        ANYTIME, 'sync', ('taskname',), {})
+    assert run(app, lambda scheduler: scheduler.revoke('sync'))
+    assert not run(app, lambda scheduler: scheduler.revoke('sync'))
+    with pytest.raises(KeyError):
+        celery_longterm_scheduler.get_scheduler(app).backend.get('sync')
+
+
+def test_async_pending_yields_due_entries_in_order_and_removes_them(app):
+    app.conf['longterm_scheduler_batch_size'] = 2
+
+    async def scenario(scheduler):
+        await scheduler.store_many(
+            (ANYTIME.add(seconds=i), str(i), (i,), {}) for i in range(5))
+        await scheduler.store(ANYTIME.add(days=1), 'later', (), {})
+        result = [task_id async for task_id, args, kw in scheduler.pending(
+            ANYTIME.add(seconds=10))]
+        return result, await scheduler.backend.next_due()
+
+    result, next_due = run(app, scenario)
+    assert result == ['0', '1', '2', '3', '4']
+    assert next_due == ANYTIME.add(days=1)
+
+
+class Removed:
+    """Stands in for a class that no longer exists when loading."""
+
+
+def test_async_pending_retries_tasks_that_cannot_be_loaded(app, monkeypatch):
+    app.conf['longterm_scheduler_serializer'] = 'pickle'
+    scheduler = celery_longterm_scheduler.get_scheduler(app)
+    scheduler.store(ANYTIME, 'broken', (Removed(),), {})
+    scheduler.store(ANYTIME, 'ok', ('taskname',), {})
+    monkeypatch.delattr(sys.modules[__name__], 'Removed')
+
+    async def scenario(scheduler):
+        result = [task_id async for task_id, args, kw in scheduler.pending(
+            ANYTIME)]
+        return result, await scheduler.backend.next_due()
+
+    assert run(app, scenario) == (['ok'], ANYTIME.add(seconds=60))
+
+
+def test_async_pending_moves_entries_stored_by_old_versions(app):
+    backend = celery_longterm_scheduler.get_scheduler(app).backend
+    backend.client.set(backend.key_prefix + 'old', backend.codec.dumps(
+        (('taskname',), {})))
+    backend.client.zadd(backend.key_prefix + backend.LEGACY_BY_TIME_KEY,
+                        {'old': ANYTIME.int_timestamp})
+
+    async def scenario(scheduler):
+        return [task_id async for task_id, args, kw in scheduler.pending(
+            ANYTIME)]
+
+    assert run(app, scenario) == ['old']
+
+
+def test_async_reschedule_changes_due_time(app):
+    async def scenario(scheduler):
+        await scheduler.store(ANYTIME, 'one', ('taskname',), {})
+        rescheduled = await scheduler.reschedule('one', ANYTIME.add(days=1))
+        missing = await scheduler.reschedule_many(
+            [('nonexistent', ANYTIME)])
+        return rescheduled, missing, await scheduler.backend.next_due()
+
+    assert run(app, scenario) == (True, 0, ANYTIME.add(days=1))
+
+
+def test_async_introspection_reads_the_index(app):
+    async def scenario(scheduler):
+        await scheduler.store_many(
+            (ANYTIME.add(seconds=i), str(i), ('taskname',), {})
+            for i in range(3))
+        first, cursor = await scheduler.list(limit=2)
+        second = await scheduler.list(cursor=cursor, payloads=True)
+        return (await scheduler.count(end=ANYTIME.add(seconds=1)),
+                await scheduler.next_due(), [x[0] for x in first], second)
+
+    assert run(app, scenario) == (2, ANYTIME, ['0', '1'], (
+        [('2', (('taskname',), {}), ANYTIME.add(seconds=2))], None))
+
+
+def test_async_scheduler_requires_redis():
+    app = celery.Celery()
+    app.conf['longterm_scheduler_backend'] = 'memory://'
+    with pytest.raises(ValueError):
+        aio.get_async_scheduler(app)
+
+
+def test_aapply_async_stores_task(app):
+    @app.task(name='echo')
+    def echo(arg):
+        return arg
+
+    result = asyncio.run(echo.aapply_async(('foo',), eta=ANYTIME))
+    args, kw = celery_longterm_scheduler.get_scheduler(app).backend.get(
+        result.id)
+    assert args == ('echo',)
+    assert kw['args'] == ('foo',)
+
+
+def test_aapply_async_supports_dedup_keys(app):
+    @app.task(name='echo')
+    def echo(arg):
+        return arg
+
+    async def scenario():
+        first = await echo.aapply_async(
+            ('first',), eta=ANYTIME, longterm_dedup_key='key')
+        second = await echo.aapply_async(
+            ('second',), eta=ANYTIME.add(days=1), longterm_dedup_key='key',
+            longterm_dedup_policy='keep_earliest')
+        await aio.get_async_scheduler(app).close()
+        return first.id, second.id
+
+    first, second = asyncio.run(scenario())
+    assert first == second
+    args, kw = celery_longterm_scheduler.get_scheduler(app).backend.get(first)
+    assert kw['args'] == ('first',)
@@ -1,22 +1,37 @@
 """Contract test that every scheduler storage backend must comply with."""
 from datetime import datetime
+from unittest import mock
 import celery
 import celery_longterm_scheduler.backend
 import celery_longterm_scheduler.conftest
+import celery_longterm_scheduler.serializer
 import json
 import pendulum
 import pytest
+import sys
+import threading
 
 
 ANYTIME = pendulum.datetime(2017, 1, 20)
 
 
-@pytest.fixture(params=['memory://', 'redis://'])
-def backend(request, redis_server):
+@pytest.fixture(params=[
+    'memory://', 'redis://', 'redis://?shards=3', 'redis://?buckets=4',
+    'redis://?hot_window=3600', 'sqlite://'])
+def backend(request, redis_server, tmp_path):
     url = request.param
-    if url == 'redis://':
-        url += '{host}:{port}/{db}'.format(**redis_server.dsn())
     dummyapp = celery.Celery()
+    if url == 'sqlite://':
+        url += str(tmp_path / 'schedule.db')
+    elif url.startswith('redis://'):
+        if url.endswith('?shards=3'):
+            dummyapp.conf['longterm_scheduler_shards'] = 3
+        if url.endswith('?buckets=4'):
+            dummyapp.conf['longterm_scheduler_payload_buckets'] = 4
+            dummyapp.conf['longterm_scheduler_key_prefix'] = 'myapp:'
+        if url.endswith('?hot_window=3600'):
+            dummyapp.conf['longterm_scheduler_hot_window'] = 3600
+        url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
     return celery_longterm_scheduler.backend.by_url(url, dummyapp)
 
 
@@ -95,3 +110,850 @@ def test_py3_deserializes_py2_pickle():
     ping = celery_longterm_scheduler.conftest.celery_ping.__maybe_evaluate__()
     # Sigh, this proxy business prevents doing a simple object identity check.
     assert repr(type(loaded)) == repr(type(ping))
+
+
+@pytest.fixture
+def redis_backend(redis_server):
+    url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
+    return celery_longterm_scheduler.backend.by_url(url, celery.Celery())
+
+
+def test_get_older_than_returns_all_entries_across_batches(redis_backend):
+    redis_backend.batch_size = 2
+    for i in range(5):
+        redis_backend.set(ANYTIME, str(i), (i,), {})
+    redis_backend.set(ANYTIME.add(hours=1), 'later', (), {})
+    items = list(redis_backend.get_older_than(ANYTIME.add(hours=1)))
+    assert [x[0] for x in items] == ['0', '1', '2', '3', '4', 'later']
+
+
+def test_get_older_than_tolerates_deleting_while_iterating(redis_backend):
+    redis_backend.batch_size = 2
+    for i in range(5):
+        redis_backend.set(ANYTIME.add(seconds=i), str(i), (i,), {})
+    ids = []
+    for id, _ in redis_backend.get_older_than(ANYTIME.add(hours=1)):
+        ids.append(id)
+        redis_backend.delete(id)
+    assert ids == ['0', '1', '2', '3', '4']
+
+
+def test_get_older_than_skips_entries_without_payload(redis_backend):
+    redis_backend.set(ANYTIME, 'one', (), {})
+    redis_backend.set(ANYTIME, 'two', (), {})
+    # Simulate a concurrent revoke that has only deleted the payload so far.
+    redis_backend.client.delete('one')
+    assert [x[0] for x in redis_backend.get_older_than(ANYTIME)] == ['two']
+
+
+def test_delete_many_removes_all_given_entries(backend):
+    backend.set(ANYTIME, 'one', ('arg1',), {})
+    backend.set(ANYTIME, 'two', ('arg2',), {})
+    backend.set(ANYTIME, 'three', ('arg3',), {})
+    assert backend.delete_many(['one', 'three']) == 2
+    with pytest.raises(KeyError):
+        backend.get('one')
+    with pytest.raises(KeyError):
+        backend.get('three')
+    assert [x[0] for x in backend.get_older_than(ANYTIME)] == ['two']
+
+
+def test_delete_many_ignores_nonexistent_task_ids(backend):
+    backend.set(ANYTIME, 'one', ('arg1',), {})
+    assert backend.delete_many(['one', 'nonexistent']) == 1
+    assert backend.delete_many([]) == 0
+    assert list(backend.get_older_than(ANYTIME)) == []
+
+
+def test_claim_returns_due_entries_in_order_up_to_limit(backend):
+    backend.set(pendulum.datetime(2017, 1, 1, 11), '3', (3,), {})
+    backend.set(pendulum.datetime(2017, 1, 1, 9), '1', (1,), {})
+    backend.set(pendulum.datetime(2017, 1, 1, 10), '2', (2,), {})
+    backend.set(pendulum.datetime(2017, 1, 1, 12), 'later', (), {})
+    due = pendulum.datetime(2017, 1, 1, 11)
+    assert backend.claim(due, 2, 60) == [
+        ('1', ((1,), {}), pendulum.datetime(2017, 1, 1, 9)),
+        ('2', ((2,), {}), pendulum.datetime(2017, 1, 1, 10))]
+    assert backend.claim(due, 2, 60) == [('3', ((3,), {}), due)]
+    assert backend.claim(due, 2, 60) == []
+
+
+def test_release_puts_claims_back_at_their_due_time(backend):
+    for i in range(4):
+        backend.set(ANYTIME.add(seconds=i), str(i), (i,), {})
+    claimed = backend.claim(ANYTIME.add(seconds=3), 3, 60)
+    backend.delete('0')
+    assert backend.release(claimed) == 2
+    assert backend.release(claimed) == 0
+    assert [x[0] for x in backend.get_older_than(ANYTIME.add(seconds=3))] == [
+        '1', '2', '3']
+    assert backend.next_due() == ANYTIME.add(seconds=1)
+
+
+def test_claimed_entries_are_not_scheduled_but_can_be_retrieved(backend):
+    backend.set(ANYTIME, 'one', ('arg',), {})
+    backend.claim(ANYTIME, 10, 60)
+    assert list(backend.get_older_than(ANYTIME)) == []
+    assert backend.get('one') == (('arg',), {})
+    assert backend.requeue_expired() == 0
+    assert list(backend.get_older_than(ANYTIME)) == []
+
+
+def test_claimed_entries_can_be_deleted(backend):
+    backend.set(ANYTIME, 'one', (), {})
+    backend.set(ANYTIME, 'two', (), {})
+    backend.claim(ANYTIME, 10, 60)
+    backend.delete('one')
+    assert backend.delete_many(['two']) == 1
+    with pytest.raises(KeyError):
+        backend.get('one')
+    with pytest.raises(KeyError):
+        backend.get('two')
+
+
+def test_ack_removes_claimed_entries(backend):
+    backend.set(ANYTIME, 'one', (), {'longterm_tags': ['a']})
+    backend.set(ANYTIME, 'two', (), {})
+    claimed = backend.claim(ANYTIME, 10, 60)
+    backend.delete('two')
+    assert backend.ack(claimed) == 1
+    assert backend.ack(claimed) == 0
+    assert backend.ack([]) == 0
+    with pytest.raises(KeyError):
+        backend.get('one')
+    assert backend.delete_by_tag('a') == 0
+    assert backend.requeue_expired() == 0
+
+
+def test_store_while_claimed_then_ack_keeps_new_entry(backend):
+    backend.set(ANYTIME, 'one', ('old',), {})
+    backend.set(ANYTIME, 'two', ('old',), {})
+    claimed = backend.claim(ANYTIME, 10, 0)
+    backend.set(ANYTIME.add(days=1), 'one', ('new',), {})
+    backend.set_many([(ANYTIME.add(days=1), 'two', ('new',), {})])
+    assert backend.ack(claimed) == 0
+    assert backend.get('one') == (('new',), {})
+    # The entries are scheduled again, not claimed anymore.
+    assert backend.requeue_expired() == 0
+    assert [x[0] for x in backend.claim(ANYTIME.add(days=1), 10, 60)] == [
+        'one', 'two']
+
+
+def test_requeue_expired_puts_claims_back_into_schedule(backend):
+    backend.set(ANYTIME, 'one', ('arg',), {})
+    backend.claim(ANYTIME, 10, 0)
+    assert backend.requeue_expired() == 1
+    assert list(backend.get_older_than(pendulum.now())) == [
+        ('one', (('arg',), {}))]
+    assert backend.requeue_expired() == 0
+
+
+def test_next_due_returns_time_of_earliest_entry(backend):
+    assert backend.next_due() is None
+    backend.set(pendulum.datetime(2017, 1, 1, 10), 'two', (), {})
+    backend.set(pendulum.datetime(2017, 1, 1, 9), 'one', (), {})
+    assert backend.next_due() == pendulum.datetime(2017, 1, 1, 9)
+
+
+def test_wait_returns_when_earlier_entry_is_stored(backend):
+    backend.wait(None, 0)
+    backend.set(pendulum.datetime(2017, 1, 1, 9), 'one', (), {})
+    assert backend.wait(pendulum.datetime(2017, 1, 1, 10), 5)
+    assert not backend.wait(None, 0.1)
+
+
+def test_wait_ignores_later_entries(backend):
+    backend.wait(None, 0)
+    backend.set(pendulum.datetime(2017, 1, 1, 11), 'one', (), {})
+    assert not backend.wait(pendulum.datetime(2017, 1, 1, 10), 0.1)
+
+
+def test_backend_uses_configured_serializer_and_compression(redis_server):
+    app = celery.Celery()
+    app.conf['longterm_scheduler_serializer'] = 'pickle'
+    app.conf['longterm_scheduler_compression'] = 'zlib'
+    app.conf['longterm_scheduler_compression_threshold'] = 10
+    url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
+    backend = celery_longterm_scheduler.backend.by_url(url, app)
+    backend.set(ANYTIME, 'myid', ('arg',), {'args': ('x' * 100,)})
+    assert len(backend.client.get('myid')) < 100
+    assert backend.get('myid') == (('arg',), {'args': ('x' * 100,)})
+
+
+def test_set_many_stores_all_entries(backend):
+    backend.batch_size = 2
+    entries = (
+        (pendulum.datetime(2017, 1, 1, 12 - i), str(i), (i,), {'kw': i})
+        for i in range(5))
+    backend.set_many(entries)
+    assert backend.get('3') == ((3,), {'kw': 3})
+    assert [x[0] for x in backend.get_older_than(ANYTIME)] == [
+        '4', '3', '2', '1', '0']
+
+
+def test_set_many_requires_timezone_aware_datetime(backend):
+    with pytest.raises(ValueError):
+        backend.set_many([(datetime.now(), 'myid', (), {})])
+
+
+def test_cleanup_removes_orphaned_payloads_and_dangling_ids(redis_backend):
+    redis_backend.batch_size = 2
+    redis_backend.set(ANYTIME, 'claimed', (), {})
+    redis_backend.claim(ANYTIME, 1, 60)
+    redis_backend.set(ANYTIME, 'scheduled', (), {})
+    redis_backend.set(ANYTIME, 'other', (), {})
+    redis_backend.client.set('orphan', 'payload')
+    redis_backend.client.zadd(redis_backend.BY_TIME_KEY, {'dangling': 1})
+    redis_backend.client.zadd(redis_backend.IN_FLIGHT_KEY, {'dangling2': 1})
+    assert redis_backend.cleanup(force=True) == (1, 2)
+    assert redis_backend.client.get('orphan') is None
+    assert [x[0] for x in redis_backend.get_older_than(ANYTIME)] == [
+        'scheduled', 'other']
+    assert redis_backend.get('claimed') == ((), {})
+    assert redis_backend.cleanup(force=True) == (0, 0)
+
+
+@pytest.fixture
+def sharded_backend(redis_server):
+    app = celery.Celery()
+    app.conf['longterm_scheduler_shards'] = 3
+    url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
+    return celery_longterm_scheduler.backend.by_url(url, app)
+
+
+def test_sharded_entries_are_spread_over_hash_tagged_keys(sharded_backend):
+    for i in range(20):
+        sharded_backend.set(ANYTIME, str(i), (), {})
+    keys = {key.decode('utf-8') for key in sharded_backend.client.keys()}
+    indexes = {x for x in keys if x.startswith('scheduled_task_id_by_time')}
+    assert indexes == {
+        'scheduled_task_id_by_time_v2:{0}', 'scheduled_task_id_by_time_v2:{1}',
+        'scheduled_task_id_by_time_v2:{2}'}
+    assert 'scheduled_task:{%s}:7' % sharded_backend._shard('7') in keys
+
+
+def test_cleanup_works_with_shards(sharded_backend):
+    sharded_backend.set(ANYTIME, 'scheduled', (), {})
+    sharded_backend.client.set(
+        sharded_backend._payload_key('orphan'), 'payload')
+    sharded_backend.client.zadd(
+        sharded_backend._index_keys(1)[0], {'dangling': 1})
+    assert sharded_backend.cleanup() == (1, 1)
+    assert sharded_backend.get('scheduled') == ((), {})
+
+
+def test_migrate_moves_unsharded_entries_into_shards(
+        redis_backend, sharded_backend):
+    redis_backend.batch_size = 2
+    for i in range(5):
+        redis_backend.set(ANYTIME.add(seconds=i), str(i), (i,), {
+            'longterm_tags': ['article-%s' % (i % 2)]})
+    redis_backend.claim(ANYTIME, 1, 60)
+    sharded_backend.batch_size = 2
+    assert sharded_backend.migrate() == 5
+    assert sharded_backend.migrate() == 0
+    assert [x[0] for x in sharded_backend.get_older_than(
+        ANYTIME.add(hours=1))] == ['1', '2', '3', '4']
+    assert sharded_backend.get('0') == ((0,), {'longterm_tags': ['article-0']})
+    assert sharded_backend.delete_by_tag('article-0') == 3
+    assert sharded_backend.delete_by_tag('article-1') == 2
+    assert sharded_backend.count() == 0
+    for key in [redis_backend.BY_TIME_KEY, redis_backend.IN_FLIGHT_KEY,
+                redis_backend.LABELS_KEY,
+                redis_backend.LABEL_KEY + ':article-0']:
+        assert not redis_backend.client.exists(key)
+
+
+def test_migrate_moves_quarantine_and_failures_into_shards(
+        redis_backend, sharded_backend):
+    for id in ['q1', 'q2', 'retried']:
+        redis_backend.set(ANYTIME, id, (id,), {})
+    redis_backend.claim(ANYTIME, 3, 60)
+    redis_backend.fail(
+        [('q1', 'Error: boom'), ('q2', 'Error: boom')], ANYTIME, 60, 0)
+    redis_backend.fail([('retried', 'Error: boom')], ANYTIME, 60, 5)
+    assert sharded_backend.migrate() == 3
+    assert sorted(sharded_backend.quarantined()) == [
+        ('q1', 'Error: boom', ANYTIME), ('q2', 'Error: boom', ANYTIME)]
+    assert sharded_backend.get('q1') == (('q1',), {})
+    due = ANYTIME.add(seconds=60)
+    assert [x[0] for x in sharded_backend.claim(due, 3, 60)] == ['retried']
+    # The failures of the retried entry were moved along.
+    assert sharded_backend.fail([('retried', 'Error: again')], due, 60, 5) == [
+        ('retried', 2, due.add(seconds=120))]
+    for key in [redis_backend.QUARANTINE_KEY, redis_backend.FAILURES_KEY]:
+        assert not redis_backend.client.exists(key)
+    assert sharded_backend.replay(None, ANYTIME) == 2
+    assert sharded_backend.cleanup(force=True) == (0, 0)
+
+
+def test_migrate_moves_entries_indexed_by_seconds(redis_backend):
+    # Layout of version 1.3: scores are seconds, payloads under the task id.
+    redis_backend.client.set('old', redis_backend.codec.dumps(((1,), {})))
+    redis_backend.client.zadd(
+        redis_backend.LEGACY_BY_TIME_KEY,
+        {'old': ANYTIME.int_timestamp})
+    redis_backend.set(ANYTIME.add(seconds=1), 'new', (), {})
+    assert [x[0] for x in redis_backend.get_older_than(
+        ANYTIME.add(hours=1))] == ['new']
+    # cleanup must not remove payloads of entries not migrated yet.
+    assert redis_backend.cleanup(force=True) == (0, 0)
+    assert redis_backend.migrate() == 1
+    assert redis_backend.migrate() == 0
+    assert list(redis_backend.get_older_than(ANYTIME.add(hours=1))) == [
+        ('old', ((1,), {})), ('new', ((), {}))]
+    assert redis_backend.claim(ANYTIME, 10, 60) == [
+        ('old', ((1,), {}), ANYTIME)]
+    assert not redis_backend.client.exists(redis_backend.LEGACY_BY_TIME_KEY)
+
+
+def test_migrate_moves_legacy_entries_into_shards(sharded_backend):
+    sharded_backend.client.set('old', sharded_backend.codec.dumps(((), {})))
+    sharded_backend.client.zadd(
+        sharded_backend.LEGACY_BY_TIME_KEY,
+        {'old': ANYTIME.int_timestamp})
+    assert sharded_backend.migrate() == 1
+    assert sharded_backend.next_due() == ANYTIME
+    assert sharded_backend.get('old') == ((), {})
+    assert not sharded_backend.client.exists('old')
+
+
+def test_requeue_expired_moves_entries_stored_by_old_versions(
+        sharded_backend, caplog):
+    # E.g. by producers that were not upgraded yet.
+    sharded_backend.client.set('old', sharded_backend.codec.dumps(((), {})))
+    sharded_backend.client.zadd(
+        sharded_backend.LEGACY_BY_TIME_KEY,
+        {'old': ANYTIME.int_timestamp})
+    assert sharded_backend.requeue_expired() == 0
+    assert 'Moved 1 entries' in caplog.text
+    assert sharded_backend.claim(ANYTIME, 10, 60) == [
+        ('old', ((), {}), ANYTIME)]
+    assert not sharded_backend.client.exists(
+        sharded_backend.LEGACY_BY_TIME_KEY)
+
+
+def test_sub_second_due_times_are_kept_in_order(backend):
+    backend.set(ANYTIME.add(microseconds=2000), 'later', (), {})
+    backend.set(ANYTIME.add(microseconds=1000), 'earlier', (), {})
+    assert [x[0] for x in backend.get_older_than(
+        ANYTIME.add(microseconds=1500))] == ['earlier']
+    assert [x[0] for x in backend.get_older_than(
+        ANYTIME.add(seconds=1))] == ['earlier', 'later']
+    assert backend.next_due() == ANYTIME.add(microseconds=1000)
+    assert backend.claim(ANYTIME.add(seconds=1), 10, 60) == [
+        ('earlier', ((), {}), ANYTIME.add(microseconds=1000)),
+        ('later', ((), {}), ANYTIME.add(microseconds=2000))]
+
+
+def test_entries_due_at_the_same_time_keep_insertion_order(backend):
+    if getattr(backend, 'shards', 1) > 1:
+        pytest.skip('Insertion order is only kept within each shard')
+    for task_id in ['b', 'a', 'c']:
+        backend.set(ANYTIME, task_id, (), {})
+    backend.set_many([(ANYTIME, 'e', (), {}), (ANYTIME, 'd', (), {})])
+    assert [x[0] for x in backend.get_older_than(ANYTIME)] == [
+        'b', 'a', 'c', 'e', 'd']
+    assert [x[0] for x in backend.claim(ANYTIME, 2, 60)] == ['b', 'a']
+
+
+def test_insertion_order_is_kept_after_many_entries(backend):
+    if getattr(backend, 'shards', 1) > 1:
+        pytest.skip('Insertion order is only kept within each shard')
+    # A sequence number counting all inserts would wrap around here.
+    backend.set_many((ANYTIME.add(days=1, seconds=i), str(i), (), {})
+                     for i in range(997))
+    ids = ['id%s' % i for i in reversed(range(4))]
+    for task_id in ids:
+        backend.set(ANYTIME, task_id, (), {})
+    assert [x[0] for x in backend.get_older_than(ANYTIME)] == ids
+
+
+def test_timestamps_are_serialized_as_exact_milliseconds():
+    timestamp = pendulum.datetime(2017, 1, 20, 10, 30, 59, 999999,
+                                  tz=pendulum.fixed_timezone(7200))
+    module = celery_longterm_scheduler.backend
+    ms = module.serialize_timestamp(timestamp)
+    assert ms == 1484901059999
+    assert module.deserialize_timestamp(ms) == timestamp.subtract(
+        microseconds=999)
+
+
+def test_reschedule_changes_due_time(backend):
+    backend.set(pendulum.datetime(2017, 1, 1, 9), 'one', ('payload',), {})
+    backend.set(pendulum.datetime(2017, 1, 1, 10), 'two', (), {})
+    assert backend.reschedule('one', pendulum.datetime(2017, 1, 1, 11))
+    assert list(backend.get_older_than(pendulum.datetime(2017, 1, 1, 12))) == [
+        ('two', ((), {})), ('one', (('payload',), {}))]
+    assert backend.next_due() == pendulum.datetime(2017, 1, 1, 10)
+    assert not backend.reschedule('nonexistent', ANYTIME)
+    assert list(backend.get_older_than(pendulum.datetime(2017, 1, 1, 12))) == [
+        ('two', ((), {})), ('one', (('payload',), {}))]
+
+
+def test_reschedule_does_not_change_claimed_entries(backend):
+    backend.set(ANYTIME, 'claimed', (), {})
+    backend.claim(ANYTIME, 1, 60)
+    assert not backend.reschedule('claimed', ANYTIME.add(days=1))
+    assert backend.next_due() is None
+
+
+def test_reschedule_many_returns_number_of_rescheduled_entries(backend):
+    backend.batch_size = 2
+    for i in range(5):
+        backend.set(ANYTIME, str(i), (), {})
+    assert backend.reschedule_many(
+        (str(i), ANYTIME.subtract(seconds=i)) for i in range(6)) == 5
+    assert [x[0] for x in backend.get_older_than(ANYTIME)] == [
+        '4', '3', '2', '1', '0']
+
+
+def test_reschedule_requires_timezone_aware_datetime(backend):
+    backend.set(ANYTIME, 'one', (), {})
+    with pytest.raises(ValueError):
+        backend.reschedule('one', datetime.now())
+
+
+def test_count_and_list_by_time_range(backend):
+    for i in range(5):
+        backend.set(ANYTIME.add(hours=i), str(i), (i,), {})
+    backend.set(ANYTIME.subtract(hours=1), 'claimed', (), {})
+    backend.claim(ANYTIME.subtract(hours=1), 1, 60)
+    assert backend.count() == 5
+    assert backend.count(ANYTIME.add(hours=1), ANYTIME.add(hours=3)) == 3
+    assert backend.count(start=ANYTIME.add(hours=4)) == 1
+    assert backend.count(end=ANYTIME.add(minutes=59)) == 1
+    assert backend.list(ANYTIME.add(hours=1), ANYTIME.add(hours=3)) == ([
+        ('1', None, ANYTIME.add(hours=1)),
+        ('2', None, ANYTIME.add(hours=2)),
+        ('3', None, ANYTIME.add(hours=3))], None)
+    assert backend.list(end=ANYTIME, payloads=True) == (
+        [('0', ((0,), {}), ANYTIME)], None)
+
+
+def test_list_paginates_with_cursor(backend):
+    backend.set_many((ANYTIME.add(seconds=i % 3), str(i), (), {})
+                     for i in range(7))
+    pages = []
+    cursor = None
+    while True:
+        entries, cursor = backend.list(limit=2, cursor=cursor)
+        pages.append([x[0] for x in entries])
+        if cursor is None:
+            break
+        # Entries changed between pages don't break pagination.
+        backend.delete(entries[0][0])
+    assert sorted(sum(pages, [])) == [str(i) for i in range(7)]
+    # In due-time order, i.e. by i % 3.
+    assert [int(x) % 3 for page in pages for x in page] == [
+        0, 0, 0, 1, 1, 2, 2]
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+
+
+def test_list_pages_through_entries_with_the_same_score(redis_backend):
+    for i in range(5):
+        redis_backend.set(ANYTIME, str(i), (), {})
+    redis_backend.client.zadd(
+        redis_backend.BY_TIME_KEY, {str(i): 1484870400000000
+                                    for i in range(5)})
+    ids = []
+    cursor = None
+    while True:
+        entries, cursor = redis_backend.list(limit=2, cursor=cursor)
+        ids.extend(x[0] for x in entries)
+        if cursor is None:
+            break
+    assert ids == ['0', '1', '2', '3', '4']
+
+
+@pytest.fixture
+def bucketed_backend(redis_server):
+    app = celery.Celery()
+    app.conf['longterm_scheduler_payload_buckets'] = 4
+    url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
+    return celery_longterm_scheduler.backend.by_url(url, app)
+
+
+def test_buckets_store_payloads_in_compact_hashes(bucketed_backend):
+    bucketed_backend.set_many(
+        (ANYTIME, str(i), (i,), {}) for i in range(20))
+    client = bucketed_backend.client
+    buckets = {key.decode('utf-8') for key in client.keys(
+        'scheduled_task_bucket:*')}
+    assert buckets == {'scheduled_task_bucket:%s' % i for i in range(4)}
+    assert sum(client.hlen(key) for key in buckets) == 20
+    assert {client.object('encoding', key) for key in buckets} <= {
+        b'ziplist', b'listpack'}
+    assert not client.exists('7')
+    assert bucketed_backend.delete_many(['7', 'nonexistent']) == 1
+    assert sum(client.hlen(key) for key in buckets) == 19
+
+
+def test_key_prefix_namespaces_all_keys(redis_server):
+    app = celery.Celery()
+    app.conf['longterm_scheduler_key_prefix'] = 'myapp:'
+    url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
+    backend = celery_longterm_scheduler.backend.by_url(url, app)
+    other_app = celery.Celery()
+    other_app.conf['longterm_scheduler_key_prefix'] = 'other:'
+    other = celery_longterm_scheduler.backend.by_url(url, other_app)
+    backend.set(ANYTIME, 'one', (), {})
+    other.set(ANYTIME, 'two', (), {})
+    backend.claim(ANYTIME, 1, 60)
+    assert {key.decode('utf-8') for key in backend.client.keys(
+        'myapp:*')} == {
+        'myapp:one', 'myapp:scheduled_task_id_in_flight'}
+    assert backend.cleanup() == (0, 0)
+    assert other.cleanup() == (0, 0)
+    assert backend.get('one') == ((), {})
+    assert [x[0] for x in other.get_older_than(ANYTIME)] == ['two']
+
+
+def test_migrate_moves_payloads_into_buckets(redis_backend, redis_server):
+    for i in range(5):
+        redis_backend.set(ANYTIME.add(seconds=i), str(i), (i,), {})
+    redis_backend.claim(ANYTIME, 1, 60)
+    app = celery.Celery()
+    app.conf['longterm_scheduler_payload_buckets'] = 2
+    url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
+    bucketed = celery_longterm_scheduler.backend.by_url(url, app)
+    # Not migrated payloads are still found.
+    assert bucketed.get('1') == ((1,), {})
+    assert [x[0] for x in bucketed.list(payloads=True)[0]] == [
+        '1', '2', '3', '4']
+    assert bucketed.cleanup(force=True) == (0, 0)
+    assert bucketed.migrate() == 5
+    assert bucketed.migrate() == 0
+    assert not any(redis_backend.client.exists(str(i)) for i in range(5))
+    assert bucketed.get('0') == ((0,), {})
+    assert [x[0] for x in bucketed.claim(ANYTIME.add(hours=1), 10, 60)] == [
+        '1', '2', '3', '4']
+
+
+def test_cleanup_removes_orphaned_bucket_fields(bucketed_backend):
+    bucketed_backend.set(ANYTIME, 'scheduled', (), {})
+    bucketed_backend.client.hset(
+        bucketed_backend._bucket_key('orphan'), 'orphan', 'payload')
+    bucketed_backend.client.zadd(
+        bucketed_backend.BY_TIME_KEY, {'dangling': 1})
+    assert bucketed_backend.cleanup(force=True) == (1, 1)
+    assert bucketed_backend.get('scheduled') == ((), {})
+
+
+@pytest.fixture
+def tiered_backend(redis_server):
+    app = celery.Celery()
+    app.conf['longterm_scheduler_hot_window'] = 3600
+    app.conf['longterm_scheduler_shards'] = 2
+    url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
+    return celery_longterm_scheduler.backend.by_url(url, app)
+
+
+def tier_sizes(backend):
+    hot = sum(backend.client.zcard(backend._index_keys(shard)[0])
+              for shard in range(backend.shards))
+    cold = sum(backend.client.zcard(backend._tier_keys(shard)[0])
+               for shard in range(backend.shards))
+    return hot, cold
+
+
+def test_hot_window_keeps_far_future_entries_in_cold_tier(tiered_backend):
+    backend = tiered_backend
+    now = pendulum.now('UTC').replace(microsecond=0)
+    # The first claim moves the horizon to the end of the next hour.
+    assert backend.claim(now, 10, 60) == []
+    backend.set_many([
+        (now.add(minutes=30), 'soon', (), {}),
+        (now.add(days=1), 'later', (), {}),
+        (now.add(days=2), 'latest', (), {})])
+    assert tier_sizes(backend) == (1, 2)
+    assert backend.count() == 3
+    assert backend.next_due() == now.add(minutes=30)
+    assert [x[0] for x in backend.list()[0]] == ['soon', 'later', 'latest']
+    assert [x[0] for x in backend.get_older_than(now.add(days=1))] == [
+        'soon', 'later']
+    assert backend.reschedule('latest', now.add(minutes=10))
+    assert backend.reschedule('soon', now.add(days=3))
+    assert tier_sizes(backend) == (1, 2)
+    backend.delete('later')
+    assert tier_sizes(backend) == (1, 1)
+    assert [x[0] for x in backend.claim(now.add(hours=1), 10, 60)] == [
+        'latest']
+    # Claiming for a later time also promotes the entries due until then.
+    assert backend.claim(now.add(days=3), 10, 60)[0][0] == 'soon'
+    assert tier_sizes(backend) == (0, 0)
+
+
+def test_claiming_far_ahead_does_not_move_the_horizon(tiered_backend):
+    backend = tiered_backend
+    now = pendulum.now('UTC')
+    assert backend.claim(now.add(years=20), 10, 60) == []
+    backend.set(now.add(years=2), 'later', (), {})
+    backend.set(now.add(minutes=10), 'soon', (), {})
+    assert tier_sizes(backend) == (1, 1)
+
+
+def test_requeue_expired_moves_old_entries_into_their_tier(tiered_backend):
+    backend = tiered_backend
+    now = pendulum.now('UTC')
+    backend.claim(now, 10, 60)
+    for id, due in [('soon', now), ('later', now.add(days=1))]:
+        backend.client.set(id, backend.codec.dumps(((), {})))
+        backend.client.zadd(backend.LEGACY_BY_TIME_KEY, {
+            id: due.int_timestamp})
+    assert backend.requeue_expired() == 0
+    assert tier_sizes(backend) == (1, 1)
+    assert backend.get('later') == ((), {})
+
+
+def test_promotion_moves_earliest_entries_in_batches(redis_server):
+    app = celery.Celery()
+    app.conf['longterm_scheduler_hot_window'] = 3600
+    app.conf['longterm_scheduler_batch_size'] = 2
+    url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
+    backend = celery_longterm_scheduler.backend.by_url(url, app)
+    now = pendulum.now('UTC')
+    backend.claim(now, 2, 60)
+    backend.set_many(
+        (now.add(days=1, seconds=i), str(i), (), {}) for i in range(5))
+    assert tier_sizes(backend) == (0, 5)
+    claimed = []
+    while True:
+        batch = backend.claim(now.add(days=2), 2, 60)
+        if not batch:
+            break
+        claimed += [x[0] for x in batch]
+    assert claimed == ['0', '1', '2', '3', '4']
+
+
+def test_migrate_moves_entries_between_tiers(redis_backend, redis_server):
+    now = pendulum.now('UTC')
+    redis_backend.set(now, 'now', (), {})
+    redis_backend.set(now.add(days=1), 'later', (), {})
+    app = celery.Celery()
+    app.conf['longterm_scheduler_hot_window'] = 3600
+    url = 'redis://{host}:{port}/{db}'.format(**redis_server.dsn())
+    tiered = celery_longterm_scheduler.backend.by_url(url, app)
+    assert tiered.migrate() == 1
+    assert tiered.migrate() == 0
+    assert tier_sizes(tiered) == (1, 1)
+    assert tiered.cleanup(force=True) == (0, 0)
+    assert tiered.get('later') == ((), {})
+    # Disabling the hot window moves everything back into one index.
+    assert redis_backend.migrate() == 1
+    assert tier_sizes(redis_backend) == (2, 0)
+
+
+class Removed:
+    """Stands in for a class that no longer exists when loading."""
+
+
+def test_claim_returns_unreadable_payloads_as_errors(backend, monkeypatch):
+    backend.codec = celery_longterm_scheduler.serializer.Codec('pickle')
+    backend.set(ANYTIME, 'broken', (Removed(),), {})
+    backend.set(ANYTIME, 'ok', ('arg',), {})
+    monkeypatch.delattr(sys.modules[__name__], 'Removed')
+    (broken, error, due), ok = backend.claim(ANYTIME, 10, 60)
+    assert broken == 'broken'
+    assert isinstance(error, celery_longterm_scheduler.backend.UnreadableTask)
+    assert 'Removed' in str(error)
+    assert due == ANYTIME
+    assert ok == ('ok', (('arg',), {}), ANYTIME)
+
+
+def test_fail_retries_with_backoff_then_quarantines(backend):
+    backend.set(ANYTIME, 'one', ('arg',), {})
+    backend.claim(ANYTIME, 1, 60)
+    assert backend.fail(
+        [('one', 'Error: first'), ('nonexistent', 'Error')],
+        ANYTIME, 10, 2) == [('one', 1, ANYTIME.add(seconds=10))]
+    assert backend.next_due() == ANYTIME.add(seconds=10)
+    backend.claim(ANYTIME.add(seconds=10), 1, 60)
+    assert backend.fail([('one', 'Error: second')], ANYTIME, 10, 2) == [
+        ('one', 2, ANYTIME.add(seconds=20))]
+    backend.claim(ANYTIME.add(seconds=20), 1, 60)
+    assert backend.fail([('one', 'Error: third')], ANYTIME, 10, 2) == [
+        ('one', 3, None)]
+    assert list(backend.quarantined()) == [('one', 'Error: third', ANYTIME)]
+    assert backend.count() == 0
+    assert backend.claim(pendulum.now(), 10, 60) == []
+    assert backend.get('one') == (('arg',), {})
+    assert backend.replay(['one', 'nonexistent'], ANYTIME) == 1
+    assert list(backend.quarantined()) == []
+    # Replaying resets the failures.
+    assert backend.claim(ANYTIME, 1, 60)[0][0] == 'one'
+    assert backend.fail([('one', 'Error')], ANYTIME, 10, 2) == [
+        ('one', 1, ANYTIME.add(seconds=10))]
+
+
+def test_quarantined_entries_can_be_replayed_or_deleted(backend):
+    for i in range(3):
+        backend.set(ANYTIME, str(i), (i,), {})
+        backend.claim(ANYTIME, 1, 60)
+        backend.fail([(str(i), 'Error')], ANYTIME.add(seconds=i), 10, 0)
+    assert [x[0] for x in backend.quarantined()] == ['0', '1', '2']
+    backend.delete('1')
+    with pytest.raises(KeyError):
+        backend.get('1')
+    assert backend.replay(None, ANYTIME) == 2
+    assert backend.replay(None, ANYTIME) == 0
+    assert sorted(x[0] for x in backend.get_older_than(ANYTIME)) == [
+        '0', '2']
+
+
+def test_set_takes_a_single_round_trip(redis_backend):
+    # Loads the scripts
+    redis_backend.set(ANYTIME, 'one', (), {})
+    redis_backend.reschedule('one', ANYTIME)
+    connection = redis_backend.client.connection_pool.get_connection()
+    redis_backend.client.connection_pool.release(connection)
+    with mock.patch.object(
+            connection, 'send_packed_command',
+            wraps=connection.send_packed_command) as send:
+        redis_backend.set(ANYTIME, 'two', (), {})
+        redis_backend.reschedule('two', ANYTIME.add(hours=1))
+    assert send.call_count == 2
+
+
+def test_scripts_are_loaded_again_after_flush(redis_backend):
+    redis_backend.set(ANYTIME, 'one', (), {})
+    redis_backend.client.script_flush()
+    redis_backend.set(ANYTIME, 'two', (), {})
+    assert redis_backend.reschedule('two', ANYTIME.add(hours=1))
+    assert [x[0] for x in redis_backend.claim(ANYTIME, 10, 60)] == ['one']
+
+
+def test_cleanup_refuses_to_scan_unprefixed_database(redis_backend):
+    redis_backend.client.set('celery-task-meta-abc', 'result')
+    with pytest.raises(ValueError):
+        redis_backend.cleanup()
+    assert redis_backend.client.get('celery-task-meta-abc') == b'result'
+
+
+def test_cleanup_keeps_quarantined_entries(redis_backend):
+    redis_backend.set(ANYTIME, 'one', (), {})
+    redis_backend.claim(ANYTIME, 1, 60)
+    redis_backend.fail([('one', 'Error')], ANYTIME, 10, 0)
+    assert redis_backend.cleanup(force=True) == (0, 0)
+    assert redis_backend.get('one') == ((), {})
+
+
+def test_delete_by_tag_removes_all_tagged_entries(backend):
+    backend.set_many([
+        (ANYTIME, str(i), ('echo',), {'longterm_tags': ['user:%s' % (i % 2)]})
+        for i in range(5)])
+    backend.set(ANYTIME, 'untagged', ('echo',), {})
+    backend.set(ANYTIME, 'both', ('echo',), {
+        'longterm_tags': ['user:0', 'user:1']})
+    backend.set(ANYTIME, 'retagged', ('echo',), {'longterm_tags': ['user:0']})
+    backend.set(ANYTIME, 'retagged', ('echo',), {'longterm_tags': ['other']})
+    backend.claim(ANYTIME, 1, 60)
+    assert backend.delete_by_tag('user:0') == 4
+    assert backend.delete_by_tag('user:0') == 0
+    assert sorted(x[0] for x in backend.get_older_than(ANYTIME)) == [
+        '1', '3', 'retagged', 'untagged']
+    backend.delete('1')
+    assert backend.delete_by_tag('user:1') == 1
+    assert backend.delete_by_tag('nonexistent') == 0
+
+
+def test_delete_by_name_requires_task_name_index(backend):
+    backend.set(ANYTIME, 'unindexed', ('echo',), {})
+    backend.index_task_names = True
+    backend.set_many([(ANYTIME, 'one', ('echo',), {}),
+                      (ANYTIME, 'two', ('other',), {})])
+    assert backend.delete_by_name('echo') == 1
+    assert sorted(x[0] for x in backend.get_older_than(ANYTIME)) == [
+        'two', 'unindexed']
+
+
+def test_labels_are_removed_with_their_entries(redis_backend):
+    redis_backend.set(ANYTIME, 'one', (), {'longterm_tags': ['a', 'b']})
+    redis_backend.set(ANYTIME, 'two', (), {'longterm_tags': ['a']})
+    assert redis_backend.cleanup(force=True) == (0, 0)
+    redis_backend.delete_many(['one'])
+    assert sorted(redis_backend.client.keys('scheduled_task_label*')) == [
+        b'scheduled_task_label:tag:a', b'scheduled_task_labels']
+    redis_backend.delete_many(['two'])
+    assert redis_backend.client.keys('scheduled_task_label*') == []
+
+
+def test_delete_finds_entries_with_any_timestamp(backend):
+    backend.set(pendulum.datetime(2017, 1, 1, 9), 'one', (), {})
+    backend.set(pendulum.datetime(2017, 1, 1, 10), 'two', (), {})
+    backend.set(pendulum.datetime(2017, 1, 1, 11), 'three', (), {})
+    backend.delete('two')
+    backend.delete('one')
+    assert [x[0] for x in backend.get_older_than(
+        pendulum.datetime(2017, 1, 1, 12))] == ['three']
+
+
+def test_set_existing_task_id_replaces_entry(backend):
+    backend.set(pendulum.datetime(2017, 1, 1, 9), 'one', ('old',), {})
+    backend.set(pendulum.datetime(2017, 1, 1, 10), 'one', ('new',), {})
+    assert list(backend.get_older_than(pendulum.datetime(2017, 1, 1, 9))) == []
+    assert list(backend.get_older_than(pendulum.datetime(2017, 1, 1, 10))) == [
+        ('one', (('new',), {}))]
+
+
+def test_set_earliest_keeps_entries_due_earlier(backend):
+    backend.set(ANYTIME.add(hours=1), 'one', ('old',), {})
+    assert not backend.set_earliest(ANYTIME.add(hours=2), 'one', ('new',), {})
+    assert not backend.set_earliest(ANYTIME.add(hours=1), 'one', ('new',), {})
+    assert backend.get('one') == (('old',), {})
+    assert backend.set_earliest(ANYTIME, 'one', ('new',), {})
+    assert backend.set_earliest(ANYTIME, 'two', ('new',), {})
+    assert sorted(backend.get_older_than(ANYTIME)) == [
+        ('one', (('new',), {})), ('two', (('new',), {}))]
+    backend.claim(ANYTIME, 2, 60)
+    assert not backend.set_earliest(
+        ANYTIME.subtract(hours=1), 'one', ('new',), {})
+
+
+def test_set_replaces_quarantined_entry(backend):
+    backend.set(ANYTIME, 'one', ('old',), {})
+    backend.claim(ANYTIME, 1, 60)
+    backend.fail([('one', 'Error')], ANYTIME, 10, 0)
+    backend.set(ANYTIME, 'one', ('new',), {})
+    assert list(backend.quarantined()) == []
+    backend.claim(ANYTIME, 1, 60)
+    assert backend.fail([('one', 'Error')], ANYTIME, 10, 1) == [
+        ('one', 1, ANYTIME.add(seconds=10))]
+
+
+def test_memory_backend_can_be_used_from_several_threads():
+    backend = celery_longterm_scheduler.backend.by_url(
+        'memory://', celery.Celery())
+    claimed = []
+
+    def store(prefix):
+        for i in range(200):
+            backend.set(ANYTIME, '%s%s' % (prefix, i), (), {})
+
+    def drain():
+        for _ in range(50):
+            claimed.extend(x[0] for x in backend.claim(ANYTIME, 10, 60))
+
+    threads = [threading.Thread(target=store, args=(x,)) for x in 'abc'] + [
+        threading.Thread(target=drain) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    claimed.extend(x[0] for x in backend.claim(ANYTIME, 1000, 60))
+    assert len(claimed) == len(set(claimed)) == 600
+
+
+def test_by_url_resolves_registered_class(monkeypatch):
+    monkeypatch.setitem(
+        celery_longterm_scheduler.backend.BACKENDS, 'custom',
+        celery_longterm_scheduler.backend.MemoryBackend)
+    backend = celery_longterm_scheduler.backend.by_url(
+        'custom://', celery.Celery())
+    assert isinstance(backend, celery_longterm_scheduler.backend.MemoryBackend)
+
+
+def test_by_url_unknown_scheme_raises():
+    with pytest.raises(KeyError):
+        celery_longterm_scheduler.backend.by_url(
+            'nonexistent://', celery.Celery())
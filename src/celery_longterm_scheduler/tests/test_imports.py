@@ -0,0 +1,40 @@
+import subprocess
+import sys
+
+
+# The cost of the package's own modules, which is about 8ms. Generous, so
+# this only catches somebody adding a heavy import at module level again,
+# not machine speed differences.
+BUDGET_US = 20000
+
+
+def import_times(module):
+    """Returns the cumulative import time in microseconds of each module that
+    importing `module` loads, on top of what celery (including the Task
+    class we subclass), click and kombu already need."""
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import celery, celery.utils, celery.app.task, click,'
+         ' kombu.exceptions; import %s' % module],
+        stderr=subprocess.PIPE, check=True, text=True).stderr
+    result = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        result[name.strip()] = int(cumulative)
+    return result
+
+
+def test_backend_module_does_not_import_backend_dependencies():
+    imported = import_times('celery_longterm_scheduler.backend')
+    assert 'celery_longterm_scheduler.backend' in imported
+    for name in [
+            'redis', 'celery.backends.redis', 'pendulum', 'sortedcontainers',
+            'sqlite3', 'lz4']:
+        assert name not in imported
+
+
+def test_package_import_time_is_within_budget():
+    imported = import_times('celery_longterm_scheduler.backend')
+    assert imported['celery_longterm_scheduler'] < BUDGET_US
@@ -0,0 +1,131 @@
+from celery_longterm_scheduler import metrics
+from unittest import mock
+import celery
+import celery_longterm_scheduler
+import pendulum
+import pytest
+import socket
+import urllib.request
+
+
+PAST_DATE = pendulum.datetime(2017, 1, 20)
+
+
+class RecordingMetrics(metrics.Metrics):
+
+    def __init__(self):
+        self.counters = {}
+        self.observed = {}
+        self.gauges = {}
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        self.observed.setdefault(name, []).append(value)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+
+@pytest.fixture
+def app():
+    app = celery.Celery(task_cls=celery_longterm_scheduler.Task)
+    app.conf['longterm_scheduler_backend'] = 'memory://'
+    app.conf['longterm_scheduler_metrics'] = RecordingMetrics()
+    return app
+
+
+def test_scheduler_records_metrics(app):
+    recorded = app.conf['longterm_scheduler_metrics']
+    scheduler = celery_longterm_scheduler.get_scheduler(app)
+    scheduler.store(PAST_DATE, 'one', ('echo',), {})
+    scheduler.store_many([
+        (PAST_DATE, 'two', ('echo',), {}),
+        (PAST_DATE.add(years=2000), 'later', ('echo',), {})])
+    assert scheduler.revoke('two')
+    with mock.patch.object(app, 'send_task'):
+        scheduler.execute_pending(pendulum.now())
+    assert recorded.counters == {'stored': 3, 'revoked': 1, 'dispatched': 1}
+    assert recorded.observed['dispatch_lag_seconds'][0] > 3600
+    assert recorded.observed['payload_bytes'][0] > 0
+    for name in ['serialize_seconds', 'deserialize_seconds',
+                 'backend_set_seconds', 'backend_set_many_seconds',
+                 'backend_delete_seconds', 'backend_claim_seconds']:
+        assert name in recorded.observed
+    assert recorded.gauges == {
+        'schedule_size': 1, 'oldest_due_age_seconds': 0}
+
+
+def test_scheduler_counts_failed_dispatch(app):
+    recorded = app.conf['longterm_scheduler_metrics']
+    scheduler = celery_longterm_scheduler.get_scheduler(app)
+    scheduler.store(PAST_DATE, 'one', ('echo',), {})
+    with mock.patch.object(app, 'send_task') as send_task:
+        send_task.side_effect = RuntimeError('broker down')
+        scheduler.execute_pending(pendulum.now())
+    assert recorded.counters['failed'] == 1
+    assert recorded.counters['retried'] == 1
+    assert 'backend_fail_seconds' in recorded.observed
+
+
+def test_get_older_than_is_timed(app):
+    recorded = app.conf['longterm_scheduler_metrics']
+    scheduler = celery_longterm_scheduler.get_scheduler(app)
+    scheduler.store(PAST_DATE, 'one', ('echo',), {})
+    assert [x[0] for x in scheduler.backend.get_older_than(PAST_DATE)] == [
+        'one']
+    assert len(recorded.observed['backend_get_older_than_seconds']) == 1
+
+
+def test_prometheus_renders_text_format():
+    exporter = metrics.PrometheusMetrics('prometheus://')
+    exporter.increment('stored', 2)
+    exporter.gauge('schedule_size', 5)
+    exporter.observe('payload_bytes', 100)
+    exporter.observe('payload_bytes', 10 ** 7)
+    text = exporter.render()
+    assert 'longterm_scheduler_stored_total 2\n' in text
+    assert 'longterm_scheduler_schedule_size 5\n' in text
+    assert 'longterm_scheduler_payload_bytes_bucket{le="64"} 0\n' in text
+    assert 'longterm_scheduler_payload_bytes_bucket{le="256"} 1\n' in text
+    assert 'longterm_scheduler_payload_bytes_bucket{le="+Inf"} 2\n' in text
+    assert 'longterm_scheduler_payload_bytes_count 2\n' in text
+    assert 'longterm_scheduler_payload_bytes_sum 10000100\n' in text
+
+
+def test_prometheus_serves_metrics_via_http():
+    exporter = metrics.PrometheusMetrics('prometheus://127.0.0.1:0')
+    exporter.start()
+    try:
+        exporter.increment('dispatched')
+        url = 'http://127.0.0.1:%s/metrics' % exporter.server.server_port
+        with urllib.request.urlopen(url) as response:
+            assert b'longterm_scheduler_dispatched_total 1' in response.read()
+    finally:
+        exporter.server.shutdown()
+
+
+def test_statsd_sends_udp_messages():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(1)
+    exporter = metrics.StatsdMetrics(
+        'statsd://127.0.0.1:%s/myapp' % receiver.getsockname()[1])
+    exporter.increment('stored')
+    exporter.observe('backend_set_seconds', 0.0015)
+    exporter.observe('payload_bytes', 100)
+    exporter.gauge('schedule_size', 3)
+    assert [receiver.recv(100) for _ in range(4)] == [
+        b'myapp.stored:1|c', b'myapp.backend_set_seconds:1.5|ms',
+        b'myapp.payload_bytes:100|h', b'myapp.schedule_size:3|g']
+    receiver.close()
+
+
+def test_metrics_are_configured_by_url():
+    conf = {'longterm_scheduler_metrics': 'statsd://localhost:8125'}
+    assert isinstance(metrics.from_conf(conf), metrics.StatsdMetrics)
+    assert metrics.from_conf(conf) is metrics.from_conf(conf)
+    assert metrics.from_conf({}) is None
+    with pytest.raises(ValueError):
+        metrics.from_conf({'longterm_scheduler_metrics': 'foo://'})
@@ -0,0 +1,30 @@
+from celery_longterm_scheduler.ratelimit import TokenBucket
+
+
+class Clock:
+
+    now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_burst_of_capacity_then_refills_at_rate():
+    clock = Clock()
+    bucket = TokenBucket(10, clock=clock)
+    assert bucket.take(100) == 10
+    assert bucket.take(1) == 0
+    assert bucket.delay() == 0.1
+    clock.now = 0.5
+    assert bucket.take(100) == 5
+    clock.now = 10
+    assert bucket.take(100) == 10
+
+
+def test_bucket_give_back_and_delay_for_several_tokens():
+    clock = Clock()
+    bucket = TokenBucket(2, capacity=4, clock=clock)
+    assert bucket.take(4) == 4
+    bucket.give_back(1)
+    assert bucket.delay(3) == 1
+    assert bucket.delay(100) == 1.5
@@ -1,7 +1,12 @@
 from celery_longterm_scheduler.conftest import CELERY
+from celery_longterm_scheduler.ratelimit import TokenBucket
 from unittest import mock
+import celery
 import celery_longterm_scheduler
+import kombu.exceptions
 import pendulum
+import pytest
+import threading
 import time
 
 
@@ -76,3 +81,351 @@ def test_revoke_deletes_from_storage():
 def test_revoke_returns_false_for_nonexistent_id():
     scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
     assert scheduler.revoke('nonexistent') is False
+
+
+def test_revoke_by_tag_and_name_remove_matching_tasks():
+    app = celery.Celery(task_cls=celery_longterm_scheduler.Task)
+    app.conf['longterm_scheduler_backend'] = 'memory://'
+    app.conf['longterm_scheduler_index_task_names'] = True
+
+    @app.task(name='remind')
+    def remind(arg):
+        pass
+
+    @app.task(name='other')
+    def other(arg):
+        pass
+
+    ids = [remind.apply_async((i,), eta=PAST_DATE, longterm_tags=[
+        'user:%s' % (i % 2)]).id for i in range(4)]
+    other.apply_async((1,), eta=PAST_DATE, longterm_tags=['user:1'])
+    other.apply_async((2,), eta=PAST_DATE)
+    scheduler = celery_longterm_scheduler.get_scheduler(app)
+    assert scheduler.revoke_by_tag('user:0') == 2
+    assert scheduler.revoke_by_name('remind') == 2
+    assert scheduler.revoke_many(ids) == 0
+    assert scheduler.count() == 2
+    with mock.patch.object(app, 'send_task') as send_task:
+        scheduler.execute_pending(PAST_DATE)
+    for call in send_task.call_args_list:
+        assert 'longterm_tags' not in call[1]
+    assert scheduler.revoke_by_tag('user:1') == 0
+
+
+def test_revoke_many_removes_tasks_in_batches():
+    ids = [echo.apply_async((i,), eta=FUTURE_DATE).id for i in range(3)]
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    assert scheduler.revoke_many(iter(ids + ['nonexistent'])) == 3
+    assert scheduler.revoke(ids[0]) is False
+
+
+def test_longterm_tags_must_be_a_list_of_strings():
+    with pytest.raises(ValueError):
+        echo.apply_async(('foo',), eta=FUTURE_DATE, longterm_tags='user:1')
+    with pytest.raises(ValueError):
+        echo.apply_async(('foo',), eta=FUTURE_DATE, longterm_tags=['a\0b'])
+
+
+def test_dedup_key_stores_one_task_per_key():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    first = echo.apply_async(
+        ('old',), eta=FUTURE_DATE, longterm_dedup_key='user:1')
+    second = echo.apply_async(
+        ('new',), eta=FUTURE_DATE.add(days=1), longterm_dedup_key='user:1')
+    other = echo.apply_async(
+        ('other',), eta=FUTURE_DATE, longterm_dedup_key='user:2')
+    assert first.id == second.id != other.id
+    assert scheduler.backend.get(first.id)[1]['args'] == ('new',)
+    echo.apply_async(('late',), eta=FUTURE_DATE.add(days=2),
+                     longterm_dedup_key='user:1',
+                     longterm_dedup_policy='keep_earliest')
+    assert scheduler.backend.get(first.id)[1]['args'] == ('new',)
+    echo.apply_async(('early',), eta=PAST_DATE, longterm_dedup_key='user:1',
+                     longterm_dedup_policy='keep_earliest')
+    with mock.patch.object(CELERY, 'send_task') as send_task:
+        scheduler.execute_pending(PAST_DATE)
+    assert send_task.call_args[1]['args'] == ('early',)
+    assert send_task.call_args[1]['task_id'] == first.id
+    assert 'longterm_dedup_key' not in send_task.call_args[1]
+    # Once sent (or revoked), the key can be scheduled again.
+    echo.apply_async(('again',), eta=FUTURE_DATE, longterm_dedup_key='user:1',
+                     longterm_dedup_policy='keep_earliest')
+    assert scheduler.backend.get(first.id)[1]['args'] == ('again',)
+    assert scheduler.revoke_many([first.id, other.id]) == 2
+
+
+def test_dedup_options_are_validated():
+    with pytest.raises(ValueError):
+        echo.apply_async(('foo',), eta=FUTURE_DATE, longterm_dedup_key='a',
+                         task_id='myid')
+    with pytest.raises(ValueError):
+        echo.apply_async(('foo',), eta=FUTURE_DATE, longterm_dedup_key='a',
+                         longterm_dedup_policy='first')
+    with pytest.raises(ValueError):
+        echo.apply_async(('foo',), eta=FUTURE_DATE,
+                         longterm_dedup_policy='replace')
+    with pytest.raises(ValueError):
+        echo.apply_async_many([(('foo',), {}, FUTURE_DATE, {
+            'longterm_dedup_key': 'a',
+            'longterm_dedup_policy': 'keep_earliest'})])
+
+
+def test_apply_async_many_does_not_store_dedup_policy():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    [id] = echo.apply_async_many([(('foo',), {}, PAST_DATE, {
+        'longterm_dedup_key': 'user:1', 'longterm_dedup_policy': 'replace'})])
+    assert 'longterm_dedup_policy' not in scheduler.backend.get(id)[1]
+    with mock.patch.object(CELERY, 'send_task') as send_task:
+        scheduler.execute_pending(PAST_DATE)
+    assert send_task.call_args[1]['task_id'] == id
+    assert 'longterm_dedup_policy' not in send_task.call_args[1]
+
+
+def test_reschedule_changes_due_time_only():
+    id = echo.apply_async(('foo',), eta=FUTURE_DATE).id
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    assert scheduler.reschedule(id, PAST_DATE)
+    assert [x[0] for x in scheduler.backend.get_older_than(PAST_DATE)] == [id]
+    assert scheduler.backend.get(id)[1]['args'] == ('foo',)
+    assert scheduler.reschedule('nonexistent', PAST_DATE) is False
+    scheduler.revoke(id)
+
+
+def test_reschedule_many_returns_number_of_rescheduled_tasks():
+    ids = [echo.apply_async((i,), eta=PAST_DATE).id for i in range(3)]
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    assert scheduler.reschedule_many(
+        [(id, FUTURE_DATE) for id in ids] + [('nonexistent', FUTURE_DATE)]
+    ) == 3
+    assert not list(scheduler.backend.get_older_than(PAST_DATE))
+    scheduler.backend.delete_many(ids)
+
+
+def test_scheduler_introspection_reads_the_index():
+    app = celery.Celery()
+    app.conf['longterm_scheduler_backend'] = 'memory://'
+    scheduler = celery_longterm_scheduler.get_scheduler(app)
+    scheduler.store_many(
+        (PAST_DATE.add(days=i), str(i), ('echo',), {}) for i in range(3))
+    assert scheduler.count() == 3
+    assert scheduler.count(PAST_DATE.add(days=1)) == 2
+    assert scheduler.next_due() == PAST_DATE
+    entries, cursor = scheduler.list(limit=2)
+    assert [x[:2] for x in entries] == [('0', None), ('1', None)]
+    assert scheduler.list(cursor=cursor, payloads=True) == (
+        [('2', (('echo',), {}), PAST_DATE.add(days=2))], None)
+
+
+def test_execute_pending_publishes_batches_with_one_producer_each():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    ids = [echo.apply_async((i,), eta=PAST_DATE).id for i in range(3)]
+    with mock.patch.object(scheduler, 'batch_size', 2), \
+            mock.patch.object(CELERY, 'send_task') as send_task:
+        scheduler.execute_pending(PAST_DATE)
+    assert [x[1]['task_id'] for x in send_task.call_args_list] == ids
+    producers = [x[1]['producer'] for x in send_task.call_args_list]
+    assert producers[0] is producers[1]
+    assert producers[0] is not None
+    assert not list(scheduler.backend.get_older_than(PAST_DATE))
+
+
+def test_execute_pending_retries_failed_tasks_and_sends_the_others():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    ids = [echo.apply_async((i,), eta=PAST_DATE).id for i in range(3)]
+    with mock.patch.object(CELERY, 'send_task') as send_task:
+        send_task.side_effect = [None, RuntimeError('broker down'), None]
+        scheduler.execute_pending(PAST_DATE)
+    assert [x[1]['task_id'] for x in send_task.call_args_list] == ids
+    # The failed task is due again after the backoff.
+    assert not list(scheduler.backend.get_older_than(PAST_DATE))
+    assert scheduler.next_due() == PAST_DATE.add(seconds=60)
+    pending = [x[0] for x in scheduler.backend.get_older_than(
+        PAST_DATE.add(seconds=60))]
+    assert pending == ids[1:2]
+    scheduler.revoke(ids[1])
+
+
+def test_execute_pending_releases_tasks_if_no_producer_is_available():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    ids = [echo.apply_async((i,), eta=PAST_DATE).id for i in range(2)]
+    with mock.patch.object(CELERY, 'producer_or_acquire') as producer:
+        producer.side_effect = RuntimeError('broker down')
+        assert not scheduler.execute_pending(PAST_DATE)
+    assert list(scheduler.quarantined()) == []
+    pending = [x[0] for x in scheduler.backend.get_older_than(PAST_DATE)]
+    assert pending == ids
+    for id in pending:
+        scheduler.revoke(id)
+
+
+def test_execute_pending_quarantines_tasks_that_fail_too_often():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    task_id = echo.apply_async(('poison',), eta=PAST_DATE).id
+    with mock.patch.object(scheduler, 'max_retries', 2), \
+            mock.patch.object(CELERY, 'send_task') as send_task:
+        send_task.side_effect = RuntimeError('broker down')
+        for hours in range(3):
+            scheduler.execute_pending(PAST_DATE.add(hours=hours))
+    assert send_task.call_count == 3
+    assert list(scheduler.quarantined()) == [
+        (task_id, 'RuntimeError: broker down', PAST_DATE.add(hours=2))]
+    assert scheduler.count(end=PAST_DATE.add(days=1)) == 0
+    assert scheduler.replay([task_id], PAST_DATE) == 1
+    assert list(scheduler.quarantined()) == []
+    assert scheduler.count(end=PAST_DATE) == 1
+    scheduler.revoke(task_id)
+
+
+def test_execute_pending_releases_tasks_if_broker_is_unavailable():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    ids = [echo.apply_async((i,), eta=PAST_DATE).id for i in range(3)]
+    with mock.patch.object(scheduler, 'max_retries', 1), \
+            mock.patch.object(CELERY, 'send_task') as send_task:
+        send_task.side_effect = kombu.exceptions.OperationalError('down')
+        for _ in range(3):
+            assert not scheduler.execute_pending(PAST_DATE)
+    # Each run ends after the first attempt, without counting it against
+    # the tasks.
+    assert send_task.call_count == 3
+    assert list(scheduler.quarantined()) == []
+    pending = [x[0] for x in scheduler.backend.get_older_than(PAST_DATE)]
+    assert pending == ids
+    with mock.patch.object(CELERY, 'send_task'):
+        assert scheduler.execute_pending(PAST_DATE)
+    assert scheduler.count(end=PAST_DATE) == 0
+
+
+def test_execute_pending_quarantines_failing_tasks_and_sends_the_rest():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    poison = [echo.apply_async(('poison',), eta=PAST_DATE).id
+              for _ in range(2)]
+    healthy = echo.apply_async(('ok',), eta=PAST_DATE.add(seconds=1)).id
+    sent = []
+
+    def send_task(*args, **kw):
+        if kw['args'] == ('poison',):
+            raise kombu.exceptions.EncodeError('cannot encode')
+        sent.append(kw['task_id'])
+
+    with mock.patch.object(scheduler, 'batch_size', 2), \
+            mock.patch.object(scheduler, 'max_retries', 0), \
+            mock.patch.object(CELERY, 'send_task', new=send_task):
+        assert scheduler.execute_pending(PAST_DATE.add(seconds=1))
+    assert sent == [healthy]
+    assert sorted(x[0] for x in scheduler.quarantined()) == sorted(poison)
+    assert scheduler.count(end=PAST_DATE.add(days=1)) == 0
+    assert scheduler.revoke_many(poison) == 2
+
+
+def test_execute_pending_publishes_in_parallel_with_own_producers():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    ids = [echo.apply_async((i,), eta=PAST_DATE).id for i in range(8)]
+    calls = []
+
+    def send_task(*args, **kw):
+        calls.append((kw['task_id'], kw['producer'], threading.get_ident()))
+        time.sleep(0.05)  # So all threads get some work.
+
+    with mock.patch.object(CELERY, 'send_task', new=send_task):
+        scheduler.execute_pending(PAST_DATE, concurrency=4)
+    assert sorted(x[0] for x in calls) == sorted(ids)
+    producers = {}
+    for _, producer, thread in calls:
+        producers.setdefault(thread, set()).add(id(producer))
+    assert len(producers) == 4
+    assert len(set.union(*producers.values())) == 4
+    assert not list(scheduler.backend.get_older_than(PAST_DATE))
+
+
+def test_execute_pending_parallel_retries_failed_tasks():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    ids = [echo.apply_async((i,), eta=PAST_DATE).id for i in range(4)]
+
+    def send_task(*args, **kw):
+        if kw['task_id'] == ids[3]:
+            raise RuntimeError('broker down')
+
+    with mock.patch.object(CELERY, 'send_task', new=send_task):
+        scheduler.execute_pending(PAST_DATE, concurrency=2)
+    pending = [x[0] for x in scheduler.backend.get_older_than(pendulum.now())]
+    assert pending == ids[3:]
+    for id in pending:
+        scheduler.revoke(id)
+
+
+def test_execute_pending_publishes_at_most_max_tasks_per_run():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    ids = [echo.apply_async((i,), eta=PAST_DATE).id for i in range(5)]
+    with mock.patch.object(scheduler, 'batch_size', 2), \
+            mock.patch.object(scheduler, 'max_tasks_per_run', 3), \
+            mock.patch.object(CELERY, 'send_task') as send_task:
+        scheduler.execute_pending(PAST_DATE)
+    assert [x[1]['task_id'] for x in send_task.call_args_list] == ids[:3]
+    pending = [x[0] for x in scheduler.backend.get_older_than(PAST_DATE)]
+    assert pending == ids[3:]
+    for id in pending:
+        scheduler.revoke(id)
+
+
+def test_execute_pending_limits_rate_per_task_name():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    ids = [echo.apply_async((i,), eta=PAST_DATE.add(seconds=i)).id
+           for i in range(3)]
+    other = record.apply_async((0,), eta=PAST_DATE.add(seconds=3)).id
+    limits = {echo.name: TokenBucket(20, capacity=1)}
+    with mock.patch.object(scheduler, 'rate_limits', limits), \
+            mock.patch.object(CELERY, 'send_task') as send_task:
+        start = time.monotonic()
+        scheduler.execute_pending(PAST_DATE.add(seconds=3))
+    # The limited tasks wait for their turn, the others don't have to.
+    assert [x[1]['task_id'] for x in send_task.call_args_list] == [
+        ids[0], other, ids[1], ids[2]]
+    assert time.monotonic() - start >= 0.09
+    assert not list(scheduler.backend.get_older_than(PAST_DATE.add(days=1)))
+
+
+def test_scheduler_reads_rate_limits_from_conf():
+    app = celery.Celery()
+    app.conf['longterm_scheduler_backend'] = 'memory://'
+    app.conf['longterm_scheduler_rate'] = '10/m'
+    app.conf['longterm_scheduler_rate_limits'] = {'foo': 5, 'bar': None}
+    scheduler = celery_longterm_scheduler.get_scheduler(app)
+    assert scheduler.rate.rate == 10 / 60
+    assert list(scheduler.rate_limits) == ['foo']
+
+
+def test_execute_forever_executes_tasks_as_soon_as_they_are_stored():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    with mock.patch.object(CELERY, 'send_task') as send_task:
+        thread = threading.Thread(target=scheduler.execute_forever)
+        thread.start()
+        try:
+            time.sleep(0.1)
+            id = echo.apply_async(('foo',), eta=PAST_DATE).id
+            for _ in range(20):
+                if send_task.called:
+                    break
+                time.sleep(0.1)
+        finally:
+            scheduler.stop()
+            thread.join()
+    assert send_task.call_args[1]['task_id'] == id
+    assert not list(scheduler.backend.get_older_than(PAST_DATE))
+
+
+def test_execute_pending_supports_entries_with_pickled_task_type():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    # Format of version 1.3 and earlier
+    scheduler.store(PAST_DATE, 'legacy', (echo.name,), {
+        'args': ('foo',), 'task_id': 'legacy', 'task_type': echo})
+    with mock.patch.object(CELERY, 'send_task') as send_task:
+        scheduler.execute_pending(PAST_DATE)
+    assert send_task.call_args[1]['task_type'].name == echo.name
+
+
+def test_execute_pending_looks_up_task_type_by_name():
+    scheduler = celery_longterm_scheduler.get_scheduler(CELERY)
+    echo.apply_async(('foo',), eta=PAST_DATE)
+    with mock.patch.object(CELERY, 'send_task') as send_task:
+        scheduler.execute_pending(PAST_DATE)
+    assert send_task.call_args[1]['task_type'] is CELERY.tasks[echo.name]
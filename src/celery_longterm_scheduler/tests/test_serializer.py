@@ -0,0 +1,66 @@
+from celery_longterm_scheduler.serializer import Codec, serialize
+import pendulum
+import pytest
+
+
+TASK = [('mytask',), {
+    'args': ['arg'], 'kwargs': {'kw': 1}, 'task_id': 'myid',
+    'expires': pendulum.datetime(2017, 1, 20)}]
+
+
+@pytest.fixture(params=['json', 'pickle', 'msgpack'])
+def serializer(request):
+    if request.param == 'msgpack':
+        pytest.importorskip('msgpack')
+    return request.param
+
+
+@pytest.fixture(params=[None, 'zlib', 'lz4'])
+def compression(request):
+    if request.param == 'lz4':
+        pytest.importorskip('lz4.frame')
+    return request.param
+
+
+def test_entries_can_be_loaded_again(serializer, compression):
+    codec = Codec(serializer, compression, compression_threshold=0)
+    args, kw = codec.loads(codec.dumps(TASK))
+    assert list(args) == ['mytask']
+    assert kw['expires'] == TASK[1]['expires']
+    assert list(kw['args']) == ['arg']
+
+
+def test_entries_can_be_loaded_with_any_configuration(
+        serializer, compression):
+    data = Codec(serializer, compression, 0).dumps(TASK)
+    assert Codec().loads(data)[1]['task_id'] == 'myid'
+
+
+def test_default_configuration_writes_plain_json():
+    assert Codec().dumps(TASK) == serialize(TASK).encode('utf-8')
+
+
+def test_entries_without_header_are_loaded_as_json():
+    assert Codec('pickle').loads(serialize(TASK))[1]['task_id'] == 'myid'
+
+
+def test_compresses_only_entries_above_threshold():
+    codec = Codec('json', 'zlib', compression_threshold=1000)
+    small = codec.dumps(TASK)
+    assert small[2] == 0
+    large = codec.dumps([('mytask',), {'args': ['x' * 2000]}])
+    assert large[2] == codec.compression.id
+    assert len(large) < 2000
+    assert codec.loads(large)[1]['args'] == ['x' * 2000]
+
+
+def test_unknown_names_raise_valueerror():
+    with pytest.raises(ValueError):
+        Codec('nonexistent')
+    with pytest.raises(ValueError):
+        Codec('json', 'nonexistent')
+
+
+def test_unknown_header_id_raises_valueerror():
+    with pytest.raises(ValueError):
+        Codec().loads(bytes([0, 99, 0]) + b'data')
@@ -1,4 +1,5 @@
 from celery_longterm_scheduler import get_scheduler
+from celery_longterm_scheduler.backend import PickleFallbackJSONEncoder
 from celery_longterm_scheduler.conftest import CELERY
 from unittest import mock
 import pendulum
@@ -45,7 +46,7 @@ def test_should_store_all_arguments_needed_for_send_task(celery_worker):
         # scheduler storage), while the normal apply_async() defers that to
         # send_task(). We undo this here for comparison purposes.
         kw['task_id'] = None
-        CELERY.send_task(*args, **kw)
+        get_scheduler(CELERY)._execute_task(result.id, args, kw)
         scheduled_call = calls[0]
 
         echo.apply_async(('foo',))
@@ -68,3 +69,39 @@ def test_should_bypass_if_no_eta_given():
 
         echo.apply_async(('foo',), eta=pendulum.now())
         assert schedule.call_count == 1
+
+
+def test_should_store_task_name_instead_of_pickled_task_instance():
+    result = echo.apply_async(('foo',), eta=pendulum.now())
+    scheduler = get_scheduler(CELERY)
+    raw = scheduler.backend.by_id[result.id]
+    assert PickleFallbackJSONEncoder.PICKLE_MARKER.encode('ascii') not in raw
+    args, kw = scheduler.backend.get(result.id)
+    assert args == (echo.name,)
+    assert 'task_type' not in kw
+    scheduler.revoke(result.id)
+
+
+def test_apply_async_many_stores_like_apply_async():
+    scheduler = get_scheduler(CELERY)
+    due = pendulum.now()
+    single = echo.apply_async(('foo',), eta=due, queue='myqueue').id
+    ids = echo.apply_async_many(
+        (((arg,), None, due, {'queue': 'myqueue'}) for arg in ['foo', 'bar']))
+    assert len(ids) == 2
+    expected = scheduler.backend.get(single)
+    for id, arg in zip(ids, ['foo', 'bar']):
+        args, kw = scheduler.backend.get(id)
+        assert kw.pop('task_id') == id
+        assert kw['args'] == (arg,)
+        kw['args'] = ('foo',)
+        assert (args, dict(kw, task_id=single)) == expected
+    for id in ids + [single]:
+        scheduler.revoke(id)
+
+
+def test_apply_async_many_uses_given_task_ids():
+    ids = echo.apply_async_many(
+        [(('foo',), None, pendulum.now(), {'task_id': 'myid'})])
+    assert ids == ['myid']
+    assert get_scheduler(CELERY).revoke('myid')